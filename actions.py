@@ -0,0 +1,134 @@
+"""Precompiled action programs.
+
+The actions and instructions of a flow are compiled once into an
+ActionProgram: the VLAN operations to apply to the packet, the output port,
+the group and the goto_table targets, so matching a flow doesn't walk its
+instructions and compare action types again on every hop.
+"""
+from napps.amlight.sdntrace_cp.utils import METADATA_MASK, copy_args
+
+PUSH_VLAN = 0
+POP_VLAN = 1
+SET_VLAN = 2
+
+
+class ActionProgram:
+    """Compiled actions and instructions of a flow.
+
+    has_output tells whether the flow has an output action, output is the
+    port of the last one, outputs are the (number of VLAN operations
+    before it, port) of each output action, group is the group_id of
+    the last group action or None, and metadata is the (value, mask) of
+    the write_metadata instruction or None."""
+
+    __slots__ = ('ops', 'has_output', 'output', 'outputs', 'group', 'gotos',
+                 'metadata')
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, ops=(), has_output=False, output=None, group=None,
+                 gotos=(), *, outputs=None, metadata=None):
+        self.ops = ops
+        self.has_output = has_output
+        self.output = output
+        self.group = group
+        self.gotos = gotos
+        self.metadata = metadata
+        if outputs is None:
+            outputs = ((len(ops), output),) if has_output else ()
+        self.outputs = outputs
+
+    def run(self, args, copies=None):
+        """Apply the VLAN operations to the packet fields, in place.
+
+        If copies is a list, a copy of the packet fields as sent by each
+        output action is appended to it with the port, as a (packet fields,
+        port) pair."""
+        if copies is None or not self.outputs:
+            self.apply(self.ops, args)
+            return
+        start = 0
+        for position, port in self.outputs:
+            self.apply(self.ops[start:position], args)
+            start = position
+            copies.append((copy_args(args), port))
+        self.apply(self.ops[start:], args)
+
+    def write_metadata(self, args):
+        """Write the metadata of the packet fields, in place.
+
+        The metadata of a packet is 0 until it's written."""
+        value, mask = self.metadata
+        args['metadata'] = (args.get('metadata', 0) & ~mask) | (value & mask)
+
+    @staticmethod
+    def apply(ops, args):
+        """Apply VLAN operations to the packet fields, in place."""
+        for operation, value in ops:
+            if operation == SET_VLAN:
+                args['dl_vlan'][-1] = value
+            elif operation == PUSH_VLAN:
+                if 'dl_vlan' not in args:
+                    args['dl_vlan'] = []
+                args['dl_vlan'].append(0)
+            elif 'dl_vlan' in args:
+                args['dl_vlan'].pop()
+                if len(args['dl_vlan']) == 0:
+                    del args['dl_vlan']
+
+
+def compile_program(flow):
+    """Compile the actions and instructions of a stored flow.
+
+    Only the last apply_actions instruction is applied. KeyError or
+    TypeError is raised if the flow is malformed."""
+    flow = flow['flow']
+    actions = ()
+    gotos = []
+    metadata = None
+    if 'actions' in flow:
+        actions = flow['actions']
+    elif 'instructions' in flow:
+        for instruction in flow['instructions']:
+            if instruction['instruction_type'] == 'apply_actions':
+                actions = instruction['actions']
+            elif instruction['instruction_type'] == 'goto_table':
+                gotos.append(instruction['table_id'])
+            elif instruction['instruction_type'] == 'write_metadata':
+                metadata = (int(instruction['metadata']),
+                            int(instruction.get('metadata_mask',
+                                                METADATA_MASK)))
+    program = compile_actions(actions, gotos)
+    program.metadata = metadata
+    return program
+
+
+def compile_actions(actions, gotos=()):
+    """Compile a list of actions, like the ones of a group bucket."""
+    ops = []
+    outputs = []
+    has_output, output, group = False, None, None
+    for action in actions:
+        action_type = action['action_type']
+        if action_type == 'output':
+            has_output, output = True, action['port']
+            outputs.append((len(ops), output))
+        elif action_type == 'group':
+            group = action['group_id']
+        elif action_type == 'push_vlan':
+            ops.append((PUSH_VLAN, None))
+        elif action_type == 'pop_vlan':
+            ops.append((POP_VLAN, None))
+        elif action_type == 'set_vlan':
+            ops.append((SET_VLAN, action['vlan_id']))
+    return ActionProgram(tuple(ops), has_output, output, group, tuple(gotos),
+                         outputs=tuple(outputs))
+
+
+def try_compile_program(flow):
+    """Compile the actions and instructions of a stored flow, or return
+    None if it's malformed, so the error is raised only when it's
+    matched."""
+    try:
+        return compile_program(flow)
+    except (KeyError, TypeError):
+        return None
@@ -0,0 +1,77 @@
+"""Admission control of trace requests.
+
+The number of trace requests in flight, including trace jobs not finished
+yet, and the number of their entries are bounded. Requests over the limits
+are rejected with a 429 error and a Retry-After header instead of queueing
+up until the controller stalls.
+"""
+from contextlib import contextmanager
+from threading import Lock
+
+from kytos.core.rest_api import HTTPException
+from napps.amlight.sdntrace_cp import settings
+
+
+class AdmissionControl:
+    """Counters of the trace requests and entries in flight."""
+
+    def __init__(self, max_requests=settings.TRACE_MAX_REQUESTS,
+                 max_entries=settings.TRACE_MAX_ENTRIES,
+                 retry_after=settings.TRACE_RETRY_AFTER):
+        self.max_requests = max_requests
+        self.max_entries = max_entries
+        self.retry_after = retry_after
+        self.requests = 0
+        self.entries = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._lock = Lock()
+
+    def acquire(self, entries=1):
+        """Admit a request with a number of entries or raise an error:
+        413 if it has more entries than ever admitted at once, 429 if the
+        limits are reached now."""
+        if entries > self.max_entries:
+            raise HTTPException(
+                413, f"Requests can't have more than {self.max_entries} "
+                     f"entries, not {entries}"
+            )
+        with self._lock:
+            if self.requests >= self.max_requests or \
+                    self.entries + entries > self.max_entries:
+                self.rejected += 1
+                raise HTTPException(
+                    429, f"Too many traces in flight: {self.requests} "
+                         f"requests with {self.entries} entries",
+                    headers={"Retry-After": str(self.retry_after)}
+                )
+            self.requests += 1
+            self.entries += entries
+            self.admitted += 1
+
+    def release(self, entries=1):
+        """Release a request admitted with a number of entries."""
+        with self._lock:
+            self.requests -= 1
+            self.entries -= entries
+
+    @contextmanager
+    def admit(self, entries=1):
+        """Hold an admitted request while in the context."""
+        self.acquire(entries)
+        try:
+            yield
+        finally:
+            self.release(entries)
+
+    def stats(self):
+        """Return the current load and the limits as a dict."""
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "max_requests": self.max_requests,
+                "entries": self.entries,
+                "max_entries": self.max_entries,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+            }
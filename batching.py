@@ -0,0 +1,105 @@
+"""Micro-batching of single trace requests.
+
+Single trace requests arriving within a short window of each other are
+collected into one batch, which the first request of the batch runs once the
+window is over or the batch is full. The batch shares the flow snapshot, the
+pipeline cache warmed by its traces and identical entries, while each request
+still gets its own result.
+"""
+from threading import Event, Lock
+
+from napps.amlight.sdntrace_cp import settings
+
+
+class TraceBatch:
+    """Entries of a batch and their results once it has run."""
+
+    def __init__(self):
+        self.entries = []
+        self.results = None
+        self.error = None
+        self.full = Event()
+        self.done = Event()
+
+
+class TraceBatcher:
+    """Collect concurrent single traces with the same batch key into
+    batches run by run_batch.
+
+    run_batch takes the batch key and the list of entries, and returns the
+    list of their results, where an exception is raised to the caller of
+    its entry. With a window of 0 every entry is run alone, right away."""
+
+    def __init__(self, run_batch, window=settings.TRACE_BATCH_WINDOW,
+                 max_entries=settings.TRACE_BATCH_MAX_ENTRIES):
+        self._run_batch = run_batch
+        self.window = window
+        self.max_entries = max_entries
+        self._batches = {}
+        self._lock = Lock()
+        self.batches = 0
+        self.entries = 0
+        self.max_batch = 0
+
+    def submit(self, batch_key, entry):
+        """Return the result of an entry, run in a batch with the entries
+        submitted with the same key within the window."""
+        if self.window <= 0:
+            return self._result(self._run(batch_key, [entry]), 0)
+        with self._lock:
+            batch = self._batches.get(batch_key)
+            leader = batch is None
+            if leader:
+                batch = self._batches[batch_key] = TraceBatch()
+            index = len(batch.entries)
+            batch.entries.append(entry)
+            if len(batch.entries) >= self.max_entries:
+                del self._batches[batch_key]
+                batch.full.set()
+        if not leader:
+            batch.done.wait()
+            return self._result(batch, index)
+        batch.full.wait(self.window / 1000)
+        with self._lock:
+            if self._batches.get(batch_key) is batch:
+                del self._batches[batch_key]
+        self._run(batch_key, batch.entries, batch)
+        return self._result(batch, index)
+
+    def _run(self, batch_key, entries, batch=None):
+        """Run the entries of a batch and wake up its callers."""
+        batch = batch or TraceBatch()
+        batch.entries = entries
+        try:
+            batch.results = self._run_batch(batch_key, entries)
+        # Any failure of a batch must be raised to each of its callers
+        # instead of leaving them waiting
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            batch.error = exc
+        finally:
+            with self._lock:
+                self.batches += 1
+                self.entries += len(entries)
+                self.max_batch = max(self.max_batch, len(entries))
+            batch.done.set()
+        return batch
+
+    @staticmethod
+    def _result(batch, index):
+        """Return the result of the entry at index, or raise its error."""
+        if batch.error is not None:
+            raise batch.error
+        result = batch.results[index]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def stats(self):
+        """Return the batching metrics as a dict."""
+        with self._lock:
+            return {
+                "window": self.window,
+                "batches": self.batches,
+                "entries": self.entries,
+                "max_batch": self.max_batch,
+            }
@@ -0,0 +1,81 @@
+"""Circuit breaker of the flow source.
+
+Fetching the stored flows from flow_manager retries with long timeouts, so
+a slow flow_manager makes every trace wait for it. After failure_threshold
+consecutive failures the circuit opens and fetches fail fast for
+reset_timeout seconds, then a single fetch is tried again: the circuit
+closes if it succeeds and opens again if it fails.
+"""
+from threading import Lock
+from time import monotonic
+
+from napps.amlight.sdntrace_cp import settings
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the flow source while the circuit is
+    open."""
+
+
+class CircuitBreaker:
+    """Call a function unless it failed too many times in a row."""
+
+    def __init__(self, call,
+                 failure_threshold=settings.FLOW_SOURCE_FAILURE_THRESHOLD,
+                 reset_timeout=settings.FLOW_SOURCE_RESET_TIMEOUT):
+        self._call = call
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.failures = 0
+        self.rejected = 0
+        self.opened = 0
+        self._opened_at = None
+        self._lock = Lock()
+
+    def __call__(self, *args, **kwargs):
+        """Call the function, or raise CircuitOpenError if the circuit is
+        open or a trial call is already running."""
+        with self._lock:
+            if self.state == OPEN and \
+                    monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+            elif self.state != CLOSED:
+                self.rejected += 1
+                raise CircuitOpenError(
+                    f"The flow source circuit is {self.state}"
+                )
+            trial = self.state == HALF_OPEN
+        try:
+            result = self._call(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.failures += 1
+                self.consecutive_failures += 1
+                if trial or \
+                        self.consecutive_failures >= self.failure_threshold:
+                    if self.state != OPEN:
+                        self.opened += 1
+                    self.state = OPEN
+                    self._opened_at = monotonic()
+            raise
+        with self._lock:
+            self.consecutive_failures = 0
+            self.state = CLOSED
+        return result
+
+    def stats(self):
+        """Return the circuit state and metrics as a dict."""
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "opened": self.opened,
+            }
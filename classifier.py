@@ -0,0 +1,252 @@
+"""Compiled flow tables.
+
+The flows of a (dpid, table_id) are grouped by the fields they match exactly
+and by the prefix lengths of the IP fields they match, and each group is a
+hash table from the values of these fields, IP addresses masked to the
+prefix length, to the flows that have them. A lookup only checks with
+do_match the first candidate of each group that could beat the best match
+so far, instead of every flow of the table.
+
+Flows are ordered by priority, highest first, then by the order they were
+added, and kept along with their compiled ActionProgram. Tables are
+persistent: adding or removing a flow returns a new table that shares
+everything but the changed bucket with the previous one, so snapshots still
+using the previous table aren't affected.
+
+Fields matched by mask, dl_vlan 0, metadata 0 and untagged packets are left
+to do_match, so the index never changes the result of a lookup.
+"""
+import ipaddress
+from bisect import insort
+from itertools import count
+
+from napps.amlight.sdntrace_cp.actions import try_compile_program
+
+# Priority of flows that don't have one, as in flow_manager
+DEFAULT_PRIORITY = 0x8000
+IP_FIELDS = ('nw_src', 'nw_dst', 'ipv6_src', 'ipv6_dst')
+
+# Flows added later are ordered after the ones with the same priority
+_sequence = count()
+
+
+def flow_order(flow):
+    """Return the order key of a stored flow added now."""
+    return (-flow['flow'].get('priority', DEFAULT_PRIORITY), next(_sequence))
+
+
+def sort_flows(flows):
+    """Return the stored flows of a switch as a tuple in priority order."""
+    return tuple(sorted(
+        flows, key=lambda flow: -flow['flow'].get('priority',
+                                                  DEFAULT_PRIORITY)
+    ))
+
+
+def exact_value(name, value):
+    """Return the value a packet must have for an exact match field of a
+    flow, or None if the field isn't matched exactly."""
+    if name == 'dl_vlan':
+        if isinstance(value, int) and 0 < value <= 4095:
+            return value
+        return None
+    if name == 'metadata' and not isinstance(value, int):
+        return None
+    if isinstance(value, (int, str)) and not isinstance(value, bool) \
+            and value:
+        return value
+    return None
+
+
+def index_key(match):
+    """Return the index fields of a flow match and the key of the flow.
+
+    Index fields are (name,) for exact match fields and (name, IP version,
+    prefix length) for IP fields."""
+    index = {}
+    for name, value in match.items():
+        if name in IP_FIELDS:
+            try:
+                network = ipaddress.ip_network(value, strict=False)
+            except (TypeError, ValueError):
+                continue
+            if network.prefixlen:
+                shift = network.max_prefixlen - network.prefixlen
+                index[(name, network.version, network.prefixlen)] = \
+                    int(network.network_address) >> shift
+            continue
+        value = exact_value(name, value)
+        if value is not None:
+            index[(name,)] = value
+    fields = tuple(sorted(index))
+    return fields, tuple(index[field] for field in fields)
+
+
+def packet_value(args, field, addresses):
+    """Return the value of a packet for an index field, or None if no flow
+    indexed by the field can match the packet.
+
+    addresses caches the IP addresses of the packet already parsed."""
+    name = field[0]
+    if name == 'dl_vlan':
+        vlan = args.get('dl_vlan')
+        if not vlan or not isinstance(vlan[-1], int):
+            return None
+        return vlan[-1] & 4095
+    value = args.get(name)
+    if not value or isinstance(value, (list, dict)):
+        return None
+    if len(field) == 1:
+        return value
+    address = addresses.get(name)
+    if address is None:
+        address = addresses[name] = ipaddress.ip_address(value)
+    _, version, prefixlen = field
+    if address.version != version:
+        return None
+    return int(address) >> (address.max_prefixlen - prefixlen)
+
+
+class FlowTable:
+    """Persistent index of the flows of a table, see the module
+    docstring.
+
+    matcher caches the generated matcher of the table, if any."""
+
+    __slots__ = ('groups', 'idle', 'size', 'matcher')
+
+    def __init__(self, groups=None, idle=(), size=0):
+        self.groups = groups if groups is not None else {}
+        self.idle = idle
+        self.size = size
+        self.matcher = None
+
+    @classmethod
+    def from_flows(cls, entries):
+        """Index (order, stored flow) pairs.
+
+        Flows without match fields never match, they are only kept."""
+        table = cls(size=len(entries))
+        idle = []
+        for order, flow in sorted(entries, key=lambda entry: entry[0]):
+            match = flow['flow'].get('match')
+            if not match:
+                idle.append((order, flow, None))
+                continue
+            index, key = index_key(match)
+            table.groups.setdefault(index, {}).setdefault(key, []).append(
+                (order, flow, try_compile_program(flow))
+            )
+        table.idle = tuple(idle)
+        return table
+
+    def add(self, order, flow):
+        """Return a new table with a stored flow added.
+
+        As in OpenFlow, a flow of the table with the same priority and
+        match is replaced."""
+        priority = flow['flow'].get('priority', DEFAULT_PRIORITY)
+        match = flow['flow'].get('match')
+        table, _ = self.remove(flow['flow'], lambda other: (
+            other['flow'].get('priority', DEFAULT_PRIORITY) == priority
+            and other['flow'].get('match') == match
+        ))
+        if not match:
+            idle = list(table.idle)
+            insort(idle, (order, flow, None), key=lambda entry: entry[0])
+            return FlowTable(table.groups, tuple(idle), table.size + 1)
+        fields, key = index_key(match)
+        groups = dict(table.groups)
+        buckets = groups[fields] = dict(groups.get(fields, {}))
+        bucket = buckets[key] = list(buckets.get(key, ()))
+        insort(bucket, (order, flow, try_compile_program(flow)),
+               key=lambda entry: entry[0])
+        return FlowTable(groups, table.idle, table.size + 1)
+
+    def remove(self, flow, same):
+        """Remove the stored flow for which same(stored flow) is true.
+
+        flow is the flow as in the 'flow' key of a stored flow. Return the
+        new table and the stored flow removed, or this table and None if
+        there's no such flow."""
+        match = flow.get('match')
+        if not match:
+            for index, (_, stored_flow, _) in enumerate(self.idle):
+                if same(stored_flow):
+                    idle = self.idle[:index] + self.idle[index + 1:]
+                    return FlowTable(self.groups, idle,
+                                     self.size - 1), stored_flow
+            return self, None
+        fields, key = index_key(match)
+        bucket = self.groups.get(fields, {}).get(key, ())
+        for index, (_, stored_flow, _) in enumerate(bucket):
+            if not same(stored_flow):
+                continue
+            groups = dict(self.groups)
+            buckets = groups[fields] = dict(groups[fields])
+            bucket = bucket[:index] + bucket[index + 1:]
+            if bucket:
+                buckets[key] = bucket
+            else:
+                del buckets[key]
+                if not buckets:
+                    del groups[fields]
+            return FlowTable(groups, self.idle,
+                             self.size - 1), stored_flow
+        return self, None
+
+    def entries(self):
+        """Return the (order, stored flow, program) entries of the table,
+        sorted."""
+        entries = list(self.idle)
+        for buckets in self.groups.values():
+            for bucket in buckets.values():
+                entries.extend(bucket)
+        entries.sort(key=lambda entry: entry[0])
+        return entries
+
+    def lookup(self, args, match):
+        """Return the first flow of the table for which match(flow) is true,
+        or None."""
+        return self.find(args, match)[0]
+
+    def find(self, args, match):
+        """Return the first flow of the table for which match(flow) is true
+        and its ActionProgram, or (None, None)."""
+        best_order, best = None, (None, None)
+        addresses = {}
+        for fields, buckets in self.groups.items():
+            key = []
+            for field in fields:
+                value = packet_value(args, field, addresses)
+                if value is None:
+                    break
+                key.append(value)
+            else:
+                for order, flow, program in buckets.get(tuple(key), ()):
+                    if best_order is not None and order >= best_order:
+                        break
+                    if match(flow):
+                        best_order, best = order, (flow, program)
+                        break
+        return best
+
+
+def compile_tables(flows):
+    """Compile the stored flows of a switch, in priority order, into
+    FlowTables by table_id."""
+    tables = {}
+    for flow in flows:
+        table_id = flow['flow'].get('table_id', 0)
+        tables.setdefault(table_id, []).append((flow_order(flow), flow))
+    return {table_id: FlowTable.from_flows(entries)
+            for table_id, entries in tables.items()}
+
+
+def table_flows(tables):
+    """Return the stored flows of compiled tables in priority order."""
+    entries = []
+    for table in tables.values():
+        entries.extend(table.entries())
+    entries.sort(key=lambda entry: entry[0])
+    return tuple(entry[1] for entry in entries)
@@ -0,0 +1,143 @@
+"""Generated flow table matchers.
+
+A matcher is a Python function generated from the flows of a table that
+returns the first flow matching a packet, with the same result as calling
+do_match on every flow in order. The packet fields are read once, the match
+values of the flows are inlined as constants, and the fields of each flow
+are compared from the most selective one, the field with the most distinct
+values in the table, so a flow that doesn't match fails early.
+
+Flows whose match values can't be compiled, like malformed VLANs or IP
+networks, are left to do_match.
+"""
+import ipaddress
+
+from napps.amlight.sdntrace_cp.classifier import IP_FIELDS
+from napps.amlight.sdntrace_cp.utils import convert_metadata
+
+
+def _literal(value, constants):
+    """Return the source of a constant, inlined if it's a literal."""
+    if type(value) in (int, str):
+        return repr(value)
+    constants.append(value)
+    return f"K[{len(constants) - 1}]"
+
+
+def _vlan_condition(value):
+    """Return the condition of a dl_vlan match value or None."""
+    if value == 0 and isinstance(value, int):
+        return "(not vlan or top & 4095 == 0)"
+    try:
+        if isinstance(value, int):
+            vid, mask = value, 4095
+        else:
+            vid, mask = map(int, value.split('/'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+    mask &= 4095
+    return f"(vlan and top & {mask} == {vid & mask})"
+
+
+def _metadata_condition(variable, value):
+    """Return the condition of a metadata match value or None."""
+    try:
+        value, mask = convert_metadata(value)
+    except (AttributeError, TypeError, ValueError):
+        return None
+    return f"({variable} & {mask} == {value & mask})"
+
+
+def _ip_condition(variable, value):
+    """Return the condition of an IP match value or None."""
+    try:
+        network = ipaddress.ip_network(value, strict=False)
+    except (TypeError, ValueError):
+        return None
+    mask = int(network.netmask)
+    return (f"({variable}_version == {network.version} and "
+            f"{variable}_int & {mask} == {int(network.network_address)})")
+
+
+def _read_field(name, variable):
+    """Return the source lines reading a packet field into its
+    variables."""
+    if name == 'dl_vlan':
+        return ["    vlan = args.get('dl_vlan')",
+                "    top = vlan[-1] if vlan else None"]
+    if name == 'metadata':
+        return [f"    {variable} = args.get('metadata') or 0"]
+    lines = [f"    {variable} = args.get({name!r})"]
+    if name in IP_FIELDS:
+        lines.extend([
+            f"    if {variable}:",
+            f"        {variable}_ip = address({variable})",
+            f"        {variable}_version = {variable}_ip.version",
+            f"        {variable}_int = int({variable}_ip)",
+            "    else:",
+            f"        {variable}_version = {variable}_int = 0",
+        ])
+    return lines
+
+
+def _condition(name, variable, value, constants):
+    """Return the condition of a match field or None."""
+    if name == 'dl_vlan':
+        return _vlan_condition(value)
+    if name == 'metadata':
+        return _metadata_condition(variable, value)
+    if name in IP_FIELDS:
+        return _ip_condition(variable, value)
+    return f"({variable} and {variable} == {_literal(value, constants)})"
+
+
+def generate_matcher(flows):
+    """Return the source of a matcher for stored flows in table order, and
+    the constants it uses."""
+    values = {}
+    for flow in flows:
+        for name, value in (flow['flow'].get('match') or {}).items():
+            values.setdefault(name, set()).add(repr(value))
+    order = {name: -len(distinct) for name, distinct in values.items()}
+    variables = {name: f"f{index}" for index, name in enumerate(values)}
+
+    lines = ["def matcher(args):"]
+    for name, variable in variables.items():
+        lines.extend(_read_field(name, variable))
+
+    constants = []
+    for index, flow in enumerate(flows):
+        match = flow['flow'].get('match')
+        if not match:
+            continue
+        conditions = [
+            _condition(name, variables[name], match[name], constants)
+            for name in sorted(match, key=order.get)
+        ]
+        if None in conditions:
+            lines.append(f"    if fallback(F[{index}], args):")
+        else:
+            lines.append(f"    if {' and '.join(conditions)}:")
+        lines.append(f"        return R[{index}]")
+    lines.append("    return None")
+    return "\n".join(lines) + "\n", constants
+
+
+def compile_matcher(flows, fallback, results=None):
+    """Generate and compile the matcher of stored flows in table order.
+
+    fallback(flow, args) is called for the flows that can't be compiled.
+    If results are given, the matcher returns the result at the position
+    of the flow matched instead of the flow."""
+    flows = tuple(flows)
+    source, constants = generate_matcher(flows)
+    namespace = {
+        'F': flows,
+        'R': tuple(results) if results is not None else flows,
+        'K': tuple(constants),
+        'address': ipaddress.ip_address,
+        'fallback': fallback,
+    }
+    # pylint: disable=exec-used
+    exec(compile(source, "<flow table matcher>", "exec"), namespace)
+    return namespace['matcher']
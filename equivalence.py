@@ -0,0 +1,195 @@
+"""Packet equivalence classes.
+
+The values of each field of a packet are split into atoms by the match
+values of a set of flows, and the class of a packet is the tuple of the
+atoms of its fields. Packets of the same class are matched by the same
+flows, so the class can stand for the packet in caches and sweeps:
+
+- exact match values are an atom each, and the values no flow matches are
+  the atom 0;
+- VLAN IDs matched by mask are split once into a table of the 4096 VLAN
+  IDs, and untagged packets are the atom -1;
+- IP addresses are split by the networks that contain them, one lookup per
+  prefix length matched;
+- fields matched by values that can't be split, like malformed VLANs or
+  metadata matched by mask, are classified by their raw values.
+
+Adding flows can only split classes, so the classes of a set of flows still
+hold after removing some of them.
+"""
+import ipaddress
+
+from napps.amlight.sdntrace_cp.classifier import IP_FIELDS
+from napps.amlight.sdntrace_cp.utils import convert_vlan
+
+UNTAGGED = -1
+
+
+class EquivalenceClasses:
+    """Packet equivalence classes of the match values of flows, see the
+    module docstring."""
+
+    __slots__ = ('fields', 'atoms', 'masks', 'networks', 'raw', 'vlans')
+
+    def __init__(self, matches=()):
+        self.atoms = {}
+        self.masks = set()
+        self.networks = {}
+        self.raw = set()
+        for match in matches:
+            for name, value in (match or {}).items():
+                self._add(name, value)
+        self.fields = tuple(sorted({*self.atoms, *self.networks,
+                                    *self.raw}))
+        self.vlans = None
+        if self.masks:
+            self.vlans = self._vlan_table()
+
+    @classmethod
+    def from_flows(cls, flows):
+        """Return the classes of stored flows."""
+        return cls(flow['flow'].get('match') for flow in flows)
+
+    @staticmethod
+    def _split(name, value):
+        """Return how a match value splits its field, as a (kind, key,
+        value) tuple: ('network', (version, prefixlen), network number),
+        ('mask', (VLAN ID, mask), None) or ('atom', None, value).
+
+        AttributeError, TypeError or ValueError is raised if the value
+        can't be split."""
+        if name in IP_FIELDS:
+            network = ipaddress.ip_network(value, strict=False)
+            shift = network.max_prefixlen - network.prefixlen
+            return ('network', (network.version, network.prefixlen),
+                    int(network.network_address) >> shift)
+        if name == 'dl_vlan':
+            vid, mask = convert_vlan(value)
+            mask &= 4095
+            if mask != 4095:
+                return 'mask', (vid & mask, mask), None
+            return 'atom', None, vid & 4095
+        if name == 'metadata' and not isinstance(value, int):
+            raise ValueError("Metadata matched by mask")
+        return 'atom', None, value
+
+    def _add(self, name, value):
+        """Add the atom of a match value."""
+        if name in self.raw:
+            return
+        try:
+            kind, key, value = self._split(name, value)
+        except (AttributeError, TypeError, ValueError):
+            self._set_raw(name)
+            return
+        if kind == 'network':
+            self.networks.setdefault(name, {}).setdefault(key,
+                                                          set()).add(value)
+            return
+        atoms = self.atoms.setdefault(name, {})
+        if kind == 'mask':
+            self.masks.add(key)
+            return
+        try:
+            atoms.setdefault(value, len(atoms) + 1)
+        except TypeError:
+            # Unhashable values are never equal to a classified value
+            pass
+
+    def _set_raw(self, name):
+        """Classify a field by its raw values."""
+        self.raw.add(name)
+        self.atoms.pop(name, None)
+        self.networks.pop(name, None)
+        if name == 'dl_vlan':
+            self.masks.clear()
+
+    def _vlan_table(self):
+        """Return the atoms of the 4096 VLAN IDs, split by the exact and
+        masked VLAN matches."""
+        exact = self.atoms.get('dl_vlan', {})
+        masks = tuple(self.masks)
+        signatures = {}
+        return tuple(
+            signatures.setdefault(
+                (exact.get(vid, 0),
+                 tuple(vid & mask == value for value, mask in masks)),
+                len(signatures)
+            )
+            for vid in range(4096)
+        )
+
+    def covers(self, match):
+        """Whether the classes still hold with a flow with this match."""
+        for name, value in (match or {}).items():
+            if name in self.raw:
+                continue
+            if name not in self.fields:
+                return False
+            try:
+                kind, key, value = self._split(name, value)
+            except (AttributeError, TypeError, ValueError):
+                return False
+            if kind == 'network':
+                if value not in self.networks.get(name, {}).get(key, ()):
+                    return False
+            elif kind == 'mask':
+                if key not in self.masks:
+                    return False
+            elif not self._is_atom(name, value):
+                return False
+        return True
+
+    def _is_atom(self, name, value):
+        """Whether a value is an atom of a field, unhashable values being
+        never equal to a classified value."""
+        try:
+            return value in self.atoms[name]
+        except TypeError:
+            return True
+
+    def class_of(self, args):
+        """Return the class of a packet, or None if it can't be classified,
+        like packets with unhashable or malformed fields."""
+        key = []
+        try:
+            for name in self.fields:
+                value = args.get(name)
+                if name == 'dl_vlan':
+                    if not value:
+                        key.append(UNTAGGED)
+                        continue
+                    value = value[-1]
+                    if name in self.raw:
+                        key.append(value)
+                    elif self.vlans is not None:
+                        key.append(self.vlans[value & 4095])
+                    else:
+                        key.append(self.atoms[name].get(value & 4095, 0))
+                elif name in self.raw:
+                    hash(value)
+                    key.append(value)
+                elif name in self.networks:
+                    key.append(self._network_atom(name, value))
+                elif name == 'metadata':
+                    key.append(self.atoms[name].get(value or 0, 0))
+                else:
+                    key.append(self.atoms[name].get(value, 0))
+        except (TypeError, ValueError):
+            return None
+        return tuple(key)
+
+    def _network_atom(self, name, value):
+        """Return the atom of an IP address: its version and the network
+        containing it for each prefix length, or None."""
+        if not value:
+            return None
+        address = ipaddress.ip_address(value)
+        number = int(address)
+        atom = [address.version]
+        for (version, prefixlen), networks in self.networks[name].items():
+            if version != address.version:
+                continue
+            network = number >> (address.max_prefixlen - prefixlen)
+            atom.append(network if network in networks else None)
+        return tuple(atom)
@@ -0,0 +1,129 @@
+"""Group tables.
+
+Group definitions are kept locally by switch, with the actions of their
+buckets compiled into ActionPrograms. A packet sent to a group is copied to
+the buckets the group type selects:
+
+- all: every bucket;
+- select: any bucket, so every bucket is a possible path;
+- indirect: the only bucket;
+- ff: the first bucket whose watch port is up, or that doesn't watch any.
+
+A bucket can send the packet to another group, up to GROUP_CHAIN_MAX
+groups deep.
+"""
+from threading import Lock
+
+from napps.amlight.sdntrace_cp import settings
+from napps.amlight.sdntrace_cp.actions import compile_actions
+from napps.amlight.sdntrace_cp.utils import copy_args
+
+GROUP_TYPES = ('all', 'select', 'indirect', 'ff')
+
+
+class Group:
+    """A group of a switch and its compiled buckets."""
+
+    __slots__ = ('group_id', 'group_type', 'buckets', 'programs')
+
+    def __init__(self, group):
+        self.group_id = group['group_id']
+        self.group_type = group['group_type']
+        if self.group_type not in GROUP_TYPES:
+            raise ValueError(f"Unknown group_type {self.group_type}")
+        self.buckets = group.get('buckets', [])
+        self.programs = tuple(compile_actions(bucket.get('actions', []))
+                              for bucket in self.buckets)
+
+    def as_dict(self):
+        """Return the group as given."""
+        return {'group_id': self.group_id, 'group_type': self.group_type,
+                'buckets': self.buckets}
+
+    def selected(self, switch):
+        """Return the indexes of the buckets a packet is copied to."""
+        if self.group_type == 'indirect':
+            return range(min(len(self.buckets), 1))
+        if self.group_type == 'ff':
+            for index, bucket in enumerate(self.buckets):
+                port = bucket.get('watch_port')
+                if port is None:
+                    return [index]
+                interface = switch.get_interface_by_port_no(port)
+                if interface and interface.is_active():
+                    return [index]
+            return []
+        return range(len(self.buckets))
+
+
+class GroupTables:
+    """Local store of the group tables of the switches.
+
+    The groups of a switch are replaced at once, so readers never see a
+    partial update."""
+
+    def __init__(self, max_chain=settings.GROUP_CHAIN_MAX):
+        self.max_chain = max_chain
+        self._groups = {}
+        self._lock = Lock()
+
+    def set(self, dpid, groups):
+        """Replace the groups of a switch.
+
+        ValueError is raised if a group is invalid, KeyError if it misses a
+        required field."""
+        compiled = {}
+        for group in groups:
+            group = Group(group)
+            compiled[group.group_id] = group
+        with self._lock:
+            if compiled:
+                self._groups[dpid] = compiled
+            else:
+                self._groups.pop(dpid, None)
+
+    def get(self, dpid, group_id):
+        """Return a group of a switch or None."""
+        return self._groups.get(dpid, {}).get(group_id)
+
+    def list(self):
+        """Return the groups of all switches as dicts, by dpid."""
+        return {dpid: [group.as_dict() for group in groups.values()]
+                for dpid, groups in self._groups.items()}
+
+    def outputs(self, switch, group_id, args, depth=0):
+        """Return the copies of a packet sent to a group.
+
+        Return a list of (packet fields, output port, branch) tuples, where
+        branch describes the groups and buckets the copy went through. The
+        packet fields are only copied when there's more than one bucket."""
+        group = self.get(switch.dpid, group_id)
+        if group is None or depth >= self.max_chain:
+            return []
+        selected = group.selected(switch)
+        outputs = []
+        for index in selected:
+            entries = copy_args(args) if len(selected) > 1 else args
+            branch = [{'group': group_id, 'group_type': group.group_type,
+                       'bucket': index}]
+            outputs.extend(
+                (entries_, port, branch + chained)
+                for entries_, port, chained in self._bucket_outputs(
+                    switch, group.programs[index], entries, depth
+                )
+            )
+        return outputs
+
+    def _bucket_outputs(self, switch, program, entries, depth):
+        """Return the copies of a packet sent by the program of a bucket,
+        as in outputs, with the branch of the groups chained after it."""
+        if program.group is None and len(program.outputs) > 1:
+            copies = []
+            program.run(entries, copies)
+            return [(copy, port, []) for copy, port in copies]
+        program.run(entries)
+        if program.group is not None:
+            return self.outputs(switch, program.group, entries, depth + 1)
+        if program.has_output:
+            return [(entries, program.output, [])]
+        return []
@@ -0,0 +1,856 @@
+"""Header space analysis for symbolic traces.
+
+A symbolic trace follows a set of packet headers instead of a single packet.
+The set is a list of disjoint cubes, each cube maps a header field to the
+state of that field:
+
+- None: the field is absent from the packet;
+- (value, mask): ternary bit vector, bits set in the mask are fixed to the
+  ones of value and the other bits can be anything;
+- ('=', value) or ('!', values): value of a field that isn't a bit vector,
+  equal to value or different from all values (or absent);
+- ANY: the field can be absent or have any value.
+
+Fields missing from a cube are absent, as in the entries of a concrete trace.
+
+The dl_vlan field is a tuple of ternary VLAN IDs, the outermost last, with
+an empty tuple for untagged packets.
+
+Each flow table splits a header set by the flows that match it, following
+the same semantics of Main.match_and_apply, so the result of a symbolic
+trace is a tree of paths with the subset of the headers that takes each one.
+"""
+import ipaddress
+import itertools
+
+from kytos.core import log
+from napps.amlight.sdntrace_cp import settings
+from napps.amlight.sdntrace_cp.utils import (OFPP_ALL, OFPP_FLOOD,
+                                             OFPP_IN_PORT, convert_vlan,
+                                             find_endpoint, output_ports,
+                                             port_number)
+
+EMPTY = object()
+ANY = object()
+
+INT_FIELDS = {'dl_type': 16, 'nw_proto': 8, 'nw_tos': 8,
+              'tp_src': 16, 'tp_dst': 16}
+MAC_FIELDS = ('dl_src', 'dl_dst')
+IP_FIELDS = {'nw_src': 4, 'nw_dst': 4, 'ipv6_src': 6, 'ipv6_dst': 6}
+VLAN_WIDTH = 12
+
+
+def field_width(name):
+    """Return the width in bits of a ternary field or None."""
+    if name in INT_FIELDS:
+        return INT_FIELDS[name]
+    if name in MAC_FIELDS:
+        return 48
+    if name in IP_FIELDS:
+        return 32 if IP_FIELDS[name] == 4 else 128
+    if name == 'dl_vlan':
+        return VLAN_WIDTH
+    return None
+
+
+def full_mask(width):
+    """Return the mask with all the bits of a field set."""
+    return (1 << width) - 1
+
+
+def ternary_intersect(first, second):
+    """Return the intersection of two ternary values or EMPTY."""
+    value1, mask1 = first
+    value2, mask2 = second
+    if (value1 ^ value2) & mask1 & mask2:
+        return EMPTY
+    return ((value1 & mask1) | (value2 & mask2), mask1 | mask2)
+
+
+def ternary_subtract(first, second):
+    """Return disjoint ternary values that cover first minus second.
+
+    Bits are fixed from the most significant one, so pieces of ranges are
+    prefixes and can be merged back by merge_cubes."""
+    value, mask = first
+    value2, mask2 = second
+    if (value ^ value2) & mask & mask2:
+        return [first]
+    pieces = []
+    value &= mask
+    free_bits = mask2 & ~mask
+    while free_bits:
+        bit = 1 << (free_bits.bit_length() - 1)
+        pieces.append((value | (~value2 & bit), mask | bit))
+        value |= value2 & bit
+        mask |= bit
+        free_bits ^= bit
+    return pieces
+
+
+def range_to_ternary(low, high, width):
+    """Split an inclusive range of integers into ternary values."""
+    if low > high or low < 0 or high > full_mask(width):
+        raise ValueError(f"Invalid range {low}-{high}")
+    pieces = []
+    while low <= high:
+        size = low & -low if low else 1 << width
+        while size > high - low + 1:
+            size >>= 1
+        pieces.append((low, full_mask(width) & ~(size - 1)))
+        low += size
+    return pieces
+
+
+def _parse_int(value):
+    """Parse an integer given as int or string, decimal or hexadecimal."""
+    if isinstance(value, bool):
+        raise ValueError(f"Invalid value {value}")
+    if isinstance(value, int):
+        return value
+    return int(value, 0)
+
+
+def _parse_mac(value):
+    """Parse a MAC address into an integer."""
+    return int(value.replace(':', '').replace('-', ''), 16)
+
+
+def parse_ternary(name, value):
+    """Parse the value of a field of a symbolic trace into ternary values.
+
+    Integers take exact values, ranges as 'low-high' and masked values as
+    'value/mask'; IP addresses take prefixes; and '*' stands for any value.
+    """
+    width = field_width(name)
+    if value == '*':
+        return [(0, 0)]
+    if name in IP_FIELDS:
+        network = ipaddress.ip_network(value, strict=False)
+        if network.version != IP_FIELDS[name]:
+            raise ValueError(f"Invalid IPv{IP_FIELDS[name]} value {value}")
+        return [(int(network.network_address), int(network.netmask))]
+    parse = _parse_mac if name in MAC_FIELDS else _parse_int
+    if isinstance(value, str) and '/' in value:
+        value, mask = value.split('/')
+        mask = parse(mask) & full_mask(width)
+        return [(parse(value) & mask, mask)]
+    if isinstance(value, str) and '-' in value and name not in MAC_FIELDS:
+        low, high = value.split('-')
+        return range_to_ternary(_parse_int(low), _parse_int(high), width)
+    value = parse(value)
+    if not 0 <= value <= full_mask(width):
+        raise ValueError(f"Value {value} out of range for field {name}")
+    return [(value, full_mask(width))]
+
+
+def parse_header_space(entries):
+    """Parse the plain entries of a symbolic trace into a list of cubes.
+
+    The value of each field can be one value or a list of them, for the
+    union of their headers."""
+    alternatives = []
+    for name, value in entries.items():
+        if name in ('dpid', 'in_port'):
+            continue
+        if name == 'dl_vlan':
+            # convert_entries wraps dl_vlan in a list
+            value = value[0]
+        values = value if isinstance(value, list) else [value]
+        if name == 'dl_vlan':
+            states = [(ternary,) for item in values
+                      for ternary in parse_ternary(name, item)]
+        elif field_width(name):
+            states = [ternary for item in values
+                      for ternary in parse_ternary(name, item)]
+        else:
+            states = [('=', item) for item in values]
+        alternatives.append([(name, state) for state in states])
+    cubes = []
+    for combination in itertools.product(*alternatives):
+        cube = {'dl_vlan': ()}
+        cube.update(combination)
+        cubes.append(cube)
+        if len(cubes) > settings.HSA_MAX_CUBES:
+            raise ValueError("The header space has too many combinations")
+    return cubes
+
+
+def flow_predicate(match):
+    """Compile a flow match, but in_port, into a list of constraints.
+
+    Each constraint is a tuple (field, kind, data) following do_match:
+    'vlan' for dl_vlan, 'ternary' for bit vector fields and 'exact' for any
+    other field, compared by equality."""
+    predicate = []
+    for name, field_flow in match.items():
+        if name == 'in_port':
+            continue
+        if name == 'dl_vlan':
+            value, mask = convert_vlan(field_flow)
+            mask &= full_mask(VLAN_WIDTH)
+            predicate.append((name, 'vlan',
+                              (value & mask, mask, field_flow == 0)))
+        elif name in IP_FIELDS:
+            network = ipaddress.ip_network(field_flow, strict=False)
+            if network.version != IP_FIELDS[name]:
+                # The packet address is never in this network
+                predicate.append((name, 'ternary', (0, -1)))
+                continue
+            predicate.append((name, 'ternary',
+                              (int(network.network_address),
+                               int(network.netmask))))
+        elif name in MAC_FIELDS or name in INT_FIELDS:
+            try:
+                value = parse_ternary(name, field_flow)[0]
+            except (AttributeError, TypeError, ValueError):
+                predicate.append((name, 'exact', field_flow))
+                continue
+            predicate.append((name, 'ternary', value))
+        else:
+            predicate.append((name, 'exact', field_flow))
+    return predicate
+
+
+def _intersect_vlan(state, data):
+    """Return the VLAN stack of a cube restricted to a constraint on its
+    top VLAN or EMPTY."""
+    value, mask, untagged = data
+    if not state:
+        return state if untagged else EMPTY
+    top = ternary_intersect(state[-1], (value, mask))
+    return EMPTY if top is EMPTY else state[:-1] + (top,)
+
+
+def _intersect_ternary(state, data):
+    """Return the ternary state of a field restricted to a ternary value or
+    EMPTY."""
+    if state is ANY:
+        return (data[0] & data[1], data[1])
+    return ternary_intersect(state, data)
+
+
+def _intersect_state(kind, state, data):
+    """Return the state of a field restricted to a constraint or EMPTY."""
+    if kind == 'vlan':
+        return _intersect_vlan(state, data)
+    if state is None:
+        return EMPTY
+    if kind == 'ternary':
+        return _intersect_ternary(state, data)
+    if state is ANY or (state[0] == '!' and data not in state[1]):
+        return ('=', data)
+    if state[0] == '=' and state[1] == data:
+        return state
+    return EMPTY
+
+
+def _subtract_vlan(state, data):
+    """Return the VLAN stacks of a cube whose top VLAN doesn't satisfy a
+    constraint."""
+    value, mask, untagged = data
+    if not state:
+        return [] if untagged else [state]
+    return [state[:-1] + (top,)
+            for top in ternary_subtract(state[-1], (value, mask))]
+
+
+def _subtract_ternary(state, data):
+    """Return the ternary states of a field that don't match a ternary
+    value, absent included."""
+    if state is ANY:
+        return [None] + ternary_subtract((0, 0), data)
+    return ternary_subtract(state, data)
+
+
+def _subtract_state(kind, state, data):
+    """Return the states of a field that don't satisfy a constraint."""
+    if kind == 'vlan':
+        return _subtract_vlan(state, data)
+    if state is None:
+        return [state]
+    if kind == 'ternary':
+        return _subtract_ternary(state, data)
+    if state is ANY:
+        return [('!', frozenset([data]))]
+    if state[0] == '!':
+        return [('!', state[1] | {data})]
+    return [] if state[1] == data else [state]
+
+
+def intersect_cube(cube, predicate):
+    """Return the headers of a cube that satisfy a predicate or None."""
+    new_cube = cube
+    for name, kind, data in predicate:
+        state = new_cube.get(name)
+        new_state = _intersect_state(kind, state, data)
+        if new_state is EMPTY:
+            return None
+        if new_state is not state:
+            if new_cube is cube:
+                new_cube = dict(cube)
+            new_cube[name] = new_state
+    return new_cube
+
+
+def subtract_cube(cube, predicate):
+    """Return disjoint cubes with the headers of cube that don't satisfy
+    a predicate."""
+    if intersect_cube(cube, predicate) is None:
+        return [cube]
+    pieces = []
+    current = cube
+    for name, kind, data in predicate:
+        state = current.get(name)
+        for new_state in _subtract_state(kind, state, data):
+            piece = dict(current)
+            piece[name] = new_state
+            pieces.append(piece)
+        current = dict(current)
+        current[name] = _intersect_state(kind, state, data)
+    return pieces
+
+
+def split_cubes(cubes, predicate):
+    """Split cubes into the headers that satisfy a predicate and the rest."""
+    matched, rest = [], []
+    for cube in cubes:
+        match = intersect_cube(cube, predicate)
+        if match is None:
+            rest.append(cube)
+            continue
+        matched.append(match)
+        rest.extend(subtract_cube(cube, predicate))
+    return matched, rest
+
+
+def _get_ternary(cube, name):
+    """Return the ternary value of a field, the outermost for dl_vlan."""
+    state = cube.get(name)
+    if name == 'dl_vlan':
+        return state[-1] if state else None
+    if isinstance(state, tuple) and len(state) == 2 \
+            and isinstance(state[0], int):
+        return state
+    return None
+
+
+def _merge_field(cubes, name):
+    """Merge cubes that only differ by the lowest fixed bit of a field."""
+    merged = True
+    while merged and len(cubes) > 1:
+        merged = False
+        pending = {}
+        result = []
+        for cube in cubes:
+            ternary = _get_ternary(cube, name)
+            if not ternary or not ternary[1]:
+                result.append(cube)
+                continue
+            value, mask = ternary
+            bit = mask & -mask
+            rest = cube.get(name)[:-1] if name == 'dl_vlan' else None
+            key = (tuple(item for item in cube.items() if item[0] != name),
+                   rest, mask, value & ~bit)
+            if key not in pending:
+                pending[key] = cube
+                continue
+            del pending[key]
+            cube = dict(cube)
+            ternary = (value & ~bit, mask & ~bit)
+            cube[name] = rest + (ternary,) if rest is not None else ternary
+            result.append(cube)
+            merged = True
+        result.extend(pending.values())
+        cubes = result
+    return cubes
+
+
+def merge_cubes(cubes, names):
+    """Merge cubes with sibling values of the given fields, so splitting
+    by many flows doesn't fragment the header space."""
+    for name in names:
+        cubes = _merge_field(cubes, name)
+    return cubes
+
+
+def apply_actions(cube, actions):
+    """Apply the VLAN actions of a flow to a cube, like match_and_apply.
+
+    When the cube tracks its ingress VLANs, see ingress_cube, the ones that
+    are removed or replaced are kept in it."""
+    vlan = cube.get('dl_vlan', ())
+    kept = cube.get('_vlan_kept')
+    lost = cube.get('_vlan_lost', ())
+    for action in actions:
+        action_type = action['action_type']
+        if action_type == 'push_vlan':
+            vlan = vlan + ((0, full_mask(VLAN_WIDTH)),)
+            continue
+        if action_type not in ('pop_vlan', 'set_vlan') or not vlan:
+            continue
+        if kept is not None and len(vlan) <= kept:
+            kept -= 1
+            lost = vlan[-1:] + lost
+        if action_type == 'pop_vlan':
+            vlan = vlan[:-1]
+        else:
+            vlan = vlan[:-1] + ((action['vlan_id'],
+                                 full_mask(VLAN_WIDTH)),)
+    if vlan is cube.get('dl_vlan', ()):
+        return cube
+    cube = dict(cube)
+    cube['dl_vlan'] = vlan
+    if kept is not None:
+        cube['_vlan_kept'] = kept
+        cube['_vlan_lost'] = lost
+    return cube
+
+
+def ingress_cube(cube):
+    """Return the headers a tracked cube had when it was created.
+
+    Actions only change the VLANs, so a cube created by any_headers tracks
+    how many of its VLANs are still the ingress ones and the ingress VLANs
+    that were popped or replaced, as they were when removed."""
+    cube = dict(cube)
+    kept = cube.pop('_vlan_kept')
+    cube['dl_vlan'] = cube['dl_vlan'][:kept] + cube.pop('_vlan_lost', ())
+    return cube
+
+
+def any_headers():
+    """Return cubes with any untagged or single tagged headers, tracking
+    their ingress VLANs."""
+    cube = {name: ANY for name in
+            itertools.chain(INT_FIELDS, MAC_FIELDS, IP_FIELDS)}
+    return [{**cube, 'dl_vlan': vlan, '_vlan_kept': len(vlan)}
+            for vlan in ((), ((0, 0),))]
+
+
+def output_actions(actions):
+    """Return the (actions before it, port) of each output action.
+
+    As in the copies of ActionProgram.run, each output action sends a copy
+    of the packet with the VLAN actions before it applied."""
+    return [(actions[:index], action['port'])
+            for index, action in enumerate(actions)
+            if action['action_type'] == 'output']
+
+
+def _format_ip(width, value, mask):
+    """Format a ternary IP address as an address, a prefix or an address
+    and a mask."""
+    cls = ipaddress.IPv4Address if width == 32 else ipaddress.IPv6Address
+    prefix = bin(mask).count('1')
+    if mask != full_mask(width) & ~full_mask(width - prefix):
+        return f"{cls(value)}/{cls(mask)}"
+    if prefix == width:
+        return str(cls(value))
+    return f"{cls(value)}/{prefix}"
+
+
+def _format_mac(width, value, mask):
+    """Format a ternary MAC address as an address or an address and a
+    mask."""
+    def mac(number):
+        octets = number.to_bytes(6, 'big')
+        return ':'.join(f"{octet:02x}" for octet in octets)
+    if mask == full_mask(width):
+        return mac(value)
+    return f"{mac(value)}/{mac(mask)}"
+
+
+def format_ternary(name, value, mask):
+    """Format a ternary value of a field for the JSON response."""
+    width = field_width(name)
+    if mask == 0:
+        return '*'
+    if name in IP_FIELDS:
+        return _format_ip(width, value, mask)
+    if name in MAC_FIELDS:
+        return _format_mac(width, value, mask)
+    if mask == full_mask(width):
+        return value
+    free = full_mask(width) & ~mask
+    if not free & (free + 1):
+        return f"{value}-{value | free}"
+    return f"{value}/{mask}"
+
+
+def format_cube(cube):
+    """Format a cube for the JSON response, absent fields are left out and
+    fields that can take any value or be absent are null."""
+    result = {}
+    for name, state in cube.items():
+        if name.startswith('_'):
+            continue
+        if name == 'dl_vlan':
+            result[name] = [format_ternary(name, *ternary)
+                            for ternary in state]
+        elif state is None:
+            continue
+        elif state is ANY:
+            result[name] = None
+        elif state[0] == '=':
+            result[name] = state[1]
+        elif state[0] == '!':
+            result[name] = {'not': sorted(state[1], key=str)}
+        else:
+            result[name] = format_ternary(name, *state)
+    return result
+
+
+class SymbolicTracer:
+    """Trace header spaces through the stored flows."""
+
+    def __init__(self, get_switch, stored_flows):
+        self.get_switch = get_switch
+        self.stored_flows = stored_flows
+        self._predicates = {}
+        self._nodes = 0
+
+    def trace(self, dpid, in_port, cubes):
+        """Trace a header space starting at a switch port.
+
+        Return the tree of paths: each node is a step on a switch, with a
+        branch for each subset of its headers that is handled differently.
+        """
+        self._nodes = 0
+        return self._trace_step(dpid, in_port, cubes, [])
+
+    def _predicate(self, flow, table_id, in_port):
+        """Return the predicate of a flow or None if it can't match.
+
+        As in do_match, flows without match or from another table don't
+        match, and in_port is compared with the port of the step."""
+        match = flow['flow'].get('match')
+        if not match or flow['flow'].get('table_id', 0) != table_id:
+            return None
+        if 'in_port' in match and (not in_port
+                                   or match['in_port'] != in_port):
+            return None
+        key = id(flow)
+        if key not in self._predicates:
+            self._predicates[key] = (flow, flow_predicate(match))
+        return self._predicates[key][1]
+
+    @staticmethod
+    def _instructions(flow, table_id):
+        """Return the actions and goto table of a flow, like
+        process_tables."""
+        actions, goto_table = [], None
+        if 'actions' in flow['flow']:
+            return flow['flow']['actions'], None
+        for instruction in flow['flow'].get('instructions', []):
+            if instruction['instruction_type'] == 'apply_actions':
+                actions = instruction['actions']
+            elif instruction['instruction_type'] == 'goto_table':
+                if instruction['table_id'] <= table_id:
+                    msg = f"Wrong table_id in {flow['flow']}: The packet " \
+                          "can only been directed to a flow table number " \
+                          f"greather than {table_id}"
+                    raise ValueError(msg)
+                goto_table = instruction['table_id']
+        return actions, goto_table
+
+    def switch_paths(self, switch, in_port, cubes):
+        """Split the headers arriving at a switch port by the flows they
+        match, like match_and_apply.
+
+        Return a list of (actions, cubes) pairs, with None actions for the
+        headers that match no flow. Headers that take flows with the same
+        effect are grouped together."""
+        results = []
+        self._process_table(switch.dpid, 0, in_port, cubes, [], results)
+        paths = {}
+        for actions, matched in results:
+            key = _actions_key(actions)
+            if key in paths:
+                paths[key][1].extend(matched)
+            else:
+                paths[key] = (actions, list(matched))
+        return [(actions, merge_cubes(matched, _field_names(matched)))
+                for actions, matched in paths.values()]
+
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    def _process_table(self, dpid, table_id, in_port, cubes, actions,
+                       results):
+        """Split cubes by the flows of a table, following goto_table.
+
+        Append to results an (actions, cubes) pair for each matched path
+        and a (None, cubes) pair for the headers that match nothing."""
+        remaining = cubes
+        merge_above = 2 * len(remaining) + 16
+        for flow in self.stored_flows.get(dpid) or []:
+            predicate = self._predicate(flow, table_id, in_port)
+            if predicate is None:
+                continue
+            matched, remaining = split_cubes(remaining, predicate)
+            if len(remaining) > merge_above:
+                # Merging is amortized over the flows that fragment the rest
+                remaining = merge_cubes(remaining, _field_names(remaining))
+                if len(remaining) > settings.HSA_MAX_CUBES:
+                    raise ValueError("The header space has too many "
+                                     "combinations")
+                merge_above = 2 * len(remaining) + 16
+            if matched:
+                flow_actions, goto_table = self._instructions(flow, table_id)
+                if goto_table is None:
+                    results.append((actions + list(flow_actions), matched))
+                else:
+                    self._process_table(dpid, goto_table, in_port, matched,
+                                        actions + list(flow_actions),
+                                        results)
+            if not remaining:
+                break
+        if remaining:
+            results.append((None, remaining))
+
+    def _trace_step(self, dpid, in_port, cubes, path):
+        """Trace the headers arriving at a switch port."""
+        self._nodes += 1
+        if self._nodes > settings.HSA_MAX_STEPS:
+            raise ValueError("The symbolic trace has too many steps")
+        node = {'dpid': dpid, 'port': in_port,
+                'type': 'intermediary' if path else 'starting',
+                'branches': []}
+        switch = self.get_switch(dpid)
+        if not switch:
+            node['type'] = 'last'
+            return node
+        path = path + [(dpid, in_port)]
+        for actions, matched in self.switch_paths(switch, in_port, cubes):
+            node['branches'].extend(
+                self._branches(switch, actions, matched, path)
+            )
+        return node
+
+    def _branches(self, switch, actions, cubes, path):
+        """Follow the headers of a switch that took the same flows, with a
+        branch for every port they are sent to.
+
+        As in concrete traces, every output action sends a copy of the
+        headers and FLOOD, ALL and IN_PORT are expanded, see output_ports.
+        Group actions aren't followed."""
+        outputs = []
+        if actions is not None and switch.ofp_version == '0x04':
+            for before, port in output_actions(actions):
+                outputs.extend((before, port_no) for port_no in
+                               output_ports(switch, port, path[-1][1]))
+        if not outputs:
+            return [{'headers': [format_cube(cube) for cube in cubes],
+                     'type': 'no_match', 'out': None}]
+        return [self._branch(switch, before, port, cubes, path)
+                for before, port in outputs]
+
+    # pylint: disable=too-many-arguments
+    def _branch(self, switch, actions, port, cubes, path):
+        """Follow the headers sent to a port after the given actions."""
+        branch = {'headers': [format_cube(cube) for cube in cubes],
+                  'type': 'no_match', 'out': None}
+        endpoint = find_endpoint(switch, port) if port else None
+        if endpoint is None:
+            if port:
+                log.warning("Port %s not found on switch %s", port, switch)
+            return branch
+        cubes = [apply_actions(cube, actions) for cube in cubes]
+        branch['out'] = {'port': port,
+                         'headers': [format_cube(cube) for cube in cubes]}
+        first_dpid, first_port = path[0]
+        endpoint = endpoint['endpoint']
+        if endpoint is None:
+            branch['type'] = 'last'
+            if len(path) == 1 and first_port == port:
+                branch['type'] = 'loop'
+            return branch
+        next_step = (endpoint.switch.dpid, endpoint.port_number)
+        if next_step in path or (len(path) > 1
+                                 and first_dpid == switch.dpid
+                                 and first_port == port):
+            branch['type'] = 'loop'
+            return branch
+        branch['type'] = 'next'
+        branch['next'] = self._trace_step(*next_step, cubes, path)
+        return branch
+
+    def _inverse(self, dpid):
+        """Index the flows of a switch by output port.
+
+        Return a dict from each output port to the in_ports whose packets
+        may be sent to it, or None when it can be any in_port. Tables are
+        walked in order, following goto_table, so only in_ports that may
+        reach a table are taken for its flows. The index over-approximates
+        the matching, the headers are checked by a forward trace later."""
+        tables = {}
+        for flow in self.stored_flows.get(dpid) or []:
+            if flow['flow'].get('match'):
+                tables.setdefault(flow['flow'].get('table_id', 0),
+                                  []).append(flow)
+        reach = {0: None}
+        inverse = {}
+        for table_id in sorted(tables):
+            if table_id not in reach:
+                continue
+            for flow in tables[table_id]:
+                in_ports = _restrict_ports(
+                    reach[table_id], flow['flow']['match'].get('in_port')
+                )
+                if in_ports is not None and not in_ports:
+                    continue
+                try:
+                    actions, goto_table = self._instructions(flow, table_id)
+                except ValueError:
+                    continue
+                for _, port in output_actions(actions):
+                    port = port_number(port)
+                    inverse[port] = _union_ports(inverse.get(port, set()),
+                                                 in_ports)
+                if goto_table is not None:
+                    reach[goto_table] = _union_ports(
+                        reach.get(goto_table, set()), in_ports
+                    )
+        return inverse
+
+    def reverse(self, dpid, port):
+        """Find the ingress ports and headers that reach an egress port.
+
+        The inverted flow tables and the links are walked backwards from
+        the egress to find the candidate ingress ports, which are the ports
+        without links, and then any headers are traced from each candidate,
+        only following the ports found on the way back."""
+        self._nodes = 0
+        candidates, exits = self._candidates(dpid, port)
+        result = []
+        for in_dpid, in_port in sorted(candidates):
+            found = []
+            self._reach(in_dpid, in_port, any_headers(), [], (dpid, port),
+                        exits, found)
+            if found:
+                result.append({
+                    'dpid': in_dpid, 'port': in_port,
+                    'headers': [format_cube(ingress_cube(cube))
+                                for cube in found],
+                })
+        return result
+
+    def _candidates(self, dpid, port):
+        """Walk the inverted flow tables and the links backwards from an
+        egress port.
+
+        Return the candidate ingress ports, as (dpid, port) pairs, and the
+        exits, the (dpid, port) pairs found on the way back."""
+        inverses = {}
+        exits = {(dpid, port)}
+        pending = [(dpid, port)]
+        candidates = []
+        while pending:
+            exit_dpid, exit_port = pending.pop()
+            switch = self.get_switch(exit_dpid)
+            if not switch:
+                continue
+            if exit_dpid not in inverses:
+                inverses[exit_dpid] = self._inverse(exit_dpid)
+            in_ports = _in_ports(inverses[exit_dpid], exit_port)
+            if in_ports is None:
+                in_ports = switch.interfaces.keys()
+            for in_port in sorted(in_ports):
+                endpoint = find_endpoint(switch, in_port)
+                if endpoint is None:
+                    continue
+                endpoint = endpoint['endpoint']
+                if endpoint is None:
+                    candidates.append((exit_dpid, in_port))
+                    continue
+                previous = (endpoint.switch.dpid, endpoint.port_number)
+                if previous not in exits:
+                    exits.add(previous)
+                    pending.append(previous)
+        return candidates, exits
+
+    # pylint: disable=too-many-arguments, too-many-positional-arguments
+    def _reach(self, dpid, in_port, cubes, path, egress, exits, found):
+        """Trace headers forward, only through the given exits, and add
+        to found the ones leaving through egress."""
+        self._nodes += 1
+        if self._nodes > settings.HSA_MAX_STEPS:
+            raise ValueError("The reverse trace has too many steps")
+        switch = self.get_switch(dpid)
+        if not switch or switch.ofp_version != '0x04':
+            return
+        path = path + [(dpid, in_port)]
+        for actions, matched in self.switch_paths(switch, in_port, cubes):
+            for before, port in output_actions(actions or []):
+                for port_no in output_ports(switch, port, in_port):
+                    if (dpid, port_no) in exits:
+                        self._forward(
+                            switch, port_no,
+                            [apply_actions(cube, before) for cube in matched],
+                            path, egress, exits, found
+                        )
+
+    def _forward(self, switch, port, cubes, path, egress, exits, found):
+        """Add to found the headers sent to a port if it's the egress,
+        otherwise keep tracing them from the other end of its link, see
+        _reach."""
+        if (switch.dpid, port) == egress:
+            found.extend(cubes)
+            return
+        endpoint = find_endpoint(switch, port)
+        endpoint = endpoint and endpoint['endpoint']
+        if endpoint is None:
+            return
+        next_step = (endpoint.switch.dpid, endpoint.port_number)
+        if next_step not in path:
+            self._reach(*next_step, cubes, path, egress, exits, found)
+
+
+def _actions_key(actions):
+    """Return what a list of actions does to a packet, as a hashable."""
+    if actions is None:
+        return None
+    return tuple(
+        (action['action_type'], action.get('vlan_id'), action.get('port'))
+        for action in actions
+        if action['action_type'] in ('push_vlan', 'pop_vlan', 'set_vlan',
+                                     'output')
+    )
+
+
+def _in_ports(inverse, port):
+    """Return the in_ports whose packets may be sent to a port by the
+    flows indexed by _inverse, None being any in_port.
+
+    FLOOD and ALL send packets to any port but their in_port, IN_PORT to
+    their in_port."""
+    in_ports = inverse.get(port, set())
+    for reserved in (OFPP_FLOOD, OFPP_ALL):
+        flooded = inverse.get(reserved, set())
+        in_ports = _union_ports(in_ports, flooded if flooded is None
+                                else flooded - {port})
+    looped = inverse.get(OFPP_IN_PORT, set())
+    if looped is None or port in looped:
+        in_ports = _union_ports(in_ports, {port})
+    return in_ports
+
+
+def _field_names(cubes):
+    """Return the names of the fields of a list of cubes."""
+    return {name for cube in cubes for name in cube
+            if not name.startswith('_')}
+
+
+def _restrict_ports(in_ports, flow_in_port):
+    """Return the in_ports that satisfy the in_port of a flow match."""
+    if flow_in_port is None:
+        return in_ports
+    if in_ports is None or flow_in_port in in_ports:
+        return {flow_in_port}
+    return set()
+
+
+def _union_ports(in_ports, other):
+    """Return the union of two sets of in_ports, None being any in_port."""
+    if in_ports is None or other is None:
+        return None
+    return in_ports | other
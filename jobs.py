@@ -0,0 +1,173 @@
+"""Asynchronous bulk trace jobs.
+
+A job is a batch of trace entries that runs in background against the
+stored flows fetched when it was submitted. Finished jobs are kept in a
+bounded store, so their results can be fetched page by page.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from datetime import datetime
+from itertools import chain
+from threading import Event, Lock
+from uuid import uuid4
+
+from kytos.core import log
+from napps.amlight.sdntrace_cp import settings
+
+
+class JobsLimitError(Exception):
+    """Raised when the job store can't accept another job."""
+
+
+class TraceJob:
+    """State of a bulk trace job."""
+
+    FINISHED = ("done", "failed", "cancelled")
+
+    def __init__(self, entries, stored_flows, trace_kwargs=None):
+        self.id = uuid4().hex
+        self.entries = entries
+        self.stored_flows = stored_flows
+        self.snapshot = getattr(stored_flows, "version", None)
+        self.trace_kwargs = trace_kwargs or {}
+        self.total = len(entries)
+        self.results = []
+        self.status = "pending"
+        self.error = None
+        self.created_at = str(datetime.now())
+        self.started_at = None
+        self.finished_at = None
+        self.future = None
+        self.cancel_event = Event()
+
+    @property
+    def finished(self):
+        """Whether the job won't produce more results."""
+        return self.status in self.FINISHED
+
+    def page(self, offset, limit):
+        """Return a page of the results computed so far."""
+        return self.results[offset:offset + limit]
+
+    def as_dict(self):
+        """Return the job status as a dict."""
+        return {
+            "id": self.id,
+            "status": self.status,
+            "total": self.total,
+            "snapshot": self.snapshot,
+            "completed": len(self.results),
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class TraceJobs:
+    """Bounded store of trace jobs run by a limited pool of workers."""
+
+    def __init__(self, run_trace,
+                 max_running=settings.TRACE_JOBS_MAX_RUNNING,
+                 max_stored=settings.TRACE_JOBS_MAX_STORED, scheduler=None):
+        self._run_trace = run_trace
+        self._scheduler = scheduler
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_running,
+            thread_name_prefix="sdntrace_cp_jobs"
+        )
+        self._jobs = OrderedDict()
+        self._lock = Lock()
+        self.max_stored = max_stored
+
+    def submit(self, entries, stored_flows, **trace_kwargs):
+        """Store a new job and schedule it to run.
+
+        trace_kwargs are passed to run_trace along with each entry."""
+        job = TraceJob(entries, stored_flows, trace_kwargs)
+        with self._lock:
+            self._evict()
+            if len(self._jobs) >= self.max_stored:
+                raise JobsLimitError(
+                    f"There are already {len(self._jobs)} unfinished jobs"
+                )
+            self._jobs[job.id] = job
+        job.future = self._executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        """Return a job given its id or None."""
+        return self._jobs.get(job_id)
+
+    def list(self):
+        """Return all stored jobs, oldest first."""
+        return list(self._jobs.values())
+
+    def cancel(self, job_id):
+        """Cancel a pending or running job."""
+        job = self._jobs.get(job_id)
+        if not job or job.finished:
+            return job
+        job.cancel_event.set()
+        if job.future and job.future.cancel():
+            self._finish(job, "cancelled")
+        return job
+
+    def shutdown(self):
+        """Cancel all jobs and stop the workers."""
+        for job in self.list():
+            job.cancel_event.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _evict(self):
+        """Drop the oldest finished jobs until there is room for one more."""
+        for job_id in list(self._jobs):
+            if len(self._jobs) < self.max_stored:
+                break
+            if self._jobs[job_id].finished:
+                del self._jobs[job_id]
+
+    def _run(self, job):
+        """Trace every entry of a job, checking for cancellation."""
+        if job.cancel_event.is_set():
+            self._finish(job, "cancelled")
+            return
+        job.status = "running"
+        job.started_at = str(datetime.now())
+        status = "done"
+        try:
+            with closing(self._slices(job.entries)) as slices:
+                for entry in chain.from_iterable(slices):
+                    if job.cancel_event.is_set():
+                        status = "cancelled"
+                        break
+                    job.results.append(self._run_trace(
+                        entry, job.stored_flows, **job.trace_kwargs
+                    ))
+        except ValueError as exc:
+            status = "failed"
+            job.error = str(exc)
+        # Any failure of a trace must finish the job instead of leaving it
+        # running forever
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            log.error("Trace job %s failed: %s", job.id, exc)
+            status = "failed"
+            job.error = str(exc)
+        self._finish(job, status)
+
+    def _slices(self, entries):
+        """Yield the slices of entries to trace, scheduled as bulk work
+        when there is a scheduler."""
+        if self._scheduler is None:
+            yield entries
+            return
+        yield from self._scheduler.slices(entries)
+
+    @staticmethod
+    def _finish(job, status):
+        """Set the final status and release what is no longer needed."""
+        job.status = status
+        job.finished_at = str(datetime.now())
+        job.entries = None
+        job.stored_flows = None
@@ -4,20 +4,60 @@ Run tracepaths on OpenFlow in the Control Plane
 """
 
 import pathlib
+from collections import deque
+from contextlib import closing
 from datetime import datetime
+from itertools import chain
+from time import monotonic
 
 import tenacity
 from kytos.core import KytosNApp, log, rest
-from kytos.core.helpers import load_spec, validate_openapi
+from kytos.core.events import KytosEvent
+from kytos.core.helpers import listen_to, load_spec, validate_openapi
 from kytos.core.rest_api import (HTTPException, JSONResponse, Request,
-                                 get_json_or_400)
-from napps.amlight.sdntrace_cp.utils import (convert_entries,
-                                             convert_list_entries,
-                                             find_endpoint, get_stored_flows,
+                                 content_type_json_or_415)
+from napps.amlight.sdntrace_cp import settings
+from napps.amlight.sdntrace_cp.actions import compile_program
+from napps.amlight.sdntrace_cp.admission import AdmissionControl
+from napps.amlight.sdntrace_cp.batching import TraceBatcher
+from napps.amlight.sdntrace_cp.breaker import CircuitBreaker, CircuitOpenError
+from napps.amlight.sdntrace_cp.groups import GroupTables
+from napps.amlight.sdntrace_cp.hsa import SymbolicTracer, parse_header_space
+from napps.amlight.sdntrace_cp.jobs import JobsLimitError, TraceJobs
+from napps.amlight.sdntrace_cp.scheduler import INTERACTIVE, TraceScheduler
+from napps.amlight.sdntrace_cp.snapshot import (FlowSnapshot, FlowSnapshots,
+                                                SnapshotBuilder)
+from napps.amlight.sdntrace_cp.sweep import (SWEEP, SweepOutcomes,
+                                             count_headers, expand_sweep,
+                                             sweep_class, sweep_size,
+                                             sweep_values)
+from napps.amlight.sdntrace_cp.utils import (TRACE_TIMINGS, TraceJSONResponse,
+                                             convert_entries, copy_args,
+                                             entry_key, find_endpoint,
+                                             get_query_choice, get_query_int,
+                                             get_response_format,
+                                             get_snapshot_query,
+                                             get_stored_flows,
+                                             get_trace_timing,
+                                             load_json_or_400,
                                              match_field_dl_vlan,
-                                             match_field_ip, prepare_json)
+                                             match_field_ip,
+                                             match_field_metadata,
+                                             output_ports,
+                                             prepare_compact_json,
+                                             prepare_json, set_trace_times)
+from napps.amlight.sdntrace_cp.validation import (compile_entries_validator,
+                                                  load_entries_schema)
+from napps.amlight.sdntrace_cp.watch import (WatchedTraces,
+                                             WatchedTracesLimitError,
+                                             WatchedTraceStream,
+                                             WatchedTraceStreamLimitError,
+                                             diff_results)
+from starlette.responses import StreamingResponse
 
 
+# Each REST endpoint and event handler of the NApp is a public method
+# pylint: disable=too-many-public-methods
 class Main(KytosNApp):
     """Main class of amlight/sdntrace_cp NApp.
 
@@ -26,6 +66,9 @@ class Main(KytosNApp):
     """
 
     spec = load_spec(pathlib.Path(__file__).parent / "openapi.yml")
+    validate_entries = staticmethod(compile_entries_validator(
+        load_entries_schema(pathlib.Path(__file__).parent / "openapi.yml")
+    ))
 
     def setup(self):
         """Replace the '__init__' method for the KytosNApp subclass.
@@ -35,6 +78,23 @@ class Main(KytosNApp):
 
         """
         log.info("Starting Kytos SDNTrace CP App!")
+        self.snapshots = FlowSnapshots()
+        # The lambda looks up get_stored_flows on each fetch, so it can be
+        # patched after setup
+        # pylint: disable=unnecessary-lambda
+        self.flow_source = CircuitBreaker(lambda: get_stored_flows())
+        self.snapshot_builder = SnapshotBuilder(self.snapshots,
+                                                self.flow_source)
+        self.group_tables = GroupTables()
+        self.admission = AdmissionControl()
+        self.scheduler = TraceScheduler()
+        self.jobs = TraceJobs(self.trace_entry, scheduler=self.scheduler)
+        self.batcher = TraceBatcher(self._trace_batch)
+        self.watched = WatchedTraces(
+            self.tracepath, self.do_match,
+            lambda result: prepare_json(result)['result']
+        )
+        self.watched_stream = WatchedTraceStream()
 
     def execute(self):
         """This method is executed right after the setup method execution.
@@ -44,86 +104,543 @@ class Main(KytosNApp):
 
             self.execute_as_loop(30)  # 30-second interval.
         """
+        self.snapshot_builder.start()
 
     def shutdown(self):
         """This method is executed when your napp is unloaded.
 
         If you have some cleanup procedure, insert it here.
         """
+        self.jobs.shutdown()
+        self.watched_stream.close()
+        self.snapshot_builder.shutdown()
 
     @rest('/v1/trace', methods=['PUT'])
     @validate_openapi(spec)
-    def trace(self, request: Request) -> JSONResponse:
-        """Trace a path."""
-        result = []
-        data = get_json_or_400(request, self.controller.loop)
+    def trace(self, request: Request) -> TraceJSONResponse:
+        """Trace a path.
+
+        Concurrent requests for the same snapshot query parameters and
+        timing are traced in batches, see TraceBatcher."""
+        response_format = get_response_format(request)
+        timing = get_trace_timing(request)
+        data = load_json_or_400(request, self.controller.loop)
+        entries = convert_entries(data)
+        if not entries:
+            raise HTTPException(400, "Empty entries")
+        version, max_staleness = get_snapshot_query(request)
+        with self.admission.admit():
+            stored_flows, result = self.batcher.submit(
+                (version, max_staleness, timing), entries
+            )
+        if response_format == 'compact':
+            response = prepare_compact_json([result])
+        else:
+            response = prepare_json(result)
+        response.update(self._snapshot_info(stored_flows))
+        return TraceJSONResponse(response)
+
+    def _trace_entries(self, entries, stored_flows, timing):
+        """Trace the entries of a bulk request in bulk slices.
+
+        Return the results and the results of the distinct entries by
+        key."""
+        results = []
+        distinct = {}
+        with closing(self.scheduler.slices(entries)) as slices:
+            for entry in chain.from_iterable(slices):
+                key = entry_key(entry)
+                result = distinct.get(key)
+                if result is None:
+                    try:
+                        result = self.trace_entry(entry, stored_flows, timing)
+                    except ValueError as exc:
+                        raise HTTPException(409, str(exc)) from exc
+                    distinct[key] = result
+                results.append(result)
+        return results, distinct
+
+    def _trace_batch(self, batch_key, entries):
+        """Trace a batch of single trace entries against one snapshot.
+
+        Return the (snapshot, result) pair of each entry, or the 409 error
+        of its trace. Identical entries are traced once."""
+        version, max_staleness, timing = batch_key
+        stored_flows = self._snapshot(version, max_staleness)
+        results = {}
+        batch = []
+        with self.scheduler.slot(INTERACTIVE):
+            for entry in entries:
+                key = entry_key(entry)
+                if key not in results:
+                    try:
+                        results[key] = (
+                            stored_flows,
+                            self.tracepath(entry, stored_flows, timing)
+                        )
+                    except ValueError as exc:
+                        results[key] = HTTPException(409, str(exc))
+                batch.append(results[key])
+        return batch
+
+    @rest('/v1/traces', methods=['PUT'])
+    def get_traces(self, request: Request) -> TraceJSONResponse:
+        """For bulk requests.
+
+        The entries are validated by validate_entries instead of
+        @validate_openapi, which is much faster for large batches. Entries
+        with swept fields get a sweep result, see trace_sweep. Identical
+        entries are traced once and share their result."""
+        response_format = get_response_format(request)
+        timing = get_trace_timing(request)
+        entries = self._load_entries(request)
+        with self.admission.admit(count_headers(entries)):
+            stored_flows = self._get_snapshot(request)
+            results, distinct = self._trace_entries(entries, stored_flows,
+                                                    timing)
+        if response_format == 'compact':
+            response = prepare_compact_json(results)
+        else:
+            response = prepare_json(results)
+        response.update(self._snapshot_info(stored_flows))
+        response['dedup'] = {'entries': len(entries),
+                             'distinct': len(distinct)}
+        return TraceJSONResponse(response)
+
+    @rest('/v1/trace/symbolic', methods=['PUT'])
+    @validate_openapi(spec)
+    def symbolic_trace(self, request: Request) -> TraceJSONResponse:
+        """Trace a header space, returning the tree of paths it takes."""
+        data = load_json_or_400(request, self.controller.loop)
         entries = convert_entries(data)
         if not entries:
             raise HTTPException(400, "Empty entries")
         try:
-            stored_flows = get_stored_flows()
-        except tenacity.RetryError as exc:
-            raise HTTPException(424, "It couldn't get stored_flows") from exc
+            header_space = parse_header_space(entries)
+        except (AttributeError, TypeError, ValueError) as exc:
+            raise HTTPException(400, f"Invalid header space: {exc}") from exc
+        with self.admission.admit():
+            stored_flows = self._get_snapshot(request)
+            tracer = SymbolicTracer(self.controller.get_switch_by_dpid,
+                                    stored_flows)
+            try:
+                result = tracer.trace(entries['dpid'], entries['in_port'],
+                                      header_space)
+            except ValueError as exc:
+                raise HTTPException(409, str(exc)) from exc
+        return TraceJSONResponse({'result': result,
+                                  **self._snapshot_info(stored_flows)})
+
+    @rest('/v1/trace/reverse', methods=['PUT'])
+    @validate_openapi(spec)
+    def reverse_trace(self, request: Request) -> TraceJSONResponse:
+        """Find the ingress ports and headers that reach an egress port."""
+        data = load_json_or_400(request, self.controller.loop)
+        egress = data['egress']
+        with self.admission.admit():
+            stored_flows = self._get_snapshot(request)
+            tracer = SymbolicTracer(self.controller.get_switch_by_dpid,
+                                    stored_flows)
+            try:
+                result = tracer.reverse(egress['dpid'], egress['port'])
+            except ValueError as exc:
+                raise HTTPException(409, str(exc)) from exc
+        return TraceJSONResponse({'egress': egress, 'result': result,
+                                  **self._snapshot_info(stored_flows)})
+
+    @rest('/v1/traces/jobs', methods=['POST'])
+    def create_trace_job(self, request: Request) -> JSONResponse:
+        """Submit a bulk trace job to run in background."""
+        timing = get_query_choice(request, 'timing', TRACE_TIMINGS)
+        entries = self._load_entries(request)
+        size = count_headers(entries)
+        self.admission.acquire(size)
+        job = None
+        try:
+            stored_flows = self._get_snapshot(request)
+            job = self.jobs.submit(entries, stored_flows, timing=timing)
+        except JobsLimitError as exc:
+            raise HTTPException(429, str(exc)) from exc
+        finally:
+            # The job holds its admission until it's done
+            if job is None:
+                self.admission.release(size)
+        job.future.add_done_callback(
+            lambda _future: self.admission.release(size)
+        )
+        staleness = self.snapshot_builder.staleness(stored_flows)
+        return JSONResponse({**job.as_dict(), 'staleness': staleness},
+                            status_code=202)
+
+    @rest('/v1/traces/jobs', methods=['GET'])
+    def list_trace_jobs(self, _request: Request) -> JSONResponse:
+        """List the stored bulk trace jobs."""
+        return JSONResponse({
+            "jobs": [job.as_dict() for job in self.jobs.list()]
+        })
+
+    @rest('/v1/traces/jobs/{job_id}', methods=['GET'])
+    def get_trace_job(self, request: Request) -> JSONResponse:
+        """Get the status and progress of a bulk trace job."""
+        job = self._get_job_or_404(request.path_params["job_id"])
+        return JSONResponse(job.as_dict())
+
+    @rest('/v1/traces/jobs/{job_id}/results', methods=['GET'])
+    def get_trace_job_results(self, request: Request) -> TraceJSONResponse:
+        """Get a page of the results of a bulk trace job."""
+        job = self._get_job_or_404(request.path_params["job_id"])
+        offset = get_query_int(request, "offset", 0)
+        limit = get_query_int(request, "limit",
+                              settings.TRACE_JOBS_PAGE_LIMIT,
+                              settings.TRACE_JOBS_MAX_PAGE_LIMIT)
+        if get_response_format(request) == 'compact':
+            response = prepare_compact_json(job.page(offset, limit))
+        else:
+            response = prepare_json(job.page(offset, limit))
+        response.update({
+            "offset": offset,
+            "limit": limit,
+            "completed": len(job.results),
+            "status": job.status,
+        })
+        return TraceJSONResponse(response)
+
+    @rest('/v1/traces/jobs/{job_id}', methods=['DELETE'])
+    def cancel_trace_job(self, request: Request) -> JSONResponse:
+        """Cancel a pending or running bulk trace job."""
+        job = self.jobs.cancel(request.path_params["job_id"])
+        if not job:
+            raise HTTPException(404, "Job not found")
+        return JSONResponse(job.as_dict())
+
+    @rest('/v1/watched_traces', methods=['POST'])
+    @validate_openapi(spec)
+    def create_watched_trace(self, request: Request) -> JSONResponse:
+        """Trace a path and trace it again whenever it may change."""
+        data = load_json_or_400(request, self.controller.loop)
+        entries = convert_entries(data)
+        if not entries:
+            raise HTTPException(400, "Empty entries")
+        with self.admission.admit():
+            stored_flows = self._get_snapshot(request)
+            try:
+                watched = self.watched.add(entries, stored_flows)
+            except ValueError as exc:
+                raise HTTPException(409, str(exc)) from exc
+            except WatchedTracesLimitError as exc:
+                raise HTTPException(429, str(exc)) from exc
+        return JSONResponse(watched.as_dict(), status_code=201)
+
+    @rest('/v1/watched_traces', methods=['GET'])
+    def list_watched_traces(self, _request: Request) -> JSONResponse:
+        """List the watched traces."""
+        return JSONResponse({
+            "watched_traces": [watched.as_dict()
+                               for watched in self.watched.list()]
+        })
+
+    @rest('/v1/watched_traces/{watch_id}', methods=['GET'])
+    def get_watched_trace(self, request: Request) -> JSONResponse:
+        """Get a watched trace with its last result."""
+        watched = self.watched.get(request.path_params["watch_id"])
+        if not watched:
+            raise HTTPException(404, "Watched trace not found")
+        return JSONResponse(watched.as_dict())
+
+    @rest('/v1/watched_traces/{watch_id}', methods=['DELETE'])
+    def delete_watched_trace(self, request: Request) -> JSONResponse:
+        """Stop watching a trace."""
+        watched = self.watched.remove(request.path_params["watch_id"])
+        if not watched:
+            raise HTTPException(404, "Watched trace not found")
+        return JSONResponse(watched.as_dict())
+
+    @rest('/v1/stream/watched_traces', methods=['GET'])
+    async def stream_watched_traces(self,
+                                    _request: Request) -> StreamingResponse:
+        """Stream the changes of watched traces as Server-Sent Events.
+
+        The stream starts with a 'snapshot' event with all watched traces,
+        followed by a 'changed' event with the new result and a diff every
+        time a watched trace changes. It runs in the event loop, so
+        subscribers don't hold worker threads."""
+        snapshot = {"watched_traces": [watched.as_dict()
+                                       for watched in self.watched.list()]}
         try:
-            result = self.tracepath(entries, stored_flows)
+            messages = self.watched_stream.subscribe([("snapshot", snapshot)])
+        except WatchedTraceStreamLimitError as exc:
+            raise HTTPException(429, str(exc)) from exc
+        return StreamingResponse(
+            messages,
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
+
+    @listen_to('kytos/flow_manager.flow.added',
+               'kytos/flow_manager.flow.removed')
+    def on_flow_changed(self, event):
+        """Trace again the watched traces affected by a flow."""
+        self.handle_flow_changed(event)
+
+    def handle_flow_changed(self, event):
+        """Apply a flow added or removed to the latest flow snapshot and
+        trace again the watched traces affected by it."""
+        dpid = event.content['datapath'].dpid
+        flow = event.content['flow']
+        flow_dict = flow.as_dict()
+        removed = event.name.endswith('.removed')
+        self.snapshot_builder.apply(
+            dpid, {'flow': flow_dict, 'flow_id': flow.id}, removed
+        )
+        watch_ids = self.watched.affected_by_flow(dpid, flow_dict, flow.id,
+                                                  removed=removed)
+        self.rerun_watched_traces(watch_ids)
+
+    @listen_to('kytos/topology.link_up', 'kytos/topology.link_down')
+    def on_link_changed(self, event):
+        """Trace again the watched traces going through a link."""
+        self.handle_link_changed(event)
+
+    def handle_link_changed(self, event):
+        """Trace again the watched traces going through a link."""
+        link = event.content['link']
+        watch_ids = self.watched.affected_by_ports(
+            (endpoint.switch.dpid, endpoint.port_number)
+            for endpoint in (link.endpoint_a, link.endpoint_b)
+        )
+        self.rerun_watched_traces(watch_ids)
+
+    def rerun_watched_traces(self, watch_ids):
+        """Trace watched traces again and notify the ones that changed."""
+        if not watch_ids:
+            return
+        try:
+            stored_flows = self.snapshot_builder.latest()
+        except (tenacity.RetryError, CircuitOpenError):
+            log.error("It couldn't get stored_flows to trace watched "
+                      "traces %s again", watch_ids)
+            return
+        try:
+            changed = self.watched.rerun(watch_ids, stored_flows)
         except ValueError as exc:
-            raise HTTPException(409, str(exc)) from exc
-        return JSONResponse(prepare_json(result))
+            log.error("Failed to trace watched traces again: %s", exc)
+            return
+        for watched, previous in changed:
+            event = KytosEvent(
+                name='amlight/sdntrace_cp.watched_trace.changed',
+                content={
+                    'id': watched.id,
+                    'result': watched.result,
+                    'previous': previous,
+                }
+            )
+            self.controller.buffers.app.put(event)
+            self.watched_stream.publish("changed", {
+                'id': watched.id,
+                'result': watched.result,
+                'diff': diff_results(previous, watched.result),
+            })
 
-    @rest('/v1/traces', methods=['PUT'])
+    @rest('/v1/snapshots', methods=['GET'])
+    def list_snapshots(self, _request: Request) -> JSONResponse:
+        """List the flow snapshots that traces can be pinned to."""
+        return JSONResponse({
+            "snapshots": [snapshot.as_dict()
+                          for snapshot in self.snapshots.list()]
+        })
+
+    @rest('/v1/groups/{dpid}', methods=['PUT'])
     @validate_openapi(spec)
-    def get_traces(self, request: Request) -> JSONResponse:
-        """For bulk requests."""
-        data = get_json_or_400(request, self.controller.loop)
-        entries = convert_list_entries(data)
-        results = []
+    def put_groups(self, request: Request) -> JSONResponse:
+        """Replace the group tables of a switch used to trace group
+        actions."""
+        dpid = request.path_params["dpid"]
+        body = load_json_or_400(request, self.controller.loop)
         try:
-            stored_flows = get_stored_flows()
-        except tenacity.RetryError as exc:
+            self.group_tables.set(dpid, body["groups"])
+        except (KeyError, TypeError, ValueError) as exc:
+            raise HTTPException(400, f"Invalid groups: {exc}") from exc
+        return JSONResponse({"groups": self.group_tables.list().get(dpid,
+                                                                    [])})
+
+    @rest('/v1/groups', methods=['GET'])
+    def list_groups(self, _request: Request) -> JSONResponse:
+        """List the group tables of the switches, by dpid."""
+        return JSONResponse({"groups": self.group_tables.list()})
+
+    @rest('/v1/stats', methods=['GET'])
+    def get_stats(self, _request: Request) -> JSONResponse:
+        """Return the latest flow snapshot and snapshot rebuild metrics."""
+        latest = self.snapshots.latest
+        return JSONResponse({
+            "snapshot": latest.as_dict() if latest else None,
+            "snapshot_builder": self.snapshot_builder.stats(),
+            "pipeline_cache": latest.cache_stats() if latest else None,
+            "trace_batching": self.batcher.stats(),
+            "scheduler": self.scheduler.stats(),
+            "admission": self.admission.stats(),
+            "flow_source": self.flow_source.stats(),
+        })
+
+    def _get_snapshot(self, request):
+        """Return the flow snapshot pinned by the 'snapshot' query
+        parameter, or the latest snapshot.
+
+        The latest snapshot is read without locking while the builder is
+        tracking the stored flows and no flow change is pending, otherwise
+        the stored flows are fetched now. If they can't be fetched, the
+        latest snapshot is still used if it isn't older than the
+        'max_staleness' query parameter, in seconds."""
+        return self._snapshot(*get_snapshot_query(request))
+
+    def _snapshot(self, version=None,
+                  max_staleness=settings.FLOW_SNAPSHOT_MAX_STALENESS):
+        """Return the flow snapshot of a version, or the latest one, for a
+        trace."""
+        if version is not None:
+            snapshot = self.snapshots.get(version)
+            if not snapshot:
+                raise HTTPException(404, f"Snapshot {version} not found")
+            return snapshot
+        try:
+            return self.snapshots.use(
+                self.snapshot_builder.latest(max_staleness)
+            )
+        except (tenacity.RetryError, CircuitOpenError) as exc:
             raise HTTPException(424, "It couldn't get stored_flows") from exc
+
+    def _snapshot_info(self, stored_flows):
+        """Return the version and the staleness of the snapshot used by a
+        response."""
+        return {'snapshot': stored_flows.version,
+                'staleness': self.snapshot_builder.staleness(stored_flows)}
+
+    def _load_entries(self, request):
+        """Load, validate and convert the list of trace entries of a
+        request."""
+        content_type_json_or_415(request)
+        data = load_json_or_400(request, self.controller.loop)
+        entries = self.validate_entries(data)
         for entry in entries:
-            try:
-                results.append(self.tracepath(entry, stored_flows))
-            except ValueError as exc:
-                raise HTTPException(409, str(exc)) from exc
-        return JSONResponse(prepare_json(results))
+            if SWEEP not in entry:
+                continue
+            size = sweep_size(entry)
+            if not 0 < size <= settings.TRACE_SWEEP_MAX_HEADERS:
+                raise HTTPException(
+                    400, f"Swept entries must have between 1 and "
+                         f"{settings.TRACE_SWEEP_MAX_HEADERS} headers, not "
+                         f"{size}"
+                )
+        return entries
+
+    def _get_job_or_404(self, job_id):
+        """Return a stored job or raise a 404 error."""
+        job = self.jobs.get(job_id)
+        if not job:
+            raise HTTPException(404, "Job not found")
+        return job
+
+    def tracepath(self, entries, stored_flows, timing='trace', trail=None):
+        """Trace a path for a packet represented by entries.
+
+        timing is one of TRACE_TIMINGS. Times are only formatted once the
+        trace is done, see set_trace_times. If trail is a list, the tables
+        looked up are appended to it, see process_tables. When copies of
+        the packet are sent to several ports, the last step of the path
+        gets the branches traced from each port, see trace_branches.
+        Branches are traced breadth first."""
+        started = (datetime.now(), monotonic())
+        queue = deque()
+        expanded = set()
+        trace_result = self.trace_path(entries, stored_flows, timing, trail,
+                                       queue=queue, expanded=expanded)
+        while queue:
+            branch, entries, visited = queue.popleft()
+            branch['result'] = self.trace_path(
+                entries, stored_flows, timing, trail, prefix=visited,
+                trace_type='intermediary', queue=queue, expanded=expanded
+            )
+        if len(trace_result) == 1 and \
+                trace_result[0]['in']['type'] == 'starting' and \
+                'branches' not in trace_result[0]:
+            trace_result[0]['in']['type'] = 'last'
+        set_trace_times(trace_result, started, timing)
+        return trace_result
 
-    def tracepath(self, entries, stored_flows):
-        """Trace a path for a packet represented by entries."""
+    def trace_entry(self, entries, stored_flows, timing='trace'):
+        """Trace an entry, with trace_sweep if it has swept fields."""
+        if SWEEP in entries:
+            return self.trace_sweep(entries, stored_flows, timing)
+        return self.tracepath(entries, stored_flows, timing)
+
+    def trace_sweep(self, entries, stored_flows, timing='trace'):
+        """Trace the headers of an entry with swept fields.
+
+        Headers with the same switch, port and class of the equivalence
+        classes of all switches are matched by the same flows all along,
+        so they share the outcome of the first ones traced. The headers
+        are grouped by the outcome of their traces, see SweepOutcomes."""
+        fields, headers = expand_sweep(entries)
+        classes = stored_flows.classes() \
+            if isinstance(stored_flows, FlowSnapshot) else None
+        sweep = SweepOutcomes(
+            fields, sweep_values(entries[SWEEP].get('dl_vlan', ()))
+        )
+        for values, header in headers:
+            key = sweep_class(classes, header)
+            outcome = sweep.class_outcome(key)
+            if outcome is None:
+                outcome = sweep.add_trace(
+                    values, self.tracepath(header, stored_flows, timing), key
+                )
+            sweep.add_header(values, outcome)
+        return sweep.as_dict()
+
+    # pylint: disable=too-many-arguments
+    def trace_path(self, entries, stored_flows, timing, trail, *, prefix=(),
+                   trace_type='starting', queue=None, expanded=None):
+        """Trace the steps of a packet after the steps in prefix.
+
+        The branches of the last step are appended to queue to be traced,
+        see trace_branches. The states of the steps of a branch are added to
+        expanded."""
         # pylint: disable=too-many-branches
         trace_result = []
-        trace_type = 'starting'
         do_trace = True
         while do_trace:
             if 'dpid' not in entries or 'in_port' not in entries:
                 break
+            if prefix:
+                expanded.add(self.trace_state(entries))
             trace_step = {'in': {'dpid': entries['dpid'],
                                  'port': entries['in_port'],
-                                 'time': str(datetime.now()),
                                  'type': trace_type}}
+            if timing == 'step':
+                trace_step['in']['time'] = monotonic()
             if 'dl_vlan' in entries:
-                trace_step['in'].update({'vlan': entries['dl_vlan'][-1]})
+                trace_step['in']['vlan'] = entries['dl_vlan'][-1]
 
             switch = self.controller.get_switch_by_dpid(entries['dpid'])
             if not switch:
                 trace_step['in']['type'] = 'last'
                 trace_result.append(trace_step)
                 break
-            result = self.trace_step(switch, entries, stored_flows)
+            visited = [*prefix, *trace_result] if prefix else trace_result
+            result = self.trace_step(switch, entries, stored_flows, trail)
+            if result and 'branches' in result:
+                trace_step['branches'] = self.trace_branches(
+                    trace_step, result['branches'], visited, queue, expanded
+                )
+                trace_result.append(trace_step)
+                break
             if result:
-                out = {'port': result['out_port']}
-                if 'dl_vlan' in result['entries']:
-                    out.update({'vlan': result['entries']['dl_vlan'][-1]})
-                trace_step.update({
-                    'out': out
-                })
+                trace_step['out'] = self.step_out(result)
                 if 'dpid' in result:
-                    next_step = {'dpid': result['dpid'],
-                                 'port': result['in_port']}
                     entries = result['entries']
                     entries['dpid'] = result['dpid']
                     entries['in_port'] = result['in_port']
-                    if self.has_loop(next_step, trace_result):
+                    if self.has_loop({'dpid': result['dpid'],
+                                      'port': result['in_port']}, visited):
                         trace_step['in']['type'] = 'loop'
                         do_trace = False
                     else:
@@ -135,14 +652,69 @@ class Main(KytosNApp):
                 # No match
                 break
             if 'out' in trace_step and trace_step['out']:
-                if self.check_loop_trace_step(trace_step, trace_result):
+                if self.check_loop_trace_step(trace_step, visited):
                     do_trace = False
             trace_result.append(trace_step)
-        if len(trace_result) == 1 and \
-                trace_result[0]['in']['type'] == 'starting':
-            trace_result[0]['in']['type'] = 'last'
         return trace_result
 
+    # pylint: disable=too-many-arguments
+    def trace_branches(self, trace_step, results, visited, queue, expanded):
+        """Return the branches of the copies of a packet sent from a step.
+
+        Each branch has the groups and buckets the copy went through, if
+        any, its 'out' and its 'type': 'next' if the copy goes to another
+        switch, 'last' if it leaves the network, 'loop' or 'visited' if the
+        copy reaches a switch and port with the same packet fields as a
+        branch already traced. The steps of a 'next' branch are set in its
+        'result' once traced: the branch, packet fields and steps before it
+        are appended to queue. Branches share the steps before them."""
+        visited = [*visited, trace_step]
+        first = visited[0]['in']
+        branches = []
+        for result in results:
+            out = self.step_out(result)
+            branch = {'groups': result['groups'], 'out': out,
+                      'type': 'last', 'result': []}
+            branches.append(branch)
+            if first['dpid'] == trace_step['in']['dpid'] and \
+                    first['port'] == out['port']:
+                branch['type'] = 'loop'
+                continue
+            if 'dpid' not in result:
+                continue
+            next_step = {'dpid': result['dpid'], 'port': result['in_port']}
+            if self.has_loop(next_step, visited):
+                branch['type'] = 'loop'
+                continue
+            entries = result['entries']
+            entries['dpid'] = result['dpid']
+            entries['in_port'] = result['in_port']
+            state = self.trace_state(entries)
+            if state in expanded:
+                branch['type'] = 'visited'
+                continue
+            expanded.add(state)
+            branch['type'] = 'next'
+            queue.append((branch, entries, visited))
+        return branches
+
+    @staticmethod
+    def step_out(result):
+        """Return the 'out' of a step from the result of trace_step."""
+        out = {'port': result['out_port']}
+        if 'dl_vlan' in result['entries']:
+            out['vlan'] = result['entries']['dl_vlan'][-1]
+        return out
+
+    @staticmethod
+    def trace_state(entries):
+        """Return the switch, port and packet fields of a step as a
+        hashable state."""
+        return tuple(sorted(
+            (name, tuple(value) if isinstance(value, list) else value)
+            for name, value in entries.items()
+        ))
+
     @staticmethod
     def check_loop_trace_step(trace_step, trace_result):
         """Check if there is a loop in the trace and add the step."""
@@ -168,19 +740,55 @@ class Main(KytosNApp):
                 return True
         return False
 
-    def trace_step(self, switch, entries, stored_flows):
+    def trace_step(self, switch, entries, stored_flows, trail=None):
         """Perform a trace step.
 
         Match the given fields against the switch's list of flows."""
+        in_port = entries.get('in_port')
+        branches = []
         flow, entries, port = self.match_and_apply(
                                                     switch,
                                                     entries,
-                                                    stored_flows
+                                                    stored_flows,
+                                                    trail,
+                                                    branches
                                                 )
 
-        if not flow or not port:
+        if not flow:
             return None
+        if not branches:
+            if not port:
+                return None
+            branches = [(entries, port, [])]
+        outputs = self.branch_outputs(switch, branches, in_port)
+        if len(outputs) == 1 and not outputs[0][2]:
+            return self.next_hop(switch, outputs[0][0], outputs[0][1])
+
+        results = []
+        for entries_, port_, groups in outputs:
+            result = self.next_hop(switch, entries_, port_)
+            if result:
+                result['groups'] = groups
+                results.append(result)
+        return {'branches': results} if results else None
 
+    @staticmethod
+    def branch_outputs(switch, branches, in_port):
+        """Return the (packet fields, port, groups) of the copies of a
+        packet sent to the output ports of each branch, with reserved ports
+        like FLOOD expanded, see output_ports."""
+        outputs = []
+        for entries, port, groups in branches:
+            ports = output_ports(switch, port, in_port)
+            for port_no in ports:
+                outputs.append((copy_args(entries) if len(ports) > 1
+                                else entries, port_no, groups))
+        return outputs
+
+    @staticmethod
+    def next_hop(switch, entries, port):
+        """Return where a packet sent to a port of a switch goes, as in the
+        result of trace_step, or None if the port isn't found."""
         endpoint = find_endpoint(switch, port)
         if endpoint is None:
             log.warning(f"Port {port} not found on switch {switch}")
@@ -212,6 +820,10 @@ class Main(KytosNApp):
                 if not match_field_dl_vlan(field, field_flow):
                     return False
                 continue
+            if name == 'metadata':
+                if not match_field_metadata(field or 0, field_flow):
+                    return False
+                continue
             # In the case of dl_vlan field, the match must be checked
             # even if this field is not in the packet args.
             if not field:
@@ -238,8 +850,12 @@ class Main(KytosNApp):
         if switch.dpid not in stored_flows:
             return None
         response = []
-        if switch.dpid not in stored_flows:
-            return None
+        if not many and isinstance(stored_flows, FlowSnapshot):
+            try:
+                return stored_flows.match(switch.dpid, table_id, args,
+                                          Main.do_match)
+            except AttributeError:
+                return None
         try:
             for flow in stored_flows[switch.dpid]:
                 match = Main.do_match(flow, args, table_id)
@@ -255,61 +871,125 @@ class Main(KytosNApp):
             return None
         return response
 
-    def process_tables(self, switch, table_id, args, stored_flows, actions):
-        """Resolve the table context and get actions in the matched flow"""
-        goto_table = False
-        actions_ = []
+    def match_program(self, switch, table_id, args, stored_flows):
+        """Match the packet against a table and return the flow matched and
+        its ActionProgram, or (None, None).
+
+        Flow snapshots keep the programs compiled with their tables, other
+        stored flows are compiled when matched."""
+        if isinstance(stored_flows, FlowSnapshot):
+            if switch.dpid not in stored_flows:
+                return None, None
+            try:
+                return stored_flows.lookup(switch.dpid, table_id, args,
+                                           Main.do_match)
+            except AttributeError:
+                return None, None
         flow = self.match_flows(switch, table_id, args, stored_flows, False)
-        if flow and 'actions' in flow['flow']:
-            actions_ = flow['flow']['actions']
-        elif flow and 'instructions' in flow['flow']:
-            for instruction in flow['flow']['instructions']:
-                if instruction['instruction_type'] == 'apply_actions':
-                    actions_ = instruction['actions']
-                elif instruction['instruction_type'] == 'goto_table':
-                    table_id_ = instruction['table_id']
-                    if table_id < table_id_:
-                        table_id = table_id_
-                        goto_table = True
-                    else:
-                        msg = f"Wrong table_id in {flow['flow']}: \
-                            The packet can only been directed to a \
-                                flow table number greather than {table_id}"
-                        raise ValueError(msg) from ValueError
-        actions.extend(actions_)
-        return flow, actions, goto_table, table_id
-
-    def match_and_apply(self, switch, args, stored_flows):
+        return flow, compile_program(flow) if flow else None
+
+    def process_tables(self, switch, table_id, args, stored_flows, programs,
+                       *, trail=None):
+        """Resolve the table context and get the ActionProgram of the
+        matched flow
+
+        The metadata written by the flow is set in the packet fields for
+        the next tables. If trail is a list, (dpid, table_id, packet fields,
+        matched flow) is appended to it."""
+        goto_table = False
+        flow, program = self.match_program(switch, table_id, args,
+                                           stored_flows)
+        if trail is not None:
+            trail.append((switch.dpid, table_id, copy_args(args), flow))
+        if not flow:
+            return flow, programs, goto_table, table_id
+        if program is None:
+            # Raises the error of a malformed flow
+            program = compile_program(flow)
+        for table_id_ in program.gotos:
+            if table_id < table_id_:
+                table_id = table_id_
+                goto_table = True
+            else:
+                msg = f"Wrong table_id in {flow.get('flow')}: \
+                    The packet can only been directed to a \
+                        flow table number greather than {table_id}"
+                raise ValueError(msg) from ValueError
+        programs.append(program)
+        if program.metadata is not None:
+            program.write_metadata(args)
+        return flow, programs, goto_table, table_id
+
+    def match_pipeline(self, switch, args, stored_flows, trail=None):
+        """Match a packet through the tables of a switch and return the
+        flow matched last and the ActionPrograms of the pipeline.
+
+        With a flow snapshot and no trail, the results are cached by packet
+        class, see PipelineCache."""
+        cache = key = cached = None
+        if trail is None and isinstance(stored_flows, FlowSnapshot):
+            cache = stored_flows.pipeline_cache(switch.dpid)
+            key = cache.key(args)
+            cached = cache.get(key)
+        if cached:
+            return cached[0], cached[1]
+        table_id = 0
+        goto_table = True
+        programs = []
+        table_ids = []
+        while goto_table:
+            table_ids.append(table_id)
+            flow, programs, goto_table, table_id = self.process_tables(
+                switch, table_id, args, stored_flows, programs, trail=trail)
+        # Metadata is only kept through the pipeline of a switch
+        args.pop('metadata', None)
+        if cache is not None:
+            cache.put(key, (flow, tuple(programs), tuple(table_ids)))
+        return flow, programs
+
+    # pylint: disable=too-many-arguments
+    def match_and_apply(self, switch, args, stored_flows, trail=None,
+                        branches=None):
         """Match flows and apply actions.
         Match given packet (in args) against
         the stored flows (from flow_manager) and,
-        if a match flow is found, apply its actions."""
-        table_id = 0
-        goto_table = True
+        if a match flow is found, apply its actions.
+
+        The pipeline of the switch is matched by match_pipeline.
+
+        A group action takes precedence over output actions, as in an action
+        set. If the group sends copies of the packet to more than one port,
+        or there are several output actions, and branches is a list, the
+        (packet fields, port, groups) of each copy are appended to it, see
+        GroupTables.outputs, and the port returned is None. The copy of each
+        output action has the VLAN operations before it applied."""
         port = None
-        actions = []
-        while goto_table:
-            try:
-                flow, actions, goto_table, table_id = self.process_tables(
-                    switch, table_id, args, stored_flows, actions)
-            except ValueError as exception:
-                raise exception
+        flow, programs = self.match_pipeline(switch, args, stored_flows,
+                                             trail)
         if not flow or switch.ofp_version != '0x04':
             return flow, args, port
 
-        for action in actions:
-            action_type = action['action_type']
-            if action_type == 'output':
-                port = action['port']
-            if action_type == 'push_vlan':
-                if 'dl_vlan' not in args:
-                    args['dl_vlan'] = []
-                args['dl_vlan'].append(0)
-            if action_type == 'pop_vlan':
-                if 'dl_vlan' in args:
-                    args['dl_vlan'].pop()
-                    if len(args['dl_vlan']) == 0:
-                        del args['dl_vlan']
-            if action_type == 'set_vlan':
-                args['dl_vlan'][-1] = action['vlan_id']
-        return flow, args, port
+        group = None
+        outputs = 0
+        for program in programs:
+            if program.has_output:
+                port = program.output
+                outputs += len(program.outputs)
+            if program.group is not None:
+                group = program.group
+        if group is None and outputs > 1 and branches is not None:
+            copies = []
+            for program in programs:
+                program.run(args, copies)
+            branches.extend((entries, port, []) for entries, port in copies)
+            return flow, args, None
+        for program in programs:
+            program.run(args)
+        if group is None:
+            return flow, args, port
+        outputs = self.group_tables.outputs(switch, group, args)
+        if len(outputs) == 1:
+            return flow, outputs[0][0], outputs[0][1]
+        if branches is not None:
+            branches.extend(outputs)
+        return flow, args, None
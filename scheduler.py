@@ -0,0 +1,91 @@
+"""Priority scheduling of interactive and bulk traces.
+
+Interactive traces, like PUT /v1/trace, and bulk traces, like PUT /v1/traces
+and trace jobs, share a pool of workers. Bulk traces only take up to their
+own budget of it, so the rest of the workers are always left to interactive
+traces. Bulk traces run in slices of entries, and a slice only starts when
+no interactive trace is waiting and the pool isn't full, so a large batch
+yields to interactive traces between its slices.
+"""
+from contextlib import contextmanager
+from threading import Condition
+
+from napps.amlight.sdntrace_cp import settings
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+
+class TraceScheduler:
+    """Worker budgets and queues of interactive and bulk traces.
+
+    Interactive traces can use all of the workers, bulk traces up to
+    bulk_workers of them, which must be fewer than workers."""
+
+    def __init__(self, workers=settings.TRACE_WORKERS,
+                 bulk_workers=settings.TRACE_BULK_WORKERS,
+                 bulk_slice=settings.TRACE_BULK_SLICE):
+        if not 0 < bulk_workers < workers:
+            raise ValueError(f"bulk_workers must be between 1 and "
+                             f"{workers - 1}, got {bulk_workers}")
+        self.workers = {INTERACTIVE: workers, BULK: bulk_workers}
+        self.bulk_slice = bulk_slice
+        self.running = {INTERACTIVE: 0, BULK: 0}
+        self.waiting = {INTERACTIVE: 0, BULK: 0}
+        self.max_waiting = {INTERACTIVE: 0, BULK: 0}
+        self.completed = {INTERACTIVE: 0, BULK: 0}
+        self._condition = Condition()
+
+    def _can_run(self, kind):
+        """Whether work of a kind can start now."""
+        if sum(self.running.values()) >= self.workers[INTERACTIVE]:
+            return False
+        if kind == INTERACTIVE:
+            return True
+        return (self.running[BULK] < self.workers[BULK]
+                and not self.waiting[INTERACTIVE])
+
+    @contextmanager
+    def slot(self, kind):
+        """Wait for a worker of a kind and hold it while in the context."""
+        with self._condition:
+            self.waiting[kind] += 1
+            self.max_waiting[kind] = max(self.max_waiting[kind],
+                                         self.waiting[kind])
+            try:
+                self._condition.wait_for(lambda: self._can_run(kind))
+            finally:
+                self.waiting[kind] -= 1
+                if kind == INTERACTIVE:
+                    self._condition.notify_all()
+            self.running[kind] += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.running[kind] -= 1
+                self.completed[kind] += 1
+                self._condition.notify_all()
+
+    def slices(self, entries):
+        """Yield the entries of a bulk trace in slices, each one holding a
+        bulk worker until the next one is requested.
+
+        Close the iterator when stopping early, to release the worker."""
+        for start in range(0, len(entries), self.bulk_slice):
+            with self.slot(BULK):
+                yield entries[start:start + self.bulk_slice]
+
+    def stats(self):
+        """Return the worker budgets and queue depths as a dict."""
+        with self._condition:
+            return {
+                kind: {
+                    "workers": self.workers[kind],
+                    "running": self.running[kind],
+                    "waiting": self.waiting[kind],
+                    "max_waiting": self.max_waiting[kind],
+                    "completed": self.completed[kind],
+                }
+                for kind in (INTERACTIVE, BULK)
+            }
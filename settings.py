@@ -5,3 +5,77 @@
 SDNTRACE_URL = 'http://localhost:8181/api/amlight/sdntrace/trace'
 
 FLOW_MANAGER_URL = 'http://localhost:8181/api/kytos/flow_manager/v2'
+
+# Maximum number of bulk trace jobs running at the same time
+TRACE_JOBS_MAX_RUNNING = 2
+# Maximum number of bulk trace jobs kept, finished ones are evicted first
+TRACE_JOBS_MAX_STORED = 16
+# Default and maximum number of traces returned per results page
+TRACE_JOBS_PAGE_LIMIT = 100
+TRACE_JOBS_MAX_PAGE_LIMIT = 1000
+# Maximum number of header cubes of a symbolic trace at any split
+HSA_MAX_CUBES = 4096
+# Maximum number of steps of a symbolic trace tree
+HSA_MAX_STEPS = 10000
+# Maximum number of watched traces
+WATCHED_TRACES_MAX = 1000
+# Maximum number of messages queued for a subscriber of the stream of
+# watched trace changes, slower subscribers are dropped
+WATCHED_TRACES_STREAM_QUEUE = 100
+# Seconds between heartbeats of the stream of watched trace changes
+WATCHED_TRACES_STREAM_HEARTBEAT = 15
+# Maximum number of subscribers of the stream of watched trace changes
+WATCHED_TRACES_STREAM_SUBSCRIBERS = 100
+# Number of flow snapshot versions kept for pinned traces
+FLOW_SNAPSHOTS_MAX = 8
+# Seconds without flow changes before the flow snapshot is rebuilt, and
+# maximum seconds a flow change waits for a rebuild during a burst
+SNAPSHOT_REBUILD_DEBOUNCE = 0.5
+SNAPSHOT_REBUILD_MAX_DELAY = 5
+# Seconds before a failed flow snapshot build is retried, doubled after
+# every consecutive failure up to the maximum
+SNAPSHOT_REBUILD_RETRY_DELAY = 1
+SNAPSHOT_REBUILD_RETRY_MAX_DELAY = 60
+# How flow tables are matched: 'index' checks the candidates of the indexed
+# tables with do_match, 'codegen' generates a matcher function per table
+FLOW_TABLE_MATCHER = 'index'
+# Tables with more flows are matched by index even with 'codegen'
+FLOW_TABLE_CODEGEN_MAX_FLOWS = 2000
+# Maximum number of packet classes whose pipeline results are cached per
+# switch
+PIPELINE_CACHE_MAX_ENTRIES = 4096
+# Maximum number of chained groups a packet goes through, deeper buckets
+# are dropped
+GROUP_CHAIN_MAX = 8
+# Maximum number of headers of a swept trace entry
+TRACE_SWEEP_MAX_HEADERS = 65536
+# Milliseconds concurrent PUT /v1/trace requests are collected into a batch
+# traced together, 0 traces each request alone
+TRACE_BATCH_WINDOW = 0
+# Maximum number of requests of a batch, a full batch is traced right away
+TRACE_BATCH_MAX_ENTRIES = 256
+# Maximum number of interactive traces, like PUT /v1/trace, and slices of
+# bulk traces, like PUT /v1/traces and trace jobs, running at the same time.
+# Bulk slices only take up to TRACE_BULK_WORKERS of these workers, fewer than
+# TRACE_WORKERS, the rest are left to interactive traces
+TRACE_WORKERS = 8
+TRACE_BULK_WORKERS = 2
+# Number of entries of a bulk trace slice, bulk traces wait for the waiting
+# interactive traces between slices
+TRACE_BULK_SLICE = 64
+# Maximum number of trace requests in flight, including unfinished trace
+# jobs, and of their entries, counting each header of swept entries. Over
+# these limits requests get a 429 error with a Retry-After of
+# TRACE_RETRY_AFTER seconds
+TRACE_MAX_REQUESTS = 64
+TRACE_MAX_ENTRIES = 200000
+TRACE_RETRY_AFTER = 1
+# Consecutive failures fetching the stored flows that open the circuit of
+# the flow source, and seconds it stays open, failing fast, before a fetch
+# is tried again
+FLOW_SOURCE_FAILURE_THRESHOLD = 3
+FLOW_SOURCE_RESET_TIMEOUT = 30
+# Default maximum age in seconds of the latest flow snapshot used by traces
+# when the stored flows can't be fetched, overridden by the 'max_staleness'
+# query parameter
+FLOW_SNAPSHOT_MAX_STALENESS = 300
@@ -0,0 +1,507 @@
+"""Versioned flow snapshots.
+
+Traces run against an immutable snapshot of the stored flows, compiled into
+FlowTables. The last snapshots are kept, so a trace can be pinned to a
+version and reproduced later, and the flows and tables of a switch that
+didn't change are shared between versions instead of being copied.
+
+Snapshots are published RCU style: readers take FlowSnapshots.latest
+without locking and keep using it while the next snapshot is built, which
+is published by swapping that reference. A flow added or removed is applied
+to the tables of its switch incrementally, instead of building them again.
+"""
+from collections import OrderedDict
+from collections.abc import Mapping
+from datetime import datetime
+from threading import Lock, Timer
+from time import monotonic
+
+import tenacity
+from kytos.core import log
+from napps.amlight.sdntrace_cp import settings
+from napps.amlight.sdntrace_cp.breaker import CircuitOpenError
+from napps.amlight.sdntrace_cp.classifier import (compile_tables, flow_order,
+                                                  sort_flows, table_flows)
+from napps.amlight.sdntrace_cp.codegen import compile_matcher
+from napps.amlight.sdntrace_cp.equivalence import EquivalenceClasses
+from napps.amlight.sdntrace_cp.watch import same_flow
+
+
+class PipelineCache:
+    """Results of the pipeline of a switch by packet class.
+
+    Flows only match the fields of the packet as it enters the switch, and
+    the metadata written from them, so packets of the same equivalence
+    class of the flows of a switch go through the same tables and match the
+    same flows. The flow matched last, the ActionPrograms of the pipeline
+    and the tables it went through are cached by class."""
+
+    __slots__ = ('classes', 'max_entries', 'entries', 'hits', 'misses')
+
+    def __init__(self, classes,
+                 max_entries=settings.PIPELINE_CACHE_MAX_ENTRIES,
+                 entries=None):
+        self.classes = classes
+        self.max_entries = max_entries
+        self.entries = entries if entries is not None else {}
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, args):
+        """Return the class of a packet, or None if it can't be
+        classified."""
+        return self.classes.class_of(args)
+
+    def get(self, key):
+        """Return the (flow, programs, table ids) of a class or None."""
+        if key is None:
+            return None
+        result = self.entries.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """Cache the result of a class, evicting the oldest one if full."""
+        if key is None:
+            return
+        entries = self.entries
+        try:
+            if len(entries) >= self.max_entries:
+                entries.pop(next(iter(entries)), None)
+            entries[key] = result
+        except RuntimeError:
+            # Concurrent evictions
+            pass
+
+    def invalidate(self, table_id, match=None):
+        """Return a cache without the results that went through a table, or
+        None if a flow added with match splits the classes."""
+        if match is not None and not self.classes.covers(match):
+            return None
+        entries = {key: result for key, result in list(self.entries.items())
+                   if table_id not in result[2]}
+        return PipelineCache(self.classes, self.max_entries, entries)
+
+
+class FlowSnapshot(Mapping):
+    """Immutable stored flows of all switches, by dpid, at a version.
+
+    The stored flows of a switch are in priority order. After a flow is
+    applied incrementally, they are only listed from the tables of the
+    switch when needed."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, version, switches, tables, matcher='index',
+                 caches=None):
+        self.version = version
+        self.created_at = str(datetime.now())
+        self._fetched = monotonic()
+        self.matcher = matcher
+        self.used = False
+        self._switches = switches
+        self._tables = tables
+        self._caches = caches if caches is not None else {}
+        self._classes = None
+
+    def age(self):
+        """Return the seconds since the flows of the snapshot were last
+        fetched, or applied."""
+        return monotonic() - self._fetched
+
+    def refresh(self):
+        """Record the flows of the snapshot were fetched again unchanged."""
+        self._fetched = monotonic()
+
+    def __getitem__(self, dpid):
+        flows = self._switches[dpid]
+        if flows is None:
+            flows = self._switches[dpid] = table_flows(self._tables[dpid])
+        return flows
+
+    def __contains__(self, dpid):
+        return dpid in self._switches
+
+    def __iter__(self):
+        return iter(self._switches)
+
+    def __len__(self):
+        return len(self._switches)
+
+    def match(self, dpid, table_id, args, do_match):
+        """Return the first flow of a table that matches a packet or None,
+        see lookup."""
+        return self.lookup(dpid, table_id, args, do_match)[0]
+
+    def lookup(self, dpid, table_id, args, do_match):
+        """Return the first flow of a table that matches a packet and its
+        ActionProgram, or (None, None).
+
+        With the 'index' matcher, do_match(flow, args, table_id) is only
+        called for the candidates given by the compiled table. With the
+        'codegen' matcher, tables up to FLOW_TABLE_CODEGEN_MAX_FLOWS flows
+        are matched by a matcher generated from their flows the first time
+        they're looked up."""
+        table = self._tables.get(dpid, {}).get(table_id)
+        if table is None:
+            return None, None
+        if self.matcher == 'codegen' and \
+                table.size <= settings.FLOW_TABLE_CODEGEN_MAX_FLOWS:
+            matcher = table.matcher
+            if matcher is None:
+                entries = table.entries()
+                matcher = table.matcher = compile_matcher(
+                    (flow for _, flow, _ in entries),
+                    lambda flow, args: do_match(flow, args, table_id),
+                    [(flow, program) for _, flow, program in entries]
+                )
+            return matcher(args) or (None, None)
+        return table.find(args, lambda flow: do_match(flow, args, table_id))
+
+    def pipeline_cache(self, dpid):
+        """Return the PipelineCache of a switch."""
+        cache = self._caches.get(dpid)
+        if cache is None:
+            classes = EquivalenceClasses(
+                flow['flow'].get('match')
+                for table in self._tables.get(dpid, {}).values()
+                for _, flow, _ in table.entries()
+            )
+            cache = self._caches[dpid] = PipelineCache(classes)
+        return cache
+
+    def classes(self, dpid=None):
+        """Return the EquivalenceClasses of the flows of a switch, or of all
+        switches if dpid is None.
+
+        Packets of the same class of all switches are matched by the same
+        flows on every switch they go through, since actions change the
+        fields of packets of a class alike."""
+        if dpid is not None:
+            return self.pipeline_cache(dpid).classes
+        if self._classes is None:
+            self._classes = EquivalenceClasses(
+                flow['flow'].get('match')
+                for tables in self._tables.values()
+                for table in tables.values()
+                for _, flow, _ in table.entries()
+            )
+        return self._classes
+
+    def cache_stats(self):
+        """Return the number of classes cached, hits and misses of the
+        pipeline caches."""
+        caches = list(self._caches.values())
+        return {
+            "entries": sum(len(cache.entries) for cache in caches),
+            "hits": sum(cache.hits for cache in caches),
+            "misses": sum(cache.misses for cache in caches),
+        }
+
+    def as_dict(self):
+        """Return the snapshot metadata as a dict."""
+        return {
+            "version": self.version,
+            "created_at": self.created_at,
+            "switches": len(self._switches),
+            "flows": sum(table.size for tables in self._tables.values()
+                         for table in tables.values()),
+        }
+
+
+class FlowSnapshots:
+    """Bounded store of flow snapshots, the latest one last.
+
+    Every flow added or removed is a new version, so when the store is full
+    the oldest version not used by any trace is evicted first: its version
+    was never reported, so no trace can be pinned to it."""
+
+    def __init__(self, max_versions=settings.FLOW_SNAPSHOTS_MAX,
+                 matcher=settings.FLOW_TABLE_MATCHER):
+        self.max_versions = max_versions
+        self.matcher = matcher
+        self.latest = None
+        self._versions = OrderedDict()
+        self._lock = Lock()
+
+    def publish(self, stored_flows):
+        """Store the stored flows fetched from flow_manager as a snapshot.
+
+        The flows of each switch are shared with the latest snapshot when
+        they are equal. If nothing changed, the latest snapshot is returned
+        instead of a new version, its age counting from now."""
+        with self._lock:
+            latest = self.latest
+            changed = latest is None or len(latest) != len(stored_flows)
+            switches, tables, caches = {}, {}, {}
+            for dpid, flows in stored_flows.items():
+                flows = sort_flows(flows)
+                previous = latest.get(dpid) if latest is not None else None
+                if previous == flows:
+                    switches[dpid] = previous
+                    # pylint: disable=protected-access
+                    tables[dpid] = latest._tables[dpid]
+                    if dpid in latest._caches:
+                        caches[dpid] = latest._caches[dpid]
+                    continue
+                changed = True
+                switches[dpid] = flows
+                tables[dpid] = compile_tables(flows)
+            if not changed:
+                latest.refresh()
+                return latest
+            return self._add_version(switches, tables, caches)
+
+    def apply(self, dpid, stored_flow, removed=False):
+        """Add a stored flow to a switch of the latest snapshot, or remove
+        it, as a new snapshot.
+
+        Only the table of the flow is changed, the other tables and
+        switches are shared. If there's no such flow to remove, the latest
+        snapshot is returned."""
+        flow = stored_flow['flow']
+        table_id = flow.get('table_id', 0)
+        with self._lock:
+            latest = self.latest or FlowSnapshot(0, {}, {})
+            # pylint: disable=protected-access
+            switch_tables = dict(latest._tables.get(dpid, {}))
+            table = switch_tables.get(table_id)
+            if removed:
+                if table is None:
+                    return self.latest
+                table, found = table.remove(
+                    flow, lambda other: same_flow(other, flow,
+                                                  stored_flow.get('flow_id'))
+                )
+                if found is None:
+                    return self.latest
+            elif table is None:
+                table = compile_tables([stored_flow])[table_id]
+            else:
+                table = table.add(flow_order(stored_flow), stored_flow)
+            switch_tables[table_id] = table
+            switches = dict(latest._switches)
+            switches[dpid] = None
+            tables = dict(latest._tables)
+            tables[dpid] = switch_tables
+            caches = dict(latest._caches)
+            cache = caches.pop(dpid, None)
+            if cache is not None:
+                cache = cache.invalidate(
+                    table_id, None if removed else flow.get('match')
+                )
+                if cache is not None:
+                    caches[dpid] = cache
+            return self._add_version(switches, tables, caches)
+
+    def _add_version(self, switches, tables, caches):
+        """Store a new snapshot as the latest version."""
+        latest = self.latest
+        version = latest.version + 1 if latest is not None else 1
+        snapshot = FlowSnapshot(version, switches, tables, self.matcher,
+                                caches)
+        self._versions[version] = snapshot
+        if len(self._versions) > self.max_versions:
+            unused = [old for old, kept in self._versions.items()
+                      if not kept.used and old != version]
+            for old in unused[:len(self._versions) - self.max_versions]:
+                del self._versions[old]
+        while len(self._versions) > self.max_versions:
+            self._versions.popitem(last=False)
+        self.latest = snapshot
+        return snapshot
+
+    @staticmethod
+    def use(snapshot):
+        """Mark a snapshot as used by a trace, which reports its version,
+        and return it."""
+        snapshot.used = True
+        return snapshot
+
+    def get(self, version):
+        """Return the snapshot of a version or None if it wasn't kept."""
+        return self._versions.get(version)
+
+    def list(self):
+        """Return the kept snapshots, oldest first."""
+        return list(self._versions.values())
+
+
+class SnapshotBuilder:
+    """Build and publish snapshots in background after flow changes.
+
+    Flow changes are debounced: a build starts once no change arrived for
+    debounce seconds, or max_delay seconds after the first pending change.
+    Builds don't overlap, and readers keep the latest snapshot meanwhile.
+    A failed build is retried with exponential backoff, from retry_delay
+    up to retry_max_delay seconds, and flow changes meanwhile wait for the
+    retry."""
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, snapshots, fetch, *,
+                 debounce=settings.SNAPSHOT_REBUILD_DEBOUNCE,
+                 max_delay=settings.SNAPSHOT_REBUILD_MAX_DELAY,
+                 retry_delay=settings.SNAPSHOT_REBUILD_RETRY_DELAY,
+                 retry_max_delay=settings.SNAPSHOT_REBUILD_RETRY_MAX_DELAY):
+        self.snapshots = snapshots
+        self._fetch = fetch
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.tracking = False
+        self.pending = 0
+        self.building = False
+        self.rebuilds = 0
+        self.updates = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_latency = None
+        self.max_latency = None
+        self.last_rebuild_at = None
+        self._first_pending = None
+        self._timer = None
+        self._lock = Lock()
+        self._build_lock = Lock()
+
+    def start(self):
+        """Build the first snapshot in background."""
+        with self._lock:
+            self._start_timer(0)
+
+    def schedule(self):
+        """Count a flow change and schedule a debounced build, unless a
+        failed build is waiting to be retried."""
+        with self._lock:
+            now = monotonic()
+            self.pending += 1
+            if self._first_pending is None:
+                self._first_pending = now
+            if self.consecutive_failures and self._timer:
+                return
+            self._start_timer(
+                min(self.debounce,
+                    max(0, self._first_pending + self.max_delay - now))
+            )
+
+    def _start_timer(self, delay):
+        """Replace the scheduled build with one in delay seconds."""
+        if self._timer:
+            self._timer.cancel()
+        self._timer = Timer(delay, self.build)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def apply(self, dpid, stored_flow, removed=False):
+        """Apply a flow added or removed to the latest snapshot.
+
+        The flow is only applied while tracking the stored flows with no
+        build running or pending, otherwise a build is scheduled, as it is
+        when a flow removed isn't found."""
+        with self._lock:
+            applied = False
+            if self.tracking and not self.building and not self.pending:
+                latest = self.snapshots.latest
+                applied = self.snapshots.apply(dpid, stored_flow,
+                                               removed) is not latest
+                self.updates += applied
+        if not applied:
+            self.schedule()
+
+    def build(self):
+        """Fetch the stored flows and publish them as the latest snapshot.
+
+        Once a build succeeds, the builder is tracking the stored flows and
+        traces can use the latest snapshot without fetching them."""
+        with self._build_lock:
+            with self._lock:
+                pending = self.pending
+                self.pending = 0
+                self._first_pending = None
+                self.building = True
+            started = monotonic()
+            try:
+                snapshot = self.snapshots.publish(self._fetch())
+            # Any failure of the flow source must schedule a retry instead
+            # of stopping the builds
+            except Exception as exc:  # pylint: disable=broad-exception-caught
+                with self._lock:
+                    self.failures += 1
+                    self.consecutive_failures += 1
+                    self.building = False
+                    self.tracking = False
+                    self.pending += pending
+                    delay = min(self.retry_delay *
+                                2 ** (self.consecutive_failures - 1),
+                                self.retry_max_delay)
+                    self._start_timer(delay)
+                log.error("Failed to build a flow snapshot, retrying in "
+                          "%s seconds: %s", delay, exc)
+                return None
+            latency = monotonic() - started
+            with self._lock:
+                self.building = False
+                self.tracking = True
+                self.consecutive_failures = 0
+                self.rebuilds += 1
+                self.last_latency = latency
+                self.max_latency = max(self.max_latency or 0, latency)
+                self.last_rebuild_at = str(datetime.now())
+            return snapshot
+
+    def is_current(self, snapshot):
+        """Whether a snapshot is the latest one and the builder is tracking
+        the stored flows with no flow change pending."""
+        return (snapshot is not None
+                and snapshot is self.snapshots.latest
+                and self.tracking and not self.pending)
+
+    def latest(self, max_staleness=0):
+        """Return the latest snapshot if it's current, otherwise publish
+        the stored flows fetched now.
+
+        If the stored flows can't be fetched, or the flow source circuit is
+        open, the latest snapshot is returned if it isn't older than
+        max_staleness seconds."""
+        latest = self.snapshots.latest
+        if self.is_current(latest):
+            return latest
+        try:
+            return self.snapshots.publish(self._fetch())
+        except (tenacity.RetryError, CircuitOpenError):
+            if latest is None or latest.age() > max_staleness:
+                raise
+            log.warning("Using flow snapshot %s, %.1f seconds old, since it "
+                        "couldn't get stored_flows", latest.version,
+                        latest.age())
+            return latest
+
+    def staleness(self, snapshot):
+        """Return the seconds the flows of a snapshot may be out of date,
+        0 while it's current."""
+        if self.is_current(snapshot):
+            return 0
+        return round(snapshot.age(), 3)
+
+    def shutdown(self):
+        """Cancel the scheduled build."""
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+
+    def stats(self):
+        """Return the builder metrics as a dict."""
+        return {
+            "tracking": self.tracking,
+            "pending_changes": self.pending,
+            "building": self.building,
+            "rebuilds": self.rebuilds,
+            "incremental_updates": self.updates,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "last_rebuild_latency": self.last_latency,
+            "max_rebuild_latency": self.max_latency,
+            "last_rebuild_at": self.last_rebuild_at,
+        }
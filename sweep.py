@@ -0,0 +1,154 @@
+"""Field sweeps of trace entries.
+
+An entry of PUT /v1/traces can give a list of values or a {"from", "to"}
+range for some integer fields. The entry is expanded into the headers of
+the cartesian product of these values, and headers whose switch, port and
+packet equivalence class are the same, see EquivalenceClasses, are traced
+once. Headers are then grouped by the outcome of their trace.
+"""
+from itertools import product
+
+from napps.amlight.sdntrace_cp.utils import trace_outcome, trace_vlans
+
+# Key of the swept fields in a converted trace entry
+SWEEP = 'sweep'
+
+
+def sweep_values(value):
+    """Return the values of a list or a {"from", "to"} range."""
+    if isinstance(value, dict):
+        return range(value['from'], value['to'] + 1)
+    return value
+
+
+def sweep_size(entry):
+    """Return the number of headers of a swept entry."""
+    size = 1
+    for value in entry[SWEEP].values():
+        size *= len(sweep_values(value))
+    return size
+
+
+def count_headers(entries):
+    """Return the number of headers of a list of entries, swept or not."""
+    return sum(sweep_size(entry) if SWEEP in entry else 1
+               for entry in entries)
+
+
+def expand_sweep(entry):
+    """Return the swept fields of an entry and an iterator of its headers,
+    as (values of the swept fields, entry) pairs, the last field varying
+    fastest."""
+    fields = tuple(entry[SWEEP])
+    base = {name: value for name, value in entry.items() if name != SWEEP}
+
+    def headers():
+        for values in product(*(sweep_values(entry[SWEEP][name])
+                                for name in fields)):
+            header = dict(base)
+            header.update(zip(fields, values))
+            if 'dl_vlan' in header:
+                header['dl_vlan'] = [header['dl_vlan']]
+            yield values, header
+
+    return fields, headers()
+
+
+def sweep_class(classes, header):
+    """Return the switch, port and packet class of a header, or None if it
+    can't be classified by the EquivalenceClasses of all switches."""
+    if classes is None:
+        return None
+    packet_class = classes.class_of(header)
+    if packet_class is None:
+        return None
+    return header['dpid'], header['in_port'], packet_class
+
+
+def compress_headers(rows):
+    """Return the values of headers with the runs of consecutive values of
+    the last field as [from, to] ranges."""
+    compressed = []
+    for row in rows:
+        if compressed:
+            last = compressed[-1]
+            end = last[-1][1] if isinstance(last[-1], list) else last[-1]
+            if tuple(last[:-1]) == row[:-1] and row[-1] == end + 1:
+                start = last[-1][0] if isinstance(last[-1], list) \
+                    else last[-1]
+                last[-1] = [start, row[-1]]
+                continue
+        compressed.append(list(row))
+    return compressed
+
+
+class SweepOutcomes:
+    """Headers of a sweep grouped by the outcome of their traces, in the
+    order they are first traced.
+
+    The VLAN IDs of a path equal to the swept one of its header are the
+    same for all headers, see trace_outcome, so the result of an outcome
+    is the trace of its first header, and the other headers have their own
+    VLAN ID where it has the swept one.
+
+    The headers of a packet class, see sweep_class, share the outcome of
+    the first one traced, unless its path has other VLAN IDs of vlans, the
+    swept ones, set by flows. A VLAN ID of the path equal to the swept one
+    of the header may have been set by flows too, so such an outcome is
+    only shared once the next header of the class traced has it."""
+
+    def __init__(self, fields, vlans=()):
+        self.fields = fields
+        self.vlans = vlans
+        self.headers = 0
+        self.traced = 0
+        self.outcomes = []
+        self._by_path = {}
+        self._dpids = {}
+        self._classes = {}
+        self._candidates = {}
+
+    def class_outcome(self, key):
+        """Return the outcome shared by the headers of a class, or None if
+        the header must be traced."""
+        return self._classes.get(key) if key is not None else None
+
+    def add_trace(self, values, result, key=None):
+        """Return the outcome of the trace of a header, given the values
+        of its swept fields and the key of its class, if any."""
+        self.traced += 1
+        vlan = values[self.fields.index('dl_vlan')] \
+            if 'dl_vlan' in self.fields else None
+        path = trace_outcome(result, self._dpids, vlan)
+        outcome = self._by_path.get(path)
+        if outcome is None:
+            outcome = self._by_path[path] = {'headers': [], 'result': result}
+            self.outcomes.append(outcome)
+        if key is not None:
+            self._share(key, outcome, vlan, trace_vlans(result, start=1))
+        return outcome
+
+    def _share(self, key, outcome, vlan, path_vlans):
+        """Share the outcome of a header with the other headers of its
+        class, if their paths can't differ by VLAN IDs set by flows."""
+        if self._candidates.get(key, outcome) is not outcome or \
+                any(value != vlan and value in self.vlans
+                    for value in path_vlans):
+            self._candidates[key] = None
+        elif vlan in path_vlans and key not in self._candidates:
+            self._candidates[key] = outcome
+        else:
+            self._classes[key] = outcome
+
+    def add_header(self, values, outcome):
+        """Add the values of the swept fields of a header to an outcome."""
+        self.headers += 1
+        outcome['headers'].append(values)
+
+    def as_dict(self):
+        """Return the sweep as in the response, with the headers of each
+        outcome compressed, see compress_headers."""
+        for outcome in self.outcomes:
+            outcome['headers'] = compress_headers(outcome['headers'])
+        return {'fields': list(self.fields), 'headers': self.headers,
+                'traced': self.traced, 'outcomes': self.outcomes}
@@ -0,0 +1,30 @@
+"""Helpers of the differential tests of flow matching against do_match."""
+import itertools
+
+from napps.amlight.sdntrace_cp.main import Main
+
+
+def random_flows(rand, number, fields, probability=0.35):
+    """Return random stored flows, each one matching the fields, given as
+    (name, values) pairs, with a probability, on a random value."""
+    flows = []
+    for _ in range(number):
+        match = {name: rand.choice(values) for name, values in fields
+                 if rand.random() < probability}
+        flows.append({"flow": {"match": match}})
+    return flows
+
+
+def packets(fields):
+    """Return the packet fields of every combination of the values of the
+    fields, given as (name, values) pairs."""
+    names = [name for name, _ in fields]
+    return [dict(zip(names, values))
+            for values in itertools.product(*(values
+                                              for _, values in fields))]
+
+
+def first_match(flows, args, table_id=0):
+    """Return the first flow that do_match matches, or None."""
+    return next((flow for flow in flows
+                 if Main.do_match(flow, args, table_id)), None)
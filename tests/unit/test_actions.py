@@ -0,0 +1,102 @@
+"""Module to test the actions.py file."""
+import pytest
+
+from napps.amlight.sdntrace_cp.actions import (POP_VLAN, PUSH_VLAN, SET_VLAN,
+                                               compile_program,
+                                               try_compile_program)
+
+
+class TestActionProgram:
+    """Test compiling and running action programs."""
+
+    def test_compile_program(self):
+        """Test compiling the actions and instructions of flows."""
+        program = compile_program({"flow": {"actions": [
+            {"action_type": "push_vlan"},
+            {"action_type": "set_vlan", "vlan_id": 200},
+            {"action_type": "output", "port": 1},
+            {"action_type": "output", "port": 2},
+            {"action_type": "set_queue", "queue_id": 1},
+        ]}})
+        assert program.ops == ((PUSH_VLAN, None), (SET_VLAN, 200))
+        assert (program.has_output, program.output) == (True, 2)
+        assert program.gotos == ()
+
+        program = compile_program({"flow": {"instructions": [
+            {"instruction_type": "apply_actions",
+             "actions": [{"action_type": "output", "port": 1}]},
+            {"instruction_type": "apply_actions",
+             "actions": [{"action_type": "pop_vlan"}]},
+            {"instruction_type": "goto_table", "table_id": 2},
+        ]}})
+        assert program.ops == ((POP_VLAN, None),)
+        assert not program.has_output
+        assert program.gotos == (2,)
+
+        malformed = {"flow": {"actions": [{"port": 1}]}}
+        assert try_compile_program(malformed) is None
+        with pytest.raises(KeyError):
+            compile_program(malformed)
+
+    def test_run(self):
+        """Test applying the VLAN operations to the packet fields."""
+        program = compile_program({"flow": {"actions": [
+            {"action_type": "pop_vlan"},
+            {"action_type": "push_vlan"},
+            {"action_type": "set_vlan", "vlan_id": 300},
+            {"action_type": "push_vlan"},
+            {"action_type": "set_vlan", "vlan_id": 400},
+        ]}})
+        args = {"dl_vlan": [100]}
+        program.run(args)
+        assert args == {"dl_vlan": [300, 400]}
+
+        args = {}
+        compile_program({"flow": {"actions": [
+            {"action_type": "pop_vlan"}
+        ]}}).run(args)
+        assert not args
+        args = {"dl_vlan": [100]}
+        compile_program({"flow": {"actions": [
+            {"action_type": "pop_vlan"}
+        ]}}).run(args)
+        assert not args
+
+    def test_write_metadata(self):
+        """Test compiling and writing metadata with a mask."""
+        program = compile_program({"flow": {"instructions": [
+            {"instruction_type": "write_metadata", "metadata": 0x12,
+             "metadata_mask": 0xf0},
+            {"instruction_type": "goto_table", "table_id": 1},
+        ]}})
+        assert program.metadata == (0x12, 0xf0)
+        args = {}
+        program.write_metadata(args)
+        assert args == {"metadata": 0x10}
+        args = {"metadata": 0x2f}
+        program.write_metadata(args)
+        assert args == {"metadata": 0x1f}
+
+        program = compile_program({"flow": {"instructions": [
+            {"instruction_type": "write_metadata", "metadata": 3},
+        ]}})
+        args = {"metadata": 0x2f}
+        program.write_metadata(args)
+        assert args == {"metadata": 3}
+
+    def test_run_outputs(self):
+        """Test copying the packet fields sent by each output action."""
+        program = compile_program({"flow": {"actions": [
+            {"action_type": "output", "port": 1},
+            {"action_type": "push_vlan"},
+            {"action_type": "set_vlan", "vlan_id": 300},
+            {"action_type": "output", "port": 2},
+            {"action_type": "pop_vlan"},
+        ]}})
+        assert program.outputs == ((0, 1), (2, 2))
+        args = {"dl_vlan": [100]}
+        copies = []
+        program.run(args, copies)
+        assert copies == [({"dl_vlan": [100]}, 1),
+                          ({"dl_vlan": [100, 300]}, 2)]
+        assert args == {"dl_vlan": [100]}
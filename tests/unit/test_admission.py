@@ -0,0 +1,47 @@
+"""Module to test the admission.py file."""
+import pytest
+from kytos.core.rest_api import HTTPException
+
+from napps.amlight.sdntrace_cp.admission import AdmissionControl
+
+
+class TestAdmissionControl:
+    """Test the AdmissionControl class."""
+
+    def setup_method(self):
+        """Execute steps before each test."""
+        self.admission = AdmissionControl(max_requests=2, max_entries=10,
+                                          retry_after=3)
+
+    def test_admit(self):
+        """Test requests are rejected over the limits."""
+        with self.admission.admit(4):
+            with self.admission.admit(6):
+                with pytest.raises(HTTPException) as exc:
+                    self.admission.acquire(1)
+                assert exc.value.status_code == 429
+                assert exc.value.headers == {"Retry-After": "3"}
+            with pytest.raises(HTTPException) as exc:
+                self.admission.acquire(7)
+            assert exc.value.status_code == 429
+            with self.admission.admit(6):
+                pass
+        assert self.admission.stats() == {
+            "requests": 0, "max_requests": 2, "entries": 0,
+            "max_entries": 10, "admitted": 3, "rejected": 2,
+        }
+
+    def test_too_many_entries(self):
+        """Test a request over the limit of entries alone is rejected."""
+        with pytest.raises(HTTPException) as exc:
+            self.admission.acquire(11)
+        assert exc.value.status_code == 413
+        assert self.admission.stats()["rejected"] == 0
+
+    def test_release_on_error(self):
+        """Test a request is released when its context fails."""
+        with pytest.raises(ValueError):
+            with self.admission.admit(5):
+                raise ValueError
+        assert self.admission.requests == 0
+        assert self.admission.entries == 0
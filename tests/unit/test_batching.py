@@ -0,0 +1,63 @@
+"""Module to test the batching.py file."""
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+
+import pytest
+
+from napps.amlight.sdntrace_cp.batching import TraceBatcher
+
+
+class TestTraceBatcher:
+    """Test the TraceBatcher class."""
+
+    def setup_method(self):
+        """Execute steps before each test."""
+        self.batches = []
+
+    def run_batch(self, batch_key, entries):
+        """Record a batch and return its results."""
+        self.batches.append((batch_key, list(entries)))
+        return [ValueError(entry) if entry < 0 else entry * 10
+                for entry in entries]
+
+    def test_no_window(self):
+        """Test each entry runs alone without a window."""
+        batcher = TraceBatcher(self.run_batch, window=0)
+        assert batcher.submit("key", 1) == 10
+        with pytest.raises(ValueError):
+            batcher.submit("key", -1)
+        assert self.batches == [("key", [1]), ("key", [-1])]
+        assert batcher.stats() == {"window": 0, "batches": 2, "entries": 2,
+                                   "max_batch": 1}
+
+    def test_batch(self):
+        """Test concurrent entries with the same key share a batch."""
+        batcher = TraceBatcher(self.run_batch, window=200, max_entries=3)
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(batcher.submit, "key", entry)
+                       for entry in (1, -1, 2)]
+            other = executor.submit(batcher.submit, "other", 3)
+            assert other.result(timeout=5) == 30
+            assert futures[0].result(timeout=5) == 10
+            with pytest.raises(ValueError):
+                futures[1].result(timeout=5)
+            assert futures[2].result(timeout=5) == 20
+        assert sorted(self.batches) == [("key", [1, -1, 2]), ("other", [3])]
+        assert batcher.stats()["max_batch"] == 3
+
+    def test_batch_error(self):
+        """Test an error running a batch is raised to all of its callers."""
+        started = Event()
+
+        def run_batch(_batch_key, _entries):
+            started.set()
+            raise RuntimeError("failed")
+
+        batcher = TraceBatcher(run_batch, window=10000, max_entries=2)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(batcher.submit, "key", entry)
+                       for entry in (1, 2)]
+            for future in futures:
+                with pytest.raises(RuntimeError):
+                    future.result(timeout=5)
+        assert started.is_set()
@@ -0,0 +1,57 @@
+"""Module to test the breaker.py file."""
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from napps.amlight.sdntrace_cp.breaker import (CircuitBreaker,
+                                               CircuitOpenError)
+
+
+class TestCircuitBreaker:
+    """Test the CircuitBreaker class."""
+
+    def setup_method(self):
+        """Execute steps before each test."""
+        self.call = MagicMock(return_value="flows")
+        self.breaker = CircuitBreaker(self.call, failure_threshold=2,
+                                      reset_timeout=30)
+
+    @patch("napps.amlight.sdntrace_cp.breaker.monotonic")
+    def test_open_and_close(self, mock_monotonic):
+        """Test the circuit opens after consecutive failures and closes
+        after a successful trial."""
+        mock_monotonic.return_value = 100
+        assert self.breaker() == "flows"
+        self.call.side_effect = ConnectionError
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                self.breaker()
+        assert self.breaker.state == "open"
+        with pytest.raises(CircuitOpenError):
+            self.breaker()
+        assert self.call.call_count == 3
+
+        mock_monotonic.return_value = 130
+        with pytest.raises(ConnectionError):
+            self.breaker()
+        assert self.breaker.state == "open"
+        with pytest.raises(CircuitOpenError):
+            self.breaker()
+
+        mock_monotonic.return_value = 160
+        self.call.side_effect = None
+        assert self.breaker() == "flows"
+        assert self.breaker.stats() == {
+            "state": "closed", "consecutive_failures": 0, "failures": 3,
+            "rejected": 2, "opened": 2,
+        }
+
+    def test_reset_failures(self):
+        """Test a success resets the consecutive failures."""
+        self.call.side_effect = [ConnectionError, "flows", ConnectionError]
+        with pytest.raises(ConnectionError):
+            self.breaker()
+        assert self.breaker() == "flows"
+        with pytest.raises(ConnectionError):
+            self.breaker()
+        assert self.breaker.state == "closed"
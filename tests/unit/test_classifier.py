@@ -0,0 +1,119 @@
+"""Module to test the classifier.py file."""
+import random
+
+from napps.amlight.sdntrace_cp.classifier import (FlowTable, compile_tables,
+                                                  flow_order, sort_flows,
+                                                  table_flows)
+from napps.amlight.sdntrace_cp.main import Main
+from napps.amlight.sdntrace_cp.tests.helpers import (first_match, packets,
+                                                     random_flows)
+from napps.amlight.sdntrace_cp.watch import same_flow
+
+FLOW_FIELDS = (("in_port", [1, 2, 3]),
+               ("dl_vlan", [0, 10, 11, "8/4088"]),
+               ("dl_type", [2048, 2054]),
+               ("nw_dst", ["10.0.0.0/8", "10.0.0.1", "10.0.0.0/31"]),
+               ("tp_dst", [22, 80]),
+               ("metadata", [0, 4, "0x4/0x6"]))
+PACKET_FIELDS = (("in_port", (1, 2, 4)),
+                 ("dl_vlan", ([], [10], [11], [12])),
+                 ("dl_type", (None, 2048)),
+                 ("nw_dst", (None, "10.0.0.1")),
+                 ("tp_dst", (None, 80)),
+                 ("metadata", (None, 4, 6)))
+
+
+def random_table_flows(rand, number):
+    """Return random stored flows overlapping each other, with random
+    priorities and tables."""
+    flows = random_flows(rand, number, FLOW_FIELDS, 0.4)
+    for flow in flows:
+        flow["flow"]["priority"] = rand.choice([10, 20, 30])
+        if rand.random() < 0.3:
+            flow["flow"]["table_id"] = 1
+    return flows
+
+
+def assert_same_lookups(tables, flows):
+    """Assert that compiled tables match the first flow that do_match
+    matches, in priority order."""
+    flows = sort_flows(flows)
+    for args in packets(PACKET_FIELDS):
+        for table_id in (0, 1):
+            table = tables.get(table_id)
+            result = table and table.lookup(
+                args, lambda flow, tid=table_id, args=args:
+                Main.do_match(flow, args, tid)
+            )
+            assert result is first_match(flows, args, table_id)
+
+
+class TestFlowTable:
+    """Test the FlowTable class."""
+
+    def test_lookup(self):
+        """Test that a lookup finds the first matching flow of a table."""
+        flows = [
+            {"flow": {"match": {"in_port": 1, "dl_vlan": 100}}},
+            {"flow": {"match": {"in_port": 1, "nw_dst": "10.0.0.0/8"}}},
+            {"flow": {"match": {"in_port": 1}}},
+            {"flow": {"match": {"dl_vlan": 0}}},
+        ]
+        table = FlowTable.from_flows([(flow_order(flow), flow)
+                                      for flow in flows])
+
+        def lookup(args):
+            return table.lookup(args, lambda flow: Main.do_match(flow, args,
+                                                                 0))
+
+        assert lookup({"in_port": 1, "dl_vlan": [100]}) is flows[0]
+        assert lookup({"in_port": 1, "dl_vlan": [4196]}) is flows[0]
+        assert lookup({"in_port": 1, "nw_dst": "10.1.1.1"}) is flows[1]
+        assert lookup({"in_port": 1, "nw_dst": "11.1.1.1"}) is flows[2]
+        assert lookup({"in_port": 1, "nw_dst": "2001:db8::1"}) is flows[2]
+        assert lookup({"in_port": 1, "dl_vlan": [200]}) is flows[2]
+        assert lookup({"in_port": 2}) is flows[3]
+        assert lookup({"in_port": 2, "dl_vlan": [200]}) is None
+
+    def test_differential(self):
+        """Test compiled tables against matching every flow in order."""
+        flows = random_table_flows(random.Random(7), 300)
+        assert_same_lookups(compile_tables(flows), flows)
+
+    def test_add_remove(self):
+        """Test adding and removing flows incrementally."""
+        rand = random.Random(11)
+        flows = []
+        # Stored flows have distinct tables, priorities and matches
+        for flow in random_table_flows(rand, 100):
+            if not any(same_flow(other, flow["flow"]) for other in flows):
+                flows.append(flow)
+        tables = compile_tables(flows)
+        size = len(flows)
+        first = tables
+        for flow in random_table_flows(rand, 100):
+            if rand.random() < 0.4:
+                removed = flows.pop(rand.randrange(len(flows)))
+                table_id = removed["flow"].get("table_id", 0)
+                table, found = tables[table_id].remove(
+                    removed["flow"],
+                    lambda other, flow=removed: other is flow
+                )
+                assert found is removed
+            else:
+                # A flow with the same table, priority and match is replaced
+                flows = [other for other in flows
+                         if not same_flow(other, flow["flow"])]
+                flows.append(flow)
+                table_id = flow["flow"].get("table_id", 0)
+                table = tables[table_id].add(flow_order(flow), flow)
+            tables = {**tables, table_id: table}
+        assert_same_lookups(tables, flows)
+        assert table_flows(tables) == sort_flows(flows)
+        assert sum(table.size for table in tables.values()) == len(flows)
+        assert sum(table.size for table in first.values()) == size
+
+        missing = {"match": {"in_port": 9}, "priority": 10}
+        table = tables[0]
+        assert table.remove(missing, lambda other: same_flow(
+            other, missing)) == (table, None)
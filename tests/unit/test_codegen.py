@@ -0,0 +1,83 @@
+"""Module to test the codegen.py file."""
+import random
+
+import pytest
+
+from napps.amlight.sdntrace_cp.codegen import compile_matcher, generate_matcher
+from napps.amlight.sdntrace_cp.main import Main
+from napps.amlight.sdntrace_cp.snapshot import FlowSnapshots
+from napps.amlight.sdntrace_cp.tests.helpers import (first_match, packets,
+                                                     random_flows)
+
+
+class TestMatcher:
+    """Test the generated matchers."""
+
+    def test_generate_matcher(self):
+        """Test inlining constants, most selective fields first."""
+        flows = [
+            {"flow": {"match": {"in_port": 1, "dl_vlan": 10}}},
+            {"flow": {"match": {"in_port": 1, "dl_vlan": 11,
+                                "dl_src": ["a"]}}},
+            {"flow": {"match": {"dl_vlan": "x/y"}}},
+            {"flow": {"match": {}}},
+        ]
+        source, constants = generate_matcher(flows)
+        assert "(vlan and top & 4095 == 10) and (f0 and f0 == 1)" in source
+        assert "fallback(F[2], args)" in source
+        assert "F[3]" not in source
+        assert constants == [["a"]]
+
+    def test_differential(self):
+        """Test generated matchers against do_match on every flow."""
+        flows = random_flows(random.Random(5), 200, (
+            ("in_port", [1, 2, "1", 0]),
+            ("dl_vlan", [0, 10, 11, "8/4088", "10/4095", "bad"]),
+            ("dl_type", [2048, 2054]),
+            ("nw_dst", ["10.0.0.0/8", "10.0.0.1", "0.0.0.0/0",
+                        "2001:db8::/32"]),
+            ("ipv6_src", ["2001:db8::/64"]),
+            ("tp_dst", [22, 80, None]),
+            ("metadata", [0, 4, 6, "0x4/0x6", "bad"]),
+        ))
+        matcher = compile_matcher(
+            flows, lambda flow, args: Main.do_match(flow, args, 0)
+        )
+        for args in packets((("in_port", (1, 2, "1", None)),
+                             ("dl_vlan", ([], [10], [4106], [0])),
+                             ("dl_type", (None, 2048)),
+                             ("nw_dst", (None, "10.0.0.1", "2001:db8::1")),
+                             ("ipv6_src", (None, "2001:db8::2")),
+                             ("tp_dst", (None, 80)),
+                             ("metadata", (None, 4, 6)))):
+            try:
+                expected = first_match(flows, args)
+            except ValueError:
+                # Malformed VLANs and metadata are left to do_match,
+                # which raises
+                with pytest.raises(ValueError):
+                    matcher(args)
+                continue
+            assert matcher(args) is expected
+
+    def test_snapshot_codegen(self):
+        """Test snapshots matching with cached generated matchers."""
+        flow1 = {"flow": {"match": {"in_port": 1}, "priority": 10}}
+        flow2 = {"flow": {"match": {"in_port": 2}, "priority": 10}}
+        snapshots = FlowSnapshots(matcher="codegen")
+        snapshot = snapshots.publish({"dpid": [flow1, flow2]})
+        assert snapshot.match("dpid", 0, {"in_port": 2},
+                              Main.do_match) is flow2
+        # pylint: disable=protected-access
+        table = snapshot._tables["dpid"][0]
+        matcher = table.matcher
+        assert matcher is not None
+        assert snapshot.match("dpid", 0, {"in_port": 3},
+                              Main.do_match) is None
+        assert table.matcher is matcher
+
+        flow3 = {"flow": {"match": {"in_port": 3}, "priority": 10}}
+        second = snapshots.apply("dpid", flow3)
+        assert second.match("dpid", 0, {"in_port": 3}, Main.do_match) \
+            is flow3
+        assert second._tables["dpid"][0].matcher is not matcher
@@ -0,0 +1,80 @@
+"""Module to test the equivalence.py file."""
+import random
+
+from napps.amlight.sdntrace_cp.equivalence import EquivalenceClasses
+from napps.amlight.sdntrace_cp.main import Main
+from napps.amlight.sdntrace_cp.tests.helpers import packets, random_flows
+
+
+class TestEquivalenceClasses:
+    """Test the EquivalenceClasses class."""
+
+    def test_class_of(self):
+        """Test classifying packets by the atoms of their fields."""
+        classes = EquivalenceClasses([
+            {"in_port": 1, "dl_vlan": 10},
+            {"in_port": 2, "dl_vlan": "8/4088"},
+            {"nw_dst": "10.0.0.0/8"},
+            {"nw_dst": "10.0.0.1"},
+            {"metadata": 4},
+        ])
+        assert classes.fields == ("dl_vlan", "in_port", "metadata", "nw_dst")
+        assert classes.class_of({"in_port": 3, "dl_vlan": [100]}) == \
+            classes.class_of({"in_port": 4, "dl_vlan": [200]})
+        assert classes.class_of({"in_port": 3, "dl_vlan": [8]}) == \
+            classes.class_of({"in_port": 3, "dl_vlan": [15]})
+        assert classes.class_of({"in_port": 3, "dl_vlan": [8]}) != \
+            classes.class_of({"in_port": 3, "dl_vlan": [16]})
+        assert classes.class_of({"in_port": 1}) != \
+            classes.class_of({"in_port": 1, "dl_vlan": [16]})
+        assert classes.class_of({"nw_dst": "10.1.1.1"}) == \
+            classes.class_of({"nw_dst": "10.2.2.2"})
+        assert classes.class_of({"nw_dst": "10.0.0.1"}) != \
+            classes.class_of({"nw_dst": "10.0.0.2"})
+        assert classes.class_of({"nw_dst": "11.0.0.1"}) != \
+            classes.class_of({"nw_dst": "10.0.0.2"})
+        assert classes.class_of({"metadata": 4}) != classes.class_of({})
+        assert classes.class_of({"in_port": [1]}) is None
+        assert classes.class_of({"nw_dst": "bad"}) is None
+
+    def test_covers(self):
+        """Test whether flows added split the classes."""
+        classes = EquivalenceClasses([
+            {"in_port": 1, "dl_vlan": "8/4088", "nw_dst": "10.0.0.0/8"},
+            {"metadata": "0x4/0x4"},
+        ])
+        assert classes.covers({"in_port": 1, "dl_vlan": "8/4088"})
+        assert classes.covers({"nw_dst": "10.1.0.0/8", "metadata": 12})
+        assert classes.covers({})
+        assert not classes.covers({"in_port": 2})
+        assert not classes.covers({"dl_vlan": 8})
+        assert not classes.covers({"nw_dst": "10.0.0.0/16"})
+        assert not classes.covers({"dl_type": 2048})
+
+    def test_differential(self):
+        """Test packets of a class are matched by the same flows."""
+        flows = random_flows(random.Random(7), 100, (
+            ("in_port", [1, 2, "1", 0]),
+            ("dl_vlan", [0, 10, 11, "8/4088", "10/4095"]),
+            ("dl_type", [2048, 2054]),
+            ("nw_dst", ["10.0.0.0/8", "10.0.0.1", "0.0.0.0/0",
+                        "2001:db8::/32"]),
+            ("metadata", [0, 4, "0x4/0x6"]),
+            ("tp_dst", [22, 80, None, ["a"]]),
+        ))
+        classes = EquivalenceClasses.from_flows(flows)
+        matched = {}
+        for args in packets((("in_port", (1, 2, "1", 3, None)),
+                             ("dl_vlan", ([], [0], [8], [10], [12], [4106],
+                                          [20])),
+                             ("dl_type", (None, 2048, 2055)),
+                             ("nw_dst", (None, "10.0.0.1", "10.0.0.2",
+                                         "11.0.0.1", "2001:db8::1")),
+                             ("metadata", (None, 4, 6)),
+                             ("tp_dst", (None, 22, 23)))):
+            result = tuple(bool(Main.do_match(flow, args, 0))
+                           for flow in flows)
+            key = classes.class_of(args)
+            assert key is not None
+            assert matched.setdefault(key, result) == result
+        assert len(matched) < 5 * 7 * 3 * 5 * 3 * 3
@@ -0,0 +1,105 @@
+"""Module to test the groups.py file."""
+from unittest.mock import MagicMock
+
+import pytest
+
+from napps.amlight.sdntrace_cp.groups import GroupTables
+
+DPID = "00:00:00:00:00:00:00:01"
+
+
+def bucket(*actions, watch_port=None):
+    """Return a bucket with actions."""
+    result = {"actions": list(actions)}
+    if watch_port is not None:
+        result["watch_port"] = watch_port
+    return result
+
+
+def output(port):
+    """Return an output action."""
+    return {"action_type": "output", "port": port}
+
+
+def set_vlan(vlan_id):
+    """Return a set_vlan action."""
+    return {"action_type": "set_vlan", "vlan_id": vlan_id}
+
+
+class TestGroupTables:
+    """Test the GroupTables class."""
+
+    def setup_method(self):
+        """Execute steps before each test."""
+        self.groups = GroupTables(max_chain=2)
+        self.switch = MagicMock(dpid=DPID)
+
+    def test_set(self):
+        """Test setting and listing groups."""
+        group = {"group_id": 1, "group_type": "indirect",
+                 "buckets": [bucket(output(1))]}
+        self.groups.set(DPID, [group])
+        assert self.groups.list() == {DPID: [group]}
+        assert self.groups.get(DPID, 1).programs[0].output == 1
+
+        with pytest.raises(ValueError):
+            self.groups.set(DPID, [{"group_id": 1, "group_type": "fast"}])
+        with pytest.raises(KeyError):
+            self.groups.set(DPID, [{"group_type": "all"}])
+        assert self.groups.list() == {DPID: [group]}
+
+        self.groups.set(DPID, [])
+        assert self.groups.list() == {}
+
+    def test_outputs_all(self):
+        """Test the copies of a packet sent to an all group."""
+        self.groups.set(DPID, [{"group_id": 1, "group_type": "all",
+                                "buckets": [bucket(set_vlan(10), output(1)),
+                                            bucket(output(2))]}])
+        args = {"dl_vlan": [100]}
+        outputs = self.groups.outputs(self.switch, 1, args)
+        assert [(entries, port) for entries, port, _ in outputs] == [
+            ({"dl_vlan": [10]}, 1), ({"dl_vlan": [100]}, 2)
+        ]
+        assert outputs[1][2] == [{"group": 1, "group_type": "all",
+                                  "bucket": 1}]
+        assert args == {"dl_vlan": [100]}
+
+    def test_outputs_indirect(self):
+        """Test a packet sent to an indirect group isn't copied."""
+        self.groups.set(DPID, [{"group_id": 1, "group_type": "indirect",
+                                "buckets": [bucket(set_vlan(10), output(1))]}])
+        args = {"dl_vlan": [100]}
+        outputs = self.groups.outputs(self.switch, 1, args)
+        assert outputs == [(args, 1, [{"group": 1, "group_type": "indirect",
+                                       "bucket": 0}])]
+        assert args == {"dl_vlan": [10]}
+
+    def test_outputs_ff(self):
+        """Test the first live bucket of a fast failover group is used."""
+        self.groups.set(DPID, [{"group_id": 1, "group_type": "ff",
+                                "buckets": [bucket(output(1), watch_port=1),
+                                            bucket(output(2), watch_port=2)]}])
+        interfaces = {1: MagicMock(), 2: MagicMock()}
+        interfaces[1].is_active.return_value = False
+        self.switch.get_interface_by_port_no.side_effect = interfaces.get
+        outputs = self.groups.outputs(self.switch, 1, {})
+        assert [port for _, port, _ in outputs] == [2]
+
+        interfaces[2].is_active.return_value = False
+        assert not self.groups.outputs(self.switch, 1, {})
+
+    def test_outputs_chained(self):
+        """Test groups sending a packet to other groups."""
+        self.groups.set(DPID, [
+            {"group_id": 1, "group_type": "select",
+             "buckets": [bucket({"action_type": "group", "group_id": 2}),
+                         bucket(output(3))]},
+            {"group_id": 2, "group_type": "all",
+             "buckets": [bucket(output(1)),
+                         bucket({"action_type": "group", "group_id": 1})]},
+        ])
+        outputs = self.groups.outputs(self.switch, 1, {})
+        assert [port for _, port, _ in outputs] == [1, 3]
+        assert [branch["group"] for branch in outputs[0][2]] == [1, 2]
+        assert not self.groups.outputs(self.switch, 3, {})
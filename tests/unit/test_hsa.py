@@ -0,0 +1,282 @@
+"""Module to test the hsa.py file."""
+import itertools
+from unittest.mock import MagicMock
+
+import pytest
+from kytos.lib.helpers import (get_controller_mock, get_interface_mock,
+                               get_link_mock, get_switch_mock)
+
+from napps.amlight.sdntrace_cp import hsa
+
+
+def contains(cube, packet):
+    """Whether a cube contains a concrete packet, given as plain entries."""
+    for name, state in cube.items():
+        value = packet.get(name)
+        if name == 'dl_vlan':
+            value = value or []
+            if len(value) != len(state) or any(
+                vlan & mask != vid & mask
+                for vlan, (vid, mask) in zip(value, state)
+            ):
+                return False
+        elif state is None:
+            if value is not None:
+                return False
+        elif value is None or value & state[1] != state[0]:
+            return False
+    return True
+
+
+class TestTernary:
+    """Test the ternary bit vector operations."""
+
+    def test_intersect(self):
+        """Test intersecting ternary values."""
+        assert hsa.ternary_intersect((0b1000, 0b1000), (0b0001, 0b0011)) \
+            == (0b1001, 0b1011)
+        assert hsa.ternary_intersect((0b1, 0b1), (0b0, 0b1)) is hsa.EMPTY
+
+    def test_subtract(self):
+        """Test that subtracting ternary values gives disjoint pieces."""
+        pieces = hsa.ternary_subtract((0, 0), (0b101, 0b111))
+        values = {value for value in range(8)
+                  if any(value & mask == vid for vid, mask in pieces)}
+        assert values == set(range(8)) - {0b101}
+        assert sum(8 >> bin(mask).count('1') for _, mask in pieces) == 7
+        assert not hsa.ternary_subtract((5, 7), (1, 1))
+        assert hsa.ternary_subtract((4, 7), (1, 1)) == [(4, 7)]
+
+    @pytest.mark.parametrize("low,high", [(0, 4095), (1, 4095), (100, 199),
+                                          (7, 7), (3, 12)])
+    def test_range_to_ternary(self, low, high):
+        """Test splitting ranges into ternary values."""
+        pieces = hsa.range_to_ternary(low, high, 12)
+        values = [value for value in range(4096)
+                  if any(value & mask == vid for vid, mask in pieces)]
+        assert values == list(range(low, high + 1))
+
+    def test_ingress_cube(self):
+        """Test tracking the ingress VLANs of a cube through actions."""
+        cube = {'dl_vlan': ((10, 4095), (20, 4095)), '_vlan_kept': 2}
+        cube = hsa.apply_actions(cube, [
+            {'action_type': 'set_vlan', 'vlan_id': 30},
+            {'action_type': 'push_vlan'},
+            {'action_type': 'pop_vlan'},
+            {'action_type': 'pop_vlan'},
+        ])
+        assert cube['dl_vlan'] == ((10, 4095),)
+        assert hsa.ingress_cube(cube) == {
+            'dl_vlan': ((10, 4095), (20, 4095))
+        }
+
+    def test_parse_header_space(self):
+        """Test parsing the fields of a symbolic trace."""
+        cubes = hsa.parse_header_space({
+            'dpid': '00:00:00:00:00:00:00:01', 'in_port': 1,
+            'dl_vlan': ['96/4088'], 'tp_dst': [80, 443],
+            'nw_dst': '10.0.0.0/8',
+        })
+        assert cubes == [
+            {'dl_vlan': ((96, 4088),), 'tp_dst': (port, 0xffff),
+             'nw_dst': (0x0a000000, 0xff000000)}
+            for port in (80, 443)
+        ]
+        assert hsa.format_cube(cubes[0]) == {
+            'dl_vlan': ['96-103'], 'tp_dst': 80, 'nw_dst': '10.0.0.0/8'
+        }
+        with pytest.raises(ValueError):
+            hsa.parse_header_space({'nw_src': '2002:db8::1'})
+        with pytest.raises(ValueError):
+            hsa.parse_header_space({'dl_vlan': [5000]})
+
+
+class TestSymbolicTracer:
+    """Test the SymbolicTracer class."""
+
+    def setup_method(self):
+        """Execute steps before each test."""
+        self.switch1 = get_switch_mock("00:00:00:00:00:00:00:01", 0x04)
+        self.switch2 = get_switch_mock("00:00:00:00:00:00:00:02", 0x04)
+        iface1 = get_interface_mock("s1-eth2", 2, self.switch1)
+        iface2 = get_interface_mock("s2-eth1", 1, self.switch2)
+        link = get_link_mock(iface1, iface2)
+        iface1.link = link
+        iface2.link = link
+        ingress1 = get_interface_mock("s1-eth1", 1, self.switch1)
+        ingress1.link = None
+        edge1 = get_interface_mock("s1-eth3", 3, self.switch1)
+        edge1.link = None
+        edge2 = get_interface_mock("s2-eth2", 2, self.switch2)
+        edge2.link = None
+        interfaces1 = {1: ingress1, 2: iface1, 3: edge1}
+        interfaces2 = {1: iface2, 2: edge2}
+        self.switch1.interfaces = interfaces1
+        self.switch2.interfaces = interfaces2
+        self.switch1.get_interface_by_port_no.side_effect = interfaces1.get
+        self.switch2.get_interface_by_port_no.side_effect = interfaces2.get
+        switches = {self.switch1.dpid: self.switch1,
+                    self.switch2.dpid: self.switch2}
+        self.stored_flows = {
+            self.switch1.dpid: [
+                {"flow": {"match": {"in_port": 1, "dl_vlan": "100/4092"},
+                          "instructions": [
+                              {"instruction_type": "apply_actions",
+                               "actions": [{"action_type": "set_vlan",
+                                            "vlan_id": 200}]},
+                              {"instruction_type": "goto_table",
+                               "table_id": 1},
+                          ]}},
+                {"flow": {"match": {"in_port": 1, "dl_vlan": 0},
+                          "actions": [{"action_type": "output",
+                                       "port": 3}]}},
+                {"flow": {"table_id": 1, "match": {"tp_dst": 80},
+                          "actions": [{"action_type": "output",
+                                       "port": 2}]}},
+                {"flow": {"table_id": 1, "match": {"dl_type": 2048},
+                          "actions": [{"action_type": "pop_vlan"},
+                                      {"action_type": "output",
+                                       "port": 3}]}},
+            ],
+            self.switch2.dpid: [
+                {"flow": {"match": {"in_port": 1, "dl_vlan": 200},
+                          "actions": [{"action_type": "output",
+                                       "port": 2}]}},
+            ],
+        }
+        self.tracer = hsa.SymbolicTracer(switches.get, self.stored_flows)
+
+    def test_trace(self):
+        """Test the tree of paths of a header space."""
+        cubes = hsa.parse_header_space({'dl_vlan': ['98-101'],
+                                        'tp_dst': [80, 22]})
+        result = self.tracer.trace(self.switch1.dpid, 1, cubes)
+
+        assert result['type'] == 'starting'
+        branches = {(branch['type'], branch['out'] and branch['out']['port'])
+                    for branch in result['branches']}
+        assert branches == {('next', 2), ('no_match', None)}
+        forwarded = [branch for branch in result['branches']
+                     if branch['type'] == 'next'][0]
+        assert forwarded['headers'] == [{'dl_vlan': ['100-101'],
+                                         'tp_dst': 80}]
+        assert forwarded['out']['headers'] == [{'dl_vlan': [200],
+                                                'tp_dst': 80}]
+        step = forwarded['next']
+        assert (step['dpid'], step['port']) == (self.switch2.dpid, 1)
+        assert [branch['type'] for branch in step['branches']] == ['last']
+
+    def test_trace_differential(self):
+        """Test that every packet of a header space takes the branch of the
+        concrete trace."""
+        # pylint: disable=import-outside-toplevel
+        from napps.amlight.sdntrace_cp.main import Main
+        napp = Main(get_controller_mock())
+        cubes = hsa.parse_header_space({'dl_vlan': ['96-103'],
+                                        'tp_dst': [80, 22],
+                                        'dl_type': [2048, 2054]})
+        paths = self.tracer.switch_paths(self.switch1, 1, cubes)
+        packets = [
+            {'dl_vlan': [vlan], 'tp_dst': tp_dst, 'dl_type': dl_type}
+            for vlan, tp_dst, dl_type in itertools.product(
+                range(96, 104), (80, 22), (2048, 2054))
+        ]
+        for packet in packets:
+            flow, entries, port = napp.match_and_apply(
+                self.switch1, {**packet, 'in_port': 1,
+                               'dl_vlan': list(packet['dl_vlan'])},
+                self.stored_flows
+            )
+            matched = [(actions, cube) for actions, path_cubes in paths
+                       for cube in path_cubes if contains(cube, packet)]
+            assert len(matched) == 1
+            actions, cube = matched[0]
+            if not flow:
+                assert actions is None
+                continue
+            assert [port_ for _, port_ in
+                    hsa.output_actions(actions)][-1:] == [port]
+            vlan = hsa.apply_actions(cube, actions)['dl_vlan']
+            assert [vid for vid, _ in vlan] == entries.get('dl_vlan', [])
+
+    def test_trace_outputs(self):
+        """Test that headers are sent through every output action, with
+        FLOOD expanded as in concrete traces."""
+        for interface in self.switch1.interfaces.values():
+            interface.is_active.return_value = True
+        self.stored_flows[self.switch1.dpid][1]["flow"]["actions"] = [
+            {"action_type": "output", "port": 3},
+            {"action_type": "push_vlan"},
+            {"action_type": "set_vlan", "vlan_id": 200},
+            {"action_type": "output", "port": 2},
+        ]
+        cubes = hsa.parse_header_space({'dl_vlan': [0]})
+        branches = self.tracer.trace(self.switch1.dpid, 1,
+                                     cubes)['branches']
+        assert [(branch['type'], branch['out']['port'],
+                 branch['out']['headers'][0]['dl_vlan'])
+                for branch in branches] == [('last', 3, [0]),
+                                            ('next', 2, [0, 200])]
+        assert branches[1]['next']['branches'][0]['type'] == 'last'
+        headers = self.tracer.reverse(self.switch2.dpid, 2)[0]['headers']
+        assert [cube['dl_vlan'] for cube in headers] == [['100-103'], [],
+                                                         [0]]
+
+        self.stored_flows[self.switch1.dpid][1]["flow"]["actions"] = [
+            {"action_type": "output", "port": "flood"},
+        ]
+        self.tracer = hsa.SymbolicTracer(self.tracer.get_switch,
+                                         self.stored_flows)
+        branches = self.tracer.trace(self.switch1.dpid, 1,
+                                     cubes)['branches']
+        assert [branch['out']['port'] for branch in branches] == [2, 3]
+        headers = self.tracer.reverse(self.switch1.dpid, 3)[0]['headers']
+        assert [] in [cube['dl_vlan'] for cube in headers]
+
+    def test_trace_loop_and_no_switch(self):
+        """Test loops and unknown switches."""
+        self.stored_flows[self.switch2.dpid][0]["flow"]["actions"][0][
+            "port"] = 1
+        self.stored_flows[self.switch1.dpid].append(
+            {"flow": {"match": {"in_port": 2},
+                      "actions": [{"action_type": "output", "port": 2}]}}
+        )
+        cubes = hsa.parse_header_space({'dl_vlan': [100], 'tp_dst': [80]})
+        result = self.tracer.trace(self.switch1.dpid, 1, cubes)
+        step = result['branches'][0]['next']['branches'][0]['next']
+        assert (step['dpid'], step['port']) == (self.switch1.dpid, 2)
+        assert step['branches'][0]['type'] == 'loop'
+
+        tracer = hsa.SymbolicTracer(MagicMock(return_value=None), {})
+        result = tracer.trace("00:00:00:00:00:00:00:03", 1, cubes)
+        assert result['type'] == 'last'
+        assert not result['branches']
+
+    def test_trace_wrong_goto(self):
+        """Test that a goto_table backwards raises ValueError."""
+        self.stored_flows[self.switch1.dpid][0]["flow"]["instructions"][1][
+            "table_id"] = 0
+        cubes = hsa.parse_header_space({'dl_vlan': [100]})
+        with pytest.raises(ValueError):
+            self.tracer.trace(self.switch1.dpid, 1, cubes)
+
+    def test_reverse(self):
+        """Test finding the ingress headers that reach an egress port."""
+        result = self.tracer.reverse(self.switch2.dpid, 2)
+        assert len(result) == 1
+        assert (result[0]['dpid'], result[0]['port']) == (self.switch1.dpid,
+                                                          1)
+        headers = result[0]['headers']
+        assert len(headers) == 1
+        assert headers[0]['dl_vlan'] == ['100-103']
+        assert headers[0]['tp_dst'] == 80
+        assert headers[0]['dl_type'] is None
+
+        result = self.tracer.reverse(self.switch1.dpid, 3)
+        vlans = [cube['dl_vlan'] for cube in result[0]['headers']]
+        assert [] in vlans
+        # dl_vlan 0 also matches packets tagged with VLAN ID 0
+        assert all(vlan in ([], [0], ['100-103']) for vlan in vlans)
+        assert all(cube.get('tp_dst') != 80 for cube in result[0]['headers']
+                   if cube['dl_vlan'] == ['100-103'])
+        assert not self.tracer.reverse(self.switch1.dpid, 1)
@@ -0,0 +1,88 @@
+"""Module to test the jobs.py file."""
+from threading import Event
+from unittest.mock import MagicMock
+
+import pytest
+
+from napps.amlight.sdntrace_cp.jobs import JobsLimitError, TraceJobs
+
+
+class TestTraceJobs:
+    """Test the TraceJobs class."""
+
+    def setup_method(self):
+        """Execute steps before each test."""
+        self.run_trace = MagicMock(side_effect=lambda entry, _: [entry])
+        self.jobs = TraceJobs(self.run_trace, max_running=1, max_stored=2)
+
+    def teardown_method(self):
+        """Execute steps after each test."""
+        self.jobs.shutdown()
+
+    def test_submit(self):
+        """Test a job running all its entries."""
+        stored_flows = {"00:00:00:00:00:00:00:01": []}
+        job = self.jobs.submit([{"in_port": 1}, {"in_port": 2}],
+                               stored_flows)
+        job.future.result(timeout=5)
+
+        assert self.jobs.get(job.id) is job
+        assert job.status == "done"
+        assert job.results == [[{"in_port": 1}], [{"in_port": 2}]]
+        assert job.page(1, 10) == [[{"in_port": 2}]]
+        self.run_trace.assert_called_with({"in_port": 2}, stored_flows)
+        assert job.entries is None
+        assert job.stored_flows is None
+
+        job_dict = job.as_dict()
+        assert job_dict["id"] == job.id
+        assert job_dict["total"] == 2
+        assert job_dict["completed"] == 2
+        assert job_dict["finished_at"]
+
+    def test_submit_failed(self):
+        """Test a job failing when a trace raises ValueError."""
+        self.run_trace.side_effect = ValueError("Wrong table_id")
+        job = self.jobs.submit([{"in_port": 1}], {})
+        job.future.result(timeout=5)
+
+        assert job.status == "failed"
+        assert job.error == "Wrong table_id"
+        assert not job.results
+
+    def test_cancel(self):
+        """Test cancelling a running and a pending job."""
+        started, release = Event(), Event()
+
+        def run_trace(entry, _):
+            started.set()
+            release.wait(5)
+            return [entry]
+
+        self.run_trace.side_effect = run_trace
+        running = self.jobs.submit([{"in_port": 1}, {"in_port": 2}], {})
+        pending = self.jobs.submit([{"in_port": 3}], {})
+        assert started.wait(5)
+
+        assert self.jobs.cancel(pending.id).status == "cancelled"
+        self.jobs.cancel(running.id)
+        release.set()
+        running.future.result(timeout=5)
+
+        assert running.status == "cancelled"
+        assert len(running.results) == 1
+        assert self.jobs.cancel("unknown") is None
+
+    def test_limit(self):
+        """Test that finished jobs are evicted and unfinished ones aren't."""
+        first = self.jobs.submit([], {})
+        first.future.result(timeout=5)
+        release = Event()
+        self.run_trace.side_effect = lambda entry, _: release.wait(5)
+        self.jobs.submit([{"in_port": 1}], {})
+        self.jobs.submit([{"in_port": 2}], {})
+
+        assert self.jobs.get(first.id) is None
+        with pytest.raises(JobsLimitError):
+            self.jobs.submit([{"in_port": 3}], {})
+        release.set()
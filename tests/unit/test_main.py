@@ -1,6 +1,8 @@
 """Module to test the main napp file."""
 import asyncio
 import pytest
+import tenacity
+import time
 from unittest.mock import patch, MagicMock
 
 from kytos.core.interface import Interface
@@ -12,6 +14,32 @@ from kytos.lib.helpers import (
     get_test_client,
 )
 from kytos.core.rest_api import HTTPException
+from napps.amlight.sdntrace_cp.jobs import JobsLimitError
+
+
+def get_topology_mock(count, links, edges):
+    """Return switches 1 to count by index, with an interface for each
+    (index_a, port_a, index_b, port_b) link and (index, port) edge."""
+    switches = {}
+    for index in range(1, count + 1):
+        switch = get_switch_mock(f"00:00:00:00:00:00:00:0{index}", 0x04)
+        switch.get_interface_by_port_no.side_effect = switch.interfaces.get
+        switches[index] = switch
+
+    def add_interface(index, port):
+        interface = get_interface_mock(f"eth{port}", port, switches[index])
+        interface.link = None
+        switches[index].interfaces[port] = interface
+        return interface
+
+    for index_a, port_a, index_b, port_b in links:
+        interface_a = add_interface(index_a, port_a)
+        interface_b = add_interface(index_b, port_b)
+        interface_a.link = interface_b.link = get_link_mock(interface_a,
+                                                            interface_b)
+    for index, port in edges:
+        add_interface(index, port)
+    return switches
 
 
 # pylint: disable=too-many-public-methods, too-many-lines
@@ -192,6 +220,34 @@ class TestMain:
         assert result[1]["in"]["type"] == "intermediary"
         assert result[1]["out"]["port"] == 3
 
+    @pytest.mark.parametrize("timing", ["trace", "step", "none"])
+    @patch("napps.amlight.sdntrace_cp.main.Main.trace_step")
+    def test_tracepath_timing(self, mock_trace_step, timing):
+        """Test tracepath setting the step times given a timing."""
+        entries = {"dpid": "00:00:00:00:00:00:00:01", "in_port": 1}
+        mock_trace_step.side_effect = [{
+            "dpid": "00:00:00:00:00:00:00:02",
+            "in_port": 2,
+            "out_port": 3,
+            "entries": {},
+        }, {
+            "out_port": 4,
+            "entries": {},
+        }]
+
+        result = self.napp.tracepath(entries, {}, timing)
+
+        assert len(result) == 2
+        times = [step["in"].get("time") for step in result]
+        if timing == "none":
+            assert times == [None, None]
+        elif timing == "trace":
+            assert times[0] == times[1]
+            assert isinstance(times[0], str)
+        else:
+            assert times[0] <= times[1]
+            assert isinstance(times[1], str)
+
     @patch("napps.amlight.sdntrace_cp.main.Main.trace_step")
     def test_tracepath_loop(self, mock_trace_step):
         """Test tracepath with success result."""
@@ -340,6 +396,43 @@ class TestMain:
         assert result[0]["vlan"] == 100
         assert result[0]["out"] == {"port": 2, "vlan": 200}
 
+    @patch("napps.amlight.sdntrace_cp.main.get_stored_flows")
+    async def test_trace_batched(self, mock_stored_flows):
+        """Test concurrent trace rest calls traced in a batch."""
+        self.napp.controller.loop = asyncio.get_running_loop()
+        self.napp.batcher.window = 5000
+        self.napp.batcher.max_entries = 3
+        stored_flow = {
+            "flow": {
+                "match": {"in_port": 1},
+                "actions": [{"action_type": "output", "port": 2}],
+            }
+        }
+        mock_stored_flows.return_value = {
+            "00:00:00:00:00:00:00:01": [stored_flow]
+        }
+        payloads = [{"trace": {"switch": {"dpid": "00:00:00:00:00:00:00:01",
+                                          "in_port": in_port}}}
+                    for in_port in (1, 3, 1)]
+        with patch.object(self.napp, "tracepath",
+                          wraps=self.napp.tracepath) as mock_tracepath:
+            responses = await asyncio.gather(*(
+                self.api_client.put(self.trace_endpoint, json=payload)
+                for payload in payloads
+            ))
+        assert mock_tracepath.call_count == 2
+        assert mock_stored_flows.call_count == 1
+        results = [resp.json()["result"] for resp in responses]
+        assert results[0] == results[2]
+        assert results[0][0]["out"] == {"port": 2}
+        assert not results[1]
+        assert self.napp.batcher.stats()["batches"] == 1
+
+        url = f"{self.trace_endpoint}?snapshot=1000"
+        self.napp.batcher.max_entries = 1
+        resp = await self.api_client.put(url, json=payloads[0])
+        assert resp.status_code == 404
+
     @patch("napps.amlight.sdntrace_cp.main.get_stored_flows")
     async def test_trace_instructions(self, mock_stored_flows):
         """Test trace rest call with instructions."""
@@ -579,6 +672,75 @@ class TestMain:
         resp = await self.api_client.put(self.traces_endpoint, json=payload)
         assert resp.status_code == 424
 
+    @patch("napps.amlight.sdntrace_cp.main.get_stored_flows")
+    async def test_traces_stale_snapshot(self, mock_stored_flows):
+        """Test traces using the latest snapshot when the stored flows
+        can't be fetched."""
+        self.napp.controller.loop = asyncio.get_running_loop()
+        self.napp.flow_source.failure_threshold = 2
+        payload = [{"trace": {"switch": {"dpid": "00:00:00:00:00:00:00:01",
+                                         "in_port": 1}}}]
+        stored_flow = {
+            "flow": {
+                "match": {"in_port": 1},
+                "actions": [{"action_type": "output", "port": 2}],
+            }
+        }
+        mock_stored_flows.return_value = {
+            "00:00:00:00:00:00:00:01": [stored_flow]
+        }
+        resp = await self.api_client.put(self.traces_endpoint, json=payload)
+        assert resp.status_code == 200
+        version = resp.json()["snapshot"]
+
+        mock_stored_flows.side_effect = tenacity.RetryError(MagicMock())
+        resp = await self.api_client.put(self.traces_endpoint, json=payload)
+        assert resp.status_code == 200
+        assert resp.json()["snapshot"] == version
+        assert resp.json()["staleness"] >= 0
+        assert resp.json()["result"][0][0]["out"] == {"port": 2}
+
+        url = f"{self.traces_endpoint}?max_staleness=0"
+        with patch("napps.amlight.sdntrace_cp.snapshot.monotonic",
+                   return_value=10 ** 9):
+            resp = await self.api_client.put(url, json=payload)
+        assert resp.status_code == 424
+        assert self.napp.flow_source.stats()["state"] == "open"
+
+        calls = mock_stored_flows.call_count
+        resp = await self.api_client.put(self.traces_endpoint, json=payload)
+        assert resp.status_code == 200
+        assert mock_stored_flows.call_count == calls
+        assert self.napp.flow_source.stats()["rejected"] == 1
+
+    @patch("napps.amlight.sdntrace_cp.snapshot.monotonic")
+    @patch("napps.amlight.sdntrace_cp.main.get_stored_flows")
+    async def test_traces_stale_refetched(self, mock_stored_flows,
+                                          mock_monotonic):
+        """Test the staleness of a snapshot counts from the last fetch of
+        its flows, even when they didn't change."""
+        self.napp.controller.loop = asyncio.get_running_loop()
+        payload = [{"trace": {"switch": {"dpid": "00:00:00:00:00:00:00:01",
+                                         "in_port": 1}}}]
+        mock_stored_flows.return_value = {"00:00:00:00:00:00:00:01": [{
+            "flow": {"match": {"in_port": 1},
+                     "actions": [{"action_type": "output", "port": 2}]}
+        }]}
+        mock_monotonic.return_value = 100
+        resp = await self.api_client.put(self.traces_endpoint, json=payload)
+        version = resp.json()["snapshot"]
+
+        mock_monotonic.return_value = 200
+        resp = await self.api_client.put(self.traces_endpoint, json=payload)
+        assert resp.json()["snapshot"] == version
+
+        mock_stored_flows.side_effect = tenacity.RetryError(MagicMock())
+        mock_monotonic.return_value = 250
+        resp = await self.api_client.put(self.traces_endpoint, json=payload)
+        assert resp.status_code == 200
+        assert resp.json()["snapshot"] == version
+        assert resp.json()["staleness"] == 50
+
     @patch("napps.amlight.sdntrace_cp.main.get_stored_flows")
     async def test_traces_with_loop(self, mock_stored_flows):
         """Test traces rest call"""
@@ -1732,3 +1894,690 @@ class TestMain:
         assert result[2]['vlan'] == 1
         assert result[2]['out']['port'] == 15
         assert result[2]['out']['vlan'] == 100
+
+    @patch("napps.amlight.sdntrace_cp.main.get_stored_flows")
+    async def test_trace_jobs(self, mock_stored_flows):
+        """Test submitting, polling and fetching a bulk trace job."""
+        self.napp.controller.loop = asyncio.get_running_loop()
+        payload = [{
+            "trace": {
+                "switch": {
+                    "dpid": "00:00:00:00:00:00:00:01",
+                    "in_port": in_port
+                    },
+                "eth": {"dl_vlan": 100},
+            }
+        } for in_port in (1, 2, 1)]
+        stored_flow = {
+            "flow": {
+                "match": {"dl_vlan": 100, "in_port": 1},
+                "actions": [{"action_type": "output", "port": 2}],
+            }
+        }
+        mock_stored_flows.return_value = {
+            "00:00:00:00:00:00:00:01": [stored_flow]
+        }
+        jobs_endpoint = f"{self.traces_endpoint}/jobs"
+
+        resp = await self.api_client.post(jobs_endpoint, json=payload)
+        assert resp.status_code == 202
+        job_id = resp.json()["id"]
+        assert resp.json()["total"] == 3
+        self.napp.jobs.get(job_id).future.result(timeout=5)
+
+        resp = await self.api_client.get(f"{jobs_endpoint}/{job_id}")
+        assert resp.status_code == 200
+        assert resp.json()["status"] == "done"
+        assert resp.json()["completed"] == 3
+
+        resp = await self.api_client.get(jobs_endpoint)
+        assert [job["id"] for job in resp.json()["jobs"]] == [job_id]
+
+        url = f"{jobs_endpoint}/{job_id}/results?offset=1&limit=5"
+        resp = await self.api_client.get(url)
+        assert resp.status_code == 200
+        current_data = resp.json()
+        assert current_data["offset"] == 1
+        assert current_data["completed"] == 3
+        result = current_data["result"]
+        assert len(result) == 2
+        assert result[0] == []
+        assert result[1][0]["port"] == 1
+        assert result[1][0]["out"] == {"port": 2, "vlan": 100}
+
+        url = f"{jobs_endpoint}/{job_id}/results?limit=-1"
+        resp = await self.api_client.get(url)
+        assert resp.status_code == 400
+
+        resp = await self.api_client.delete(f"{jobs_endpoint}/{job_id}")
+        assert resp.status_code == 200
+        assert resp.json()["status"] == "done"
+
+        resp = await self.api_client.get(f"{jobs_endpoint}/unknown")
+        assert resp.status_code == 404
+        resp = await self.api_client.delete(f"{jobs_endpoint}/unknown")
+        assert resp.status_code == 404
+
+    async def test_traces_admission(self):
+        """Test trace rest calls rejected by admission control."""
+        self.napp.controller.loop = asyncio.get_running_loop()
+        payload = {"trace": {"switch": {"dpid": "00:00:00:00:00:00:00:01",
+                                        "in_port": 1}}}
+        self.napp.admission.max_requests = 0
+        for url, method, json in (
+            (self.trace_endpoint, "put", payload),
+            (self.traces_endpoint, "put", [payload]),
+            (f"{self.traces_endpoint}/jobs", "post", [payload]),
+            (f"{self.trace_endpoint}/symbolic", "put", payload),
+            (f"{self.trace_endpoint}/reverse", "put",
+             {"egress": {"dpid": "00:00:00:00:00:00:00:01", "port": 2}}),
+            (f"{self.base_endpoint}/watched_traces", "post", payload),
+        ):
+            resp = await getattr(self.api_client, method)(url, json=json)
+            assert resp.status_code == 429
+            assert resp.headers["Retry-After"] == "1"
+
+        self.napp.admission.max_requests = 1
+        self.napp.admission.max_entries = 2
+        resp = await self.api_client.put(self.traces_endpoint,
+                                         json=[payload] * 3)
+        assert resp.status_code == 413
+        assert self.napp.admission.stats()["requests"] == 0
+
+    @patch("napps.amlight.sdntrace_cp.main.get_stored_flows")
+    async def test_trace_jobs_limit(self, mock_stored_flows):
+        """Test submitting a bulk trace job when the store is full."""
+        self.napp.controller.loop = asyncio.get_running_loop()
+        mock_stored_flows.return_value = {}
+        self.napp.jobs.submit = MagicMock(side_effect=JobsLimitError("full"))
+        resp = await self.api_client.post(f"{self.traces_endpoint}/jobs",
+                                          json=[])
+        assert resp.status_code == 429
+        assert self.napp.admission.stats()["requests"] == 0
+
+        self.napp.jobs.submit.side_effect = RuntimeError("failed")
+        with pytest.raises(RuntimeError):
+            await self.api_client.post(f"{self.traces_endpoint}/jobs",
+                                       json=[])
+        assert self.napp.admission.stats()["requests"] == 0
+
+    @patch("napps.amlight.sdntrace_cp.main.get_stored_flows")
+    async def test_traces_compact(self, mock_stored_flows):
+        """Test traces rest call with the compact format."""
+        self.napp.controller.loop = asyncio.get_running_loop()
+        payload = [{
+            "trace": {
+                "switch": {
+                    "dpid": "00:00:00:00:00:00:00:01",
+                    "in_port": in_port
+                    },
+                "eth": {"dl_vlan": 100},
+            }
+        } for in_port in (1, 2, 1)]
+        stored_flow = {
+            "flow": {
+                "match": {"dl_vlan": 100, "in_port": 1},
+                "actions": [{"action_type": "output", "port": 2}],
+            }
+        }
+        mock_stored_flows.return_value = {
+            "00:00:00:00:00:00:00:01": [stored_flow]
+        }
+
+        url = f"{self.traces_endpoint}?format=compact"
+        resp = await self.api_client.put(url, json=payload)
+        assert resp.status_code == 200
+        result = resp.json()["result"]
+        assert result["dpids"] == ["00:00:00:00:00:00:00:01"]
+        assert result["paths"] == [
+            {"steps": [[0, 1, 2, 100]], "out": [2, 100]},
+            {"steps": [], "out": None},
+        ]
+        assert result["traces"] == [0, 1, 0]
+        assert resp.json()["dedup"] == {"entries": 3, "distinct": 2}
+
+        url = f"{self.trace_endpoint}?format=compact"
+        resp = await self.api_client.put(url, json=payload[0])
+        assert resp.status_code == 200
+        assert resp.json()["result"]["traces"] == [0]
+
+        url = f"{self.traces_endpoint}?format=xml"
+        resp = await self.api_client.put(url, json=payload)
+        assert resp.status_code == 400
+
+    async def test_traces_invalid_entries(self):
+        """Test traces rest call with an invalid entry."""
+        self.napp.controller.loop = asyncio.get_running_loop()
+        payload = [{
+            "trace": {
+                "switch": {
+                    "dpid": "00:00:00:00:00:00:00:01",
+                    "in_port": 1
+                    },
+                "eth": {"dl_vlan": 5000},
+            }
+        }]
+        resp = await self.api_client.put(self.traces_endpoint, json=payload)
+        assert resp.status_code == 400
+        assert "maximum of 4095" in resp.json()["description"]
+
+    @patch("napps.amlight.sdntrace_cp.main.get_stored_flows")
+    async def test_traces_sweep(self, mock_stored_flows):
+        """Test traces rest call with swept fields."""
+        self.napp.controller.loop = asyncio.get_running_loop()
+        payload = [{
+            "trace": {
+                "switch": {
+                    "dpid": "00:00:00:00:00:00:00:01",
+                    "in_port": 1
+                    },
+                "eth": {"dl_vlan": {"from": 1, "to": 4095}},
+            }
+        }]
+        stored_flow = {
+            "flow": {
+                "match": {"dl_vlan": 100, "in_port": 1},
+                "actions": [{"action_type": "output", "port": 2}],
+            }
+        }
+        mock_stored_flows.return_value = {
+            "00:00:00:00:00:00:00:01": [stored_flow]
+        }
+        with patch.object(self.napp, "tracepath",
+                          wraps=self.napp.tracepath) as mock_tracepath:
+            resp = await self.api_client.put(self.traces_endpoint,
+                                             json=payload)
+        assert resp.status_code == 200
+        sweep = resp.json()["result"][0]
+        assert mock_tracepath.call_count == 2
+        assert sweep["fields"] == ["dl_vlan"]
+        assert sweep["headers"] == 4095
+        assert sweep["traced"] == 2
+        assert [outcome["headers"] for outcome in sweep["outcomes"]] == [
+            [[[1, 99]], [[101, 4095]]], [[100]]
+        ]
+        assert sweep["outcomes"][0]["result"] == []
+        assert sweep["outcomes"][1]["result"][0]["out"] == {
+            "port": 2, "vlan": 100
+        }
+
+        url = f"{self.traces_endpoint}?format=compact"
+        resp = await self.api_client.put(url, json=payload)
+        result = resp.json()["result"]
+        assert result["paths"] == [
+            {"steps": [], "out": None},
+            {"steps": [[0, 1, 2, 100]], "out": [2, 100]},
+        ]
+        assert [outcome["path"] for outcome in
+                result["traces"][0]["outcomes"]] == [0, 1]
+
+        payload[0]["trace"]["switch"]["in_port"] = list(range(1, 18))
+        resp = await self.api_client.put(self.traces_endpoint, json=payload)
+        assert resp.status_code == 400
+        assert "not 69615" in resp.json()["description"]
+
+        payload[0]["trace"]["switch"]["in_port"] = {"from": 2, "to": 1}
+        resp = await self.api_client.put(self.traces_endpoint, json=payload)
+        assert resp.status_code == 400
+
+    def test_trace_sweep_vlans(self):
+        """Test swept VLAN IDs are grouped by outcome alike with and
+        without flow snapshots, each header with its own VLAN ID."""
+        dpid = "00:00:00:00:00:00:00:01"
+        stored_flows = {dpid: [
+            {"flow": {"priority": 20, "match": {"dl_vlan": 12, "in_port": 1},
+                      "actions": [{"action_type": "set_vlan",
+                                   "vlan_id": 100},
+                                  {"action_type": "output", "port": 2}]}},
+            {"flow": {"priority": 10, "match": {"in_port": 1},
+                      "actions": [{"action_type": "output", "port": 2}]}},
+        ]}
+        entry = {"dpid": dpid, "in_port": 1,
+                 "sweep": {"dl_vlan": {"from": 10, "to": 13}}}
+        snapshot = self.napp.snapshots.publish(stored_flows)
+        for flows, traced in ((stored_flows, 4), (snapshot, 3)):
+            sweep = self.napp.trace_sweep(entry, flows)
+            assert sweep["traced"] == traced
+            assert [(outcome["headers"], outcome["result"][0]["out"])
+                    for outcome in sweep["outcomes"]] == [
+                ([[[10, 11]], [13]], {"port": 2, "vlan": 10}),
+                ([[12]], {"port": 2, "vlan": 100}),
+            ]
+
+    def test_trace_sweep_set_vlan(self):
+        """Test swept VLAN IDs set to a swept one by a flow are grouped by
+        outcome alike with and without flow snapshots."""
+        dpid = "00:00:00:00:00:00:00:01"
+        stored_flows = {dpid: [
+            {"flow": {"match": {"in_port": 1},
+                      "actions": [{"action_type": "set_vlan", "vlan_id": 11},
+                                  {"action_type": "output", "port": 2}]}},
+        ]}
+        entry = {"dpid": dpid, "in_port": 1,
+                 "sweep": {"dl_vlan": {"from": 11, "to": 13}}}
+        snapshot = self.napp.snapshots.publish(stored_flows)
+        sweeps = [self.napp.trace_sweep(entry, flows)
+                  for flows in (stored_flows, snapshot)]
+        for sweep in sweeps:
+            assert [(outcome["headers"], outcome["result"][0]["out"])
+                    for outcome in sweep["outcomes"]] == [
+                ([[11]], {"port": 2, "vlan": 11}),
+                ([[[12, 13]]], {"port": 2, "vlan": 11}),
+            ]
+        assert sweeps[1]["traced"] == 3
+
+    @patch("napps.amlight.sdntrace_cp.main.get_stored_flows")
+    async def test_symbolic_trace(self, mock_stored_flows):
+        """Test symbolic trace rest call."""
+        self.napp.controller.loop = asyncio.get_running_loop()
+        payload = {
+            "trace": {
+                "switch": {
+                    "dpid": "00:00:00:00:00:00:00:01",
+                    "in_port": 1
+                    },
+                "eth": {"dl_vlan": "100-103"},
+            }
+        }
+        stored_flow = {
+            "flow": {
+                "match": {"dl_vlan": "100/4094", "in_port": 1},
+                "actions": [{"action_type": "output", "port": 2}],
+            }
+        }
+        mock_stored_flows.return_value = {
+            "00:00:00:00:00:00:00:01": [stored_flow]
+        }
+
+        url = f"{self.trace_endpoint}/symbolic"
+        resp = await self.api_client.put(url, json=payload)
+        assert resp.status_code == 200
+        result = resp.json()["result"]
+        assert result["dpid"] == "00:00:00:00:00:00:00:01"
+        assert result["branches"] == [
+            {"headers": [{"dl_vlan": ["100-101"]}], "type": "last",
+             "out": {"port": 2, "headers": [{"dl_vlan": ["100-101"]}]}},
+            {"headers": [{"dl_vlan": ["102-103"]}], "type": "no_match",
+             "out": None},
+        ]
+
+        payload["trace"]["eth"]["dl_vlan"] = "abc"
+        resp = await self.api_client.put(url, json=payload)
+        assert resp.status_code == 400
+
+    @patch("napps.amlight.sdntrace_cp.main.get_stored_flows")
+    async def test_reverse_trace(self, mock_stored_flows):
+        """Test reverse trace rest call."""
+        self.napp.controller.loop = asyncio.get_running_loop()
+        switch = self.napp.controller.switches["00:00:00:00:00:00:00:01"]
+        switch.interfaces = {1: switch.get_interface_by_port_no.return_value}
+        mock_stored_flows.return_value = {
+            "00:00:00:00:00:00:00:01": [{
+                "flow": {
+                    "match": {"dl_vlan": 100, "in_port": 1},
+                    "actions": [{"action_type": "output", "port": 2}],
+                }
+            }]
+        }
+        payload = {"egress": {"dpid": "00:00:00:00:00:00:00:01", "port": 2}}
+
+        url = f"{self.trace_endpoint}/reverse"
+        resp = await self.api_client.put(url, json=payload)
+        assert resp.status_code == 200
+        response = resp.json()
+        assert response["egress"] == payload["egress"]
+        assert len(response["result"]) == 1
+        assert response["result"][0]["port"] == 1
+        assert [cube["dl_vlan"] for cube in response["result"][0]["headers"]] \
+            == [[100]]
+
+    @patch("napps.amlight.sdntrace_cp.main.get_stored_flows")
+    async def test_watched_traces(self, mock_stored_flows):
+        """Test watched traces rest calls and flow events."""
+        self.napp.controller.loop = asyncio.get_running_loop()
+        dpid = "00:00:00:00:00:00:00:01"
+        payload = {"trace": {"switch": {"dpid": dpid, "in_port": 1},
+                             "eth": {"dl_vlan": 100}}}
+        stored_flow = {
+            "flow": {
+                "table_id": 0,
+                "priority": 10,
+                "match": {"dl_vlan": 100, "in_port": 1},
+                "actions": [{"action_type": "output", "port": 2}],
+            }
+        }
+        mock_stored_flows.return_value = {}
+
+        endpoint = f"{self.base_endpoint}/watched_traces"
+        resp = await self.api_client.post(endpoint, json=payload)
+        assert resp.status_code == 201
+        watch_id = resp.json()["id"]
+        assert resp.json()["result"] == []
+
+        mock_stored_flows.return_value = {dpid: [stored_flow]}
+        flow = MagicMock(id="f1")
+        flow.as_dict.return_value = stored_flow["flow"]
+        switch = self.napp.controller.switches[dpid]
+        event = MagicMock(content={"datapath": switch, "flow": flow})
+        event.name = "kytos/flow_manager.flow.added"
+        self.napp.controller.buffers.app.put = MagicMock()
+        self.napp.snapshot_builder.schedule = MagicMock()
+        self.napp.handle_flow_changed(event)
+        self.napp.snapshot_builder.schedule.assert_called()
+
+        sent = self.napp.controller.buffers.app.put.call_args[0][0]
+        assert sent.name == "amlight/sdntrace_cp.watched_trace.changed"
+        assert sent.content["id"] == watch_id
+        assert sent.content["previous"] == []
+        assert sent.content["result"][0]["out"] == {"port": 2, "vlan": 100}
+
+        resp = await self.api_client.get(f"{endpoint}/{watch_id}")
+        assert resp.status_code == 200
+        assert resp.json()["changes"] == 1
+
+        self.napp.controller.buffers.app.put.reset_mock()
+        self.napp.handle_flow_changed(event)
+        self.napp.controller.buffers.app.put.assert_not_called()
+
+        response = await self.napp.stream_watched_traces(MagicMock())
+        assert response.media_type == "text/event-stream"
+        assert len(self.napp.watched_stream) == 1
+        self.napp.watched_stream.max_subscribers = 1
+        resp = await self.api_client.get(
+            f"{self.base_endpoint}/stream/watched_traces"
+        )
+        assert resp.status_code == 429
+
+        resp = await self.api_client.get(endpoint)
+        assert len(resp.json()["watched_traces"]) == 1
+
+        resp = await self.api_client.delete(f"{endpoint}/{watch_id}")
+        assert resp.status_code == 200
+        resp = await self.api_client.get(f"{endpoint}/{watch_id}")
+        assert resp.status_code == 404
+
+    @patch("napps.amlight.sdntrace_cp.main.get_stored_flows")
+    async def test_trace_pinned_snapshot(self, mock_stored_flows):
+        """Test traces reporting and pinning flow snapshots."""
+        self.napp.controller.loop = asyncio.get_running_loop()
+        payload = {"trace": {"switch": {"dpid": "00:00:00:00:00:00:00:01",
+                                        "in_port": 1}}}
+        stored_flow = {
+            "flow": {
+                "match": {"in_port": 1},
+                "actions": [{"action_type": "output", "port": 2}],
+            }
+        }
+        mock_stored_flows.return_value = {
+            "00:00:00:00:00:00:00:01": [stored_flow]
+        }
+        resp = await self.api_client.put(self.trace_endpoint, json=payload)
+        assert resp.status_code == 200
+        version = resp.json()["snapshot"]
+        assert resp.json()["result"][0]["out"] == {"port": 2}
+
+        mock_stored_flows.return_value = {"00:00:00:00:00:00:00:01": []}
+        resp = await self.api_client.put(self.trace_endpoint, json=payload)
+        assert resp.json()["snapshot"] == version + 1
+        assert resp.json()["result"] == []
+
+        url = f"{self.trace_endpoint}?snapshot={version}"
+        resp = await self.api_client.put(url, json=payload)
+        assert resp.json()["snapshot"] == version
+        assert resp.json()["result"][0]["out"] == {"port": 2}
+
+        url = f"{self.traces_endpoint}?snapshot=1000"
+        resp = await self.api_client.put(url, json=[payload])
+        assert resp.status_code == 404
+
+        resp = await self.api_client.get(f"{self.base_endpoint}/snapshots")
+        assert [snapshot["version"] for snapshot in
+                resp.json()["snapshots"]] == [version, version + 1]
+
+    @patch("napps.amlight.sdntrace_cp.main.get_stored_flows")
+    async def test_trace_tracked_snapshot(self, mock_stored_flows):
+        """Test traces reading the latest snapshot built in background."""
+        self.napp.controller.loop = asyncio.get_running_loop()
+        payload = {"trace": {"switch": {"dpid": "00:00:00:00:00:00:00:01",
+                                        "in_port": 1}}}
+        stored_flow = {
+            "flow": {
+                "match": {"in_port": 1},
+                "actions": [{"action_type": "output", "port": 2}],
+            }
+        }
+        mock_stored_flows.return_value = {
+            "00:00:00:00:00:00:00:01": [stored_flow]
+        }
+        self.napp.execute()
+        deadline = time.monotonic() + 2
+        while not self.napp.snapshot_builder.rebuilds and \
+                time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        mock_stored_flows.reset_mock()
+
+        resp = await self.api_client.put(self.trace_endpoint, json=payload)
+        assert resp.status_code == 200
+        assert resp.json()["result"][0]["out"] == {"port": 2}
+        assert resp.json()["snapshot"] == 1
+        mock_stored_flows.assert_not_called()
+
+        self.napp.snapshot_builder.pending = 1
+        mock_stored_flows.return_value = {"00:00:00:00:00:00:00:01": []}
+        resp = await self.api_client.put(self.trace_endpoint, json=payload)
+        assert resp.json()["snapshot"] == 2
+        assert resp.json()["result"] == []
+
+        resp = await self.api_client.get(f"{self.base_endpoint}/stats")
+        assert resp.status_code == 200
+        assert resp.json()["snapshot"]["version"] == 2
+        assert resp.json()["snapshot_builder"]["tracking"]
+        assert resp.json()["snapshot_builder"]["rebuilds"] == 1
+        assert resp.json()["pipeline_cache"]["misses"] == 1
+
+        self.napp.snapshot_builder.pending = 0
+        flow = MagicMock(id="f1")
+        flow.as_dict.return_value = stored_flow["flow"]
+        switch = self.napp.controller.switches["00:00:00:00:00:00:00:01"]
+        event = MagicMock(content={"datapath": switch, "flow": flow})
+        event.name = "kytos/flow_manager.flow.added"
+        self.napp.handle_flow_changed(event)
+        mock_stored_flows.reset_mock()
+        resp = await self.api_client.put(self.trace_endpoint, json=payload)
+        assert resp.json()["snapshot"] == 3
+        assert resp.json()["result"][0]["out"] == {"port": 2}
+        mock_stored_flows.assert_not_called()
+
+        flow.as_dict.return_value = {
+            **stored_flow["flow"],
+            "actions": [{"action_type": "output", "port": 3}],
+        }
+        self.napp.handle_flow_changed(event)
+        resp = await self.api_client.put(self.trace_endpoint, json=payload)
+        assert resp.json()["snapshot"] == 4
+        assert resp.json()["result"][0]["out"] == {"port": 3}
+        assert self.napp.snapshots.latest.as_dict()["flows"] == 1
+        mock_stored_flows.assert_not_called()
+
+    @patch("napps.amlight.sdntrace_cp.main.get_stored_flows")
+    async def test_trace_groups(self, mock_stored_flows):
+        """Test traces branching on the buckets of a group."""
+        self.napp.controller.loop = asyncio.get_running_loop()
+        switch1 = self.napp.controller.switches["00:00:00:00:00:00:00:01"]
+        switch2 = self.napp.controller.switches["00:00:00:00:00:00:00:02"]
+        intf_sw1 = get_interface_mock("eth1", 1, switch1)
+        intf_sw1.link = None
+        intf3_sw1 = get_interface_mock("eth3", 3, switch1)
+        intf1_sw2 = get_interface_mock("eth1", 1, switch2)
+        intf3_sw1.link = get_link_mock(intf3_sw1, intf1_sw2)
+        switch1.get_interface_by_port_no.side_effect = {
+            1: intf_sw1, 2: intf_sw1, 3: intf3_sw1
+        }.get
+        intf2_sw2 = get_interface_mock("eth2", 2, switch2)
+        intf2_sw2.link = None
+        switch2.get_interface_by_port_no.return_value = intf2_sw2
+        mock_stored_flows.return_value = {
+            "00:00:00:00:00:00:00:01": [{"flow": {
+                "match": {"in_port": 1},
+                "actions": [{"action_type": "output", "port": 4},
+                            {"action_type": "group", "group_id": 1}],
+            }}],
+            "00:00:00:00:00:00:00:02": [{"flow": {
+                "match": {"in_port": 1},
+                "actions": [{"action_type": "output", "port": 2}],
+            }}],
+        }
+        groups_endpoint = f"{self.base_endpoint}/groups"
+        group = {"group_id": 1, "group_type": "all", "buckets": [
+            {"actions": [{"action_type": "push_vlan"},
+                         {"action_type": "set_vlan", "vlan_id": 10},
+                         {"action_type": "output", "port": 2}]},
+            {"actions": [{"action_type": "output", "port": 3}]},
+        ]}
+        resp = await self.api_client.put(
+            f"{groups_endpoint}/{switch1.dpid}", json={"groups": [group]}
+        )
+        assert resp.status_code == 200
+        resp = await self.api_client.get(groups_endpoint)
+        assert resp.json()["groups"] == {switch1.dpid: [group]}
+
+        payload = {"trace": {"switch": {"dpid": switch1.dpid, "in_port": 1}}}
+        resp = await self.api_client.put(self.trace_endpoint, json=payload)
+        assert resp.status_code == 200
+        result = resp.json()["result"]
+        assert len(result) == 1
+        branches = result[0]["branches"]
+        assert [branch["out"] for branch in branches] == [
+            {"port": 2, "vlan": 10}, {"port": 3}
+        ]
+        assert [branch["type"] for branch in branches] == ["last", "next"]
+        assert branches[1]["groups"] == [
+            {"group": 1, "group_type": "all", "bucket": 1}
+        ]
+        assert [(step["dpid"], step["port"], step["type"], step["out"])
+                for step in branches[1]["result"]] == [
+            (switch2.dpid, 1, "last", {"port": 2})
+        ]
+
+        resp = await self.api_client.put(
+            f"{self.trace_endpoint}?format=compact", json=payload
+        )
+        branches = resp.json()["result"]["paths"][0]["branches"]
+        assert [branch["path"]["steps"] for branch in branches] == [
+            [], [[1, 1, 2]]
+        ]
+
+        group["group_type"] = "indirect"
+        await self.api_client.put(f"{groups_endpoint}/{switch1.dpid}",
+                                  json={"groups": [group]})
+        resp = await self.api_client.put(self.trace_endpoint, json=payload)
+        assert resp.json()["result"][0]["out"] == {"port": 2, "vlan": 10}
+        assert "branches" not in resp.json()["result"][0]
+
+        group["group_type"] = "fast"
+        resp = await self.api_client.put(f"{groups_endpoint}/{switch1.dpid}",
+                                         json={"groups": [group]})
+        assert resp.status_code == 400
+
+    @patch("napps.amlight.sdntrace_cp.main.get_stored_flows")
+    async def test_trace_flood(self, mock_stored_flows):
+        """Test traces exploring the copies of flooded packets breadth
+        first, each switch, port and packet fields once."""
+        self.napp.controller.loop = asyncio.get_running_loop()
+        switches = get_topology_mock(
+            5, ((1, 2, 2, 1), (1, 3, 3, 1), (2, 2, 4, 1), (3, 2, 4, 2),
+                (4, 3, 5, 1)), ((1, 1), (5, 2))
+        )
+        self.napp.controller.switches = {switch.dpid: switch
+                                         for switch in switches.values()}
+        flood = {"flow": {"match": {"dl_vlan": 100}, "actions": [
+            {"action_type": "output", "port": 0xfffffffb}
+        ]}}
+        mock_stored_flows.return_value = {switch.dpid: [flood]
+                                          for switch in switches.values()}
+
+        payload = {"trace": {"switch": {"dpid": switches[1].dpid,
+                                        "in_port": 1},
+                             "eth": {"dl_vlan": 100}}}
+        resp = await self.api_client.put(self.trace_endpoint, json=payload)
+        assert resp.status_code == 200
+        result = resp.json()["result"]
+        assert [branch["out"]["port"] for branch in result[0]["branches"]] \
+            == [2, 3]
+        first, second = result[0]["branches"]
+        assert [(step["dpid"], step["port"]) for step in first["result"]] == [
+            (switches[2].dpid, 1), (switches[4].dpid, 1)
+        ]
+        assert [(branch["out"]["port"], branch["type"])
+                for branch in first["result"][-1]["branches"]] == [
+            (2, "next"), (3, "next")
+        ]
+        assert first["result"][-1]["branches"][1]["result"] == [{
+            "dpid": switches[5].dpid, "port": 1, "type": "last",
+            "vlan": 100, "time": result[0]["time"],
+            "out": {"port": 2, "vlan": 100},
+        }]
+        assert [(step["dpid"], step["port"]) for step in second["result"]] \
+            == [(switches[3].dpid, 1), (switches[4].dpid, 2)]
+        assert [(branch["out"]["port"], branch["type"])
+                for branch in second["result"][-1]["branches"]] == [
+            (1, "next"), (3, "visited")
+        ]
+
+    def test_match_and_apply_outputs(self):
+        """Test the copies of a packet sent by several output actions."""
+        switch = self.napp.controller.switches["00:00:00:00:00:00:00:01"]
+        flow = {"flow": {"match": {"in_port": 1}, "actions": [
+            {"action_type": "output", "port": 2},
+            {"action_type": "push_vlan"},
+            {"action_type": "set_vlan", "vlan_id": 10},
+            {"action_type": "output", "port": 3},
+        ]}}
+        stored_flows = {switch.dpid: [flow]}
+        args = {"in_port": 1}
+        branches = []
+        assert self.napp.match_and_apply(switch, args, stored_flows,
+                                         branches=branches) == \
+            (flow, args, None)
+        assert branches == [({"in_port": 1}, 2, []),
+                            ({"in_port": 1, "dl_vlan": [10]}, 3, [])]
+        assert self.napp.match_and_apply(switch, {"in_port": 1},
+                                         stored_flows)[2] == 3
+
+    @patch("napps.amlight.sdntrace_cp.main.get_stored_flows")
+    async def test_trace_metadata(self, mock_stored_flows):
+        """Test traces through pipelines carrying metadata between
+        tables."""
+        self.napp.controller.loop = asyncio.get_running_loop()
+        mock_stored_flows.return_value = {"00:00:00:00:00:00:00:01": [
+            {"flow": {"match": {"in_port": 1}, "instructions": [
+                {"instruction_type": "write_metadata", "metadata": 0x15,
+                 "metadata_mask": 0xf0},
+                {"instruction_type": "goto_table", "table_id": 1},
+            ]}},
+            {"flow": {"match": {"in_port": 2}, "instructions": [
+                {"instruction_type": "goto_table", "table_id": 1},
+            ]}},
+            {"flow": {"table_id": 1, "priority": 20,
+                      "match": {"metadata": "0x10/0xf0"}, "actions": [
+                          {"action_type": "output", "port": 3}]}},
+            {"flow": {"table_id": 1, "priority": 10,
+                      "match": {"metadata": 0}, "actions": [
+                          {"action_type": "output", "port": 4}]}},
+        ]}
+        ports = []
+        for in_port in (1, 2, 1):
+            payload = {"trace": {"switch": {
+                "dpid": "00:00:00:00:00:00:00:01", "in_port": in_port
+            }}}
+            resp = await self.api_client.put(self.trace_endpoint,
+                                             json=payload)
+            assert resp.status_code == 200
+            ports.append(resp.json()["result"][0]["out"]["port"])
+        assert ports == [3, 4, 3]
+
+        switch = self.napp.controller.switches["00:00:00:00:00:00:00:01"]
+        args = {"in_port": 1}
+        stored_flows = mock_stored_flows.return_value
+        assert self.napp.match_and_apply(switch, args, stored_flows)[2] == 3
+        assert args == {"in_port": 1}
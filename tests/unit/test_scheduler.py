@@ -0,0 +1,107 @@
+"""Module to test the scheduler.py file."""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+
+import pytest
+from napps.amlight.sdntrace_cp.scheduler import (BULK, INTERACTIVE,
+                                                 TraceScheduler)
+
+
+def wait_until(predicate, timeout=5):
+    """Poll a predicate until it's true or timeout seconds passed, and
+    return its last value."""
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+class TestTraceScheduler:
+    """Test the TraceScheduler class."""
+
+    def setup_method(self):
+        """Execute steps before each test."""
+        self.scheduler = TraceScheduler(workers=2, bulk_workers=1,
+                                        bulk_slice=2)
+
+    @staticmethod
+    def test_workers():
+        """Test bulk traces must leave workers to interactive traces."""
+        with pytest.raises(ValueError):
+            TraceScheduler(workers=2, bulk_workers=2)
+        with pytest.raises(ValueError):
+            TraceScheduler(workers=2, bulk_workers=0)
+
+    def test_slices(self):
+        """Test bulk entries are split in slices holding a worker."""
+        slices = []
+        for entries in self.scheduler.slices([1, 2, 3, 4, 5]):
+            assert self.scheduler.running[BULK] == 1
+            slices.append(entries)
+        assert slices == [[1, 2], [3, 4], [5]]
+        stats = self.scheduler.stats()
+        assert stats[BULK] == {"workers": 1, "running": 0, "waiting": 0,
+                               "max_waiting": 1, "completed": 3}
+        assert stats[INTERACTIVE]["completed"] == 0
+
+        slices = self.scheduler.slices([1, 2, 3])
+        next(slices)
+        slices.close()
+        assert self.scheduler.running[BULK] == 0
+
+    def test_bulk_yields(self):
+        """Test the next bulk slice waits for the waiting interactive
+        traces."""
+        order = []
+        first_slice = Event()
+        release = Event()
+
+        def bulk():
+            for entries in self.scheduler.slices([1, 2, 3]):
+                if entries == [1, 2]:
+                    first_slice.set()
+                    release.wait(5)
+                order.append(("bulk", entries))
+
+        def interactive():
+            with self.scheduler.slot(INTERACTIVE):
+                order.append(("interactive", None))
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            with self.scheduler.slot(INTERACTIVE):
+                bulk_future = executor.submit(bulk)
+                assert first_slice.wait(5)
+                interactive_future = executor.submit(interactive)
+                assert wait_until(lambda: self.scheduler.waiting[INTERACTIVE])
+                release.set()
+                interactive_future.result(timeout=5)
+            bulk_future.result(timeout=5)
+        assert order == [("bulk", [1, 2]), ("interactive", None),
+                         ("bulk", [3])]
+        assert self.scheduler.stats()[INTERACTIVE]["max_waiting"] == 1
+
+    def test_bulk_saturated(self):
+        """Test interactive traces still run while bulk slices hold all of
+        their workers."""
+        slices = self.scheduler.slices([1, 2, 3])
+        assert next(slices) == [1, 2]
+        with self.scheduler.slot(INTERACTIVE):
+            assert self.scheduler.running == {INTERACTIVE: 1, BULK: 1}
+        slices.close()
+
+    def test_bulk_waits_for_workers(self):
+        """Test bulk slices wait for a free worker of the pool, taken by
+        running interactive traces."""
+        order = []
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            with self.scheduler.slot(INTERACTIVE), \
+                    self.scheduler.slot(INTERACTIVE):
+                future = executor.submit(
+                    lambda: order.extend(self.scheduler.slices([1, 2, 3]))
+                )
+                assert wait_until(lambda: self.scheduler.waiting[BULK])
+                assert not self.scheduler.waiting[INTERACTIVE]
+                assert not order
+            future.result(timeout=5)
+        assert order == [[1, 2], [3]]
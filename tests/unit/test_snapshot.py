@@ -0,0 +1,241 @@
+"""Module to test the snapshot.py file."""
+import time
+from unittest.mock import MagicMock, patch
+
+from napps.amlight.sdntrace_cp.main import Main
+from napps.amlight.sdntrace_cp.snapshot import FlowSnapshots, SnapshotBuilder
+
+DPID1 = "00:00:00:00:00:00:00:01"
+DPID2 = "00:00:00:00:00:00:00:02"
+
+
+class TestFlowSnapshots:
+    """Test the FlowSnapshots class."""
+
+    def setup_method(self):
+        """Execute steps before each test."""
+        self.snapshots = FlowSnapshots(max_versions=2)
+        self.flow1 = {"flow": {"match": {"in_port": 1}, "priority": 10}}
+        self.flow2 = {"flow": {"match": {"in_port": 2}, "priority": 10}}
+
+    def test_publish(self):
+        """Test publishing versions sharing unchanged switches."""
+        first = self.snapshots.publish({DPID1: [self.flow1],
+                                        DPID2: [self.flow2]})
+        assert first.version == 1
+        assert first[DPID1] == (self.flow1,)
+        assert DPID2 in first
+        assert len(first) == 2
+        assert first.as_dict()["flows"] == 2
+
+        with patch("napps.amlight.sdntrace_cp.snapshot.monotonic",
+                   return_value=time.monotonic() + 10 ** 9):
+            assert first.age() > 10 ** 8
+            same = self.snapshots.publish({DPID1: [dict(self.flow1)],
+                                           DPID2: [self.flow2]})
+            assert same is first
+            assert first.age() == 0
+
+        second = self.snapshots.publish({DPID1: [self.flow1],
+                                         DPID2: [self.flow2, self.flow1]})
+        assert second.version == 2
+        assert second[DPID1] is first[DPID1]
+        assert second[DPID2] is not first[DPID2]
+        assert first[DPID2] == (self.flow2,)
+        assert self.snapshots.latest is second
+
+        third = self.snapshots.publish({DPID1: [self.flow1]})
+        assert third.version == 3
+        assert DPID2 not in third
+        assert self.snapshots.get(1) is None
+        assert self.snapshots.get(2) is second
+        assert self.snapshots.list() == [second, third]
+
+    def test_match(self):
+        """Test matching flows through the compiled tables."""
+        snapshot = self.snapshots.publish({DPID1: [self.flow1, self.flow2]})
+        assert snapshot.match(DPID1, 0, {"in_port": 2},
+                              Main.do_match) is self.flow2
+        assert snapshot.match(DPID1, 0, {"in_port": 3}, Main.do_match) is None
+        assert snapshot.match(DPID1, 1, {"in_port": 1}, Main.do_match) is None
+
+        second = self.snapshots.publish({DPID1: [self.flow1, self.flow2],
+                                         DPID2: [self.flow1]})
+        # pylint: disable=protected-access
+        assert second._tables[DPID1] is snapshot._tables[DPID1]
+
+    def test_apply(self):
+        """Test adding and removing flows incrementally."""
+        first = self.snapshots.publish({DPID1: [self.flow1],
+                                        DPID2: [self.flow2]})
+        flow3 = {"flow": {"match": {"in_port": 3}, "priority": 20},
+                 "flow_id": "f3"}
+        second = self.snapshots.apply(DPID1, flow3)
+        assert second.version == 2
+        assert second[DPID1] == (flow3, self.flow1)
+        assert second[DPID2] is first[DPID2]
+        assert first[DPID1] == (self.flow1,)
+        assert second.match(DPID1, 0, {"in_port": 3}, Main.do_match) is flow3
+        assert second.as_dict()["flows"] == 3
+
+        removed = {"flow": {"match": {"in_port": 3}}, "flow_id": "f3"}
+        third = self.snapshots.apply(DPID1, removed, removed=True)
+        assert third[DPID1] == (self.flow1,)
+        assert self.snapshots.apply(DPID1, removed, removed=True) is third
+        assert second.match(DPID1, 0, {"in_port": 3}, Main.do_match) is flow3
+
+    def test_evict_unused(self):
+        """Test versions used by traces are kept over unused ones."""
+        first = self.snapshots.use(self.snapshots.publish({DPID1: []}))
+        for port in range(1, 9):
+            latest = self.snapshots.apply(
+                DPID1, {"flow": {"match": {"in_port": port}}}
+            )
+        assert latest.version == 9
+        assert self.snapshots.list() == [first, latest]
+
+        self.snapshots.use(latest)
+        third = self.snapshots.apply(DPID1, self.flow1)
+        assert self.snapshots.list() == [latest, third]
+
+    def test_pipeline_cache(self):
+        """Test caching pipeline results and invalidating them."""
+        switch = MagicMock(dpid=DPID1, ofp_version='0x04')
+        goto = {"flow": {"match": {"in_port": 1},
+                         "instructions": [{"instruction_type": "goto_table",
+                                           "table_id": 1}]}}
+        output = {"flow": {"table_id": 1, "match": {"dl_vlan": 10},
+                           "actions": [{"action_type": "output",
+                                        "port": 2}]}}
+        snapshot = self.snapshots.publish({DPID1: [goto, output],
+                                           DPID2: [self.flow2]})
+        napp = Main(MagicMock())
+        cache = snapshot.pipeline_cache(DPID1)
+        assert cache.classes.fields == ("dl_vlan", "in_port")
+        assert cache.key({"in_port": 1, "dl_vlan": [5, 10],
+                          "dl_type": 2048}) == (1, 1)
+        assert cache.key({"in_port": 3, "dl_vlan": [11]}) == \
+            cache.key({"in_port": 4, "dl_vlan": [12]}) == (0, 0)
+
+        for _ in range(2):
+            result = napp.match_and_apply(
+                switch, {"in_port": 1, "dl_vlan": [10]}, snapshot
+            )
+            assert result == (output, {"in_port": 1, "dl_vlan": [10]}, 2)
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert cache.entries[(1, 1)][2] == (0, 1)
+        napp.match_and_apply(switch, {"in_port": 2, "dl_vlan": [10]},
+                             snapshot)
+        assert snapshot.cache_stats() == {"entries": 2, "hits": 1,
+                                          "misses": 2}
+
+        added = {"flow": {"table_id": 1, "match": {"in_port": 1},
+                          "priority": 0}}
+        second = self.snapshots.apply(DPID1, added)
+        # pylint: disable=protected-access
+        assert second._caches[DPID1].entries == {(1, 0): cache.entries[
+            (1, 0)]}
+        added = {"flow": {"table_id": 1, "match": {"in_port": 3}}}
+        third = self.snapshots.apply(DPID1, added)
+        assert DPID1 not in third._caches
+        assert third.classes(DPID1).class_of({"in_port": 3}) == (-1, 2)
+        assert third.classes().fields == ("dl_vlan", "in_port")
+
+
+class TestSnapshotBuilder:
+    """Test the SnapshotBuilder class."""
+
+    def setup_method(self):
+        """Execute steps before each test."""
+        self.snapshots = FlowSnapshots()
+        self.fetch = MagicMock(return_value={DPID1: []})
+        self.builder = SnapshotBuilder(self.snapshots, self.fetch,
+                                       debounce=0.05, max_delay=0.2,
+                                       retry_delay=0.05, retry_max_delay=0.1)
+
+    def teardown_method(self):
+        """Execute steps after each test."""
+        self.builder.shutdown()
+
+    def wait_for(self, condition):
+        """Wait up to 2 seconds for a condition of the builder."""
+        deadline = time.monotonic() + 2
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_build(self):
+        """Test building snapshots and the rebuild metrics."""
+        assert self.builder.build() is self.snapshots.latest
+        stats = self.builder.stats()
+        assert stats["tracking"]
+        assert stats["rebuilds"] == 1
+        assert stats["last_rebuild_latency"] is not None
+
+        self.fetch.side_effect = RuntimeError("flow_manager is down")
+        self.builder.pending = 2
+        assert self.builder.build() is None
+        stats = self.builder.stats()
+        assert not stats["tracking"]
+        assert stats["failures"] == 1
+        assert stats["consecutive_failures"] == 1
+        assert stats["pending_changes"] == 2
+
+    def test_retry(self):
+        """Test failed builds are retried with backoff until one
+        succeeds."""
+        self.fetch.side_effect = [RuntimeError("flow_manager is down"),
+                                  RuntimeError("flow_manager is down"),
+                                  {DPID1: []}]
+        self.builder.start()
+        assert self.wait_for(lambda: self.builder.failures == 1)
+        self.builder.schedule()
+        assert self.builder.pending == 1
+        assert self.wait_for(lambda: self.builder.rebuilds == 1)
+        stats = self.builder.stats()
+        assert stats["tracking"]
+        assert stats["failures"] == 2
+        assert stats["consecutive_failures"] == 0
+        assert stats["pending_changes"] == 0
+        assert self.fetch.call_count == 3
+
+    def test_retry_backoff(self):
+        """Test the delay of retries doubles up to the maximum."""
+        self.fetch.side_effect = RuntimeError("flow_manager is down")
+        delays = []
+        for _ in range(3):
+            self.builder.build()
+            # pylint: disable=protected-access
+            delays.append(self.builder._timer.interval)
+        assert delays == [0.05, 0.1, 0.1]
+
+    def test_apply(self):
+        """Test applying flows incrementally only while tracking."""
+        flow = {"flow": {"match": {"in_port": 1}}}
+        self.builder.schedule = MagicMock()
+        self.builder.apply(DPID1, flow)
+        self.builder.schedule.assert_called_once()
+
+        self.builder.build()
+        self.builder.apply(DPID1, flow)
+        assert self.snapshots.latest[DPID1] == (flow,)
+        assert self.builder.stats()["incremental_updates"] == 1
+        self.builder.schedule.assert_called_once()
+
+        self.builder.apply(DPID1, {"flow": {"match": {"in_port": 2}}},
+                           removed=True)
+        assert self.builder.schedule.call_count == 2
+
+    def test_schedule(self):
+        """Test debouncing builds after flow changes."""
+        for _ in range(5):
+            self.builder.schedule()
+        assert self.builder.pending == 5
+        assert self.wait_for(lambda: self.builder.rebuilds == 1)
+        assert self.builder.pending == 0
+        self.fetch.assert_called_once()
+
+        self.builder.schedule()
+        self.builder.shutdown()
+        time.sleep(0.1)
+        assert self.builder.rebuilds == 1
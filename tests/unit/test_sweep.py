@@ -0,0 +1,93 @@
+"""Module to test the sweep.py file."""
+from unittest.mock import MagicMock
+
+from napps.amlight.sdntrace_cp.sweep import (SweepOutcomes, compress_headers,
+                                             expand_sweep, sweep_class,
+                                             sweep_size)
+
+
+def trace(vlan):
+    """Return the trace of a packet sent to port 2 with a VLAN ID."""
+    return [{"in": {"dpid": "1", "port": 1, "type": "starting",
+                    "vlan": vlan}, "out": {"port": 2, "vlan": vlan}}]
+
+
+def test_expand_sweep():
+    """Test expanding the headers of a swept entry."""
+    entry = {"dpid": "1", "dl_type": 2048,
+             "sweep": {"in_port": [1, 2], "dl_vlan": {"from": 10, "to": 11}}}
+    assert sweep_size(entry) == 4
+    fields, headers = expand_sweep(entry)
+    assert fields == ("in_port", "dl_vlan")
+    assert list(headers) == [
+        ((1, 10), {"dpid": "1", "dl_type": 2048, "in_port": 1,
+                   "dl_vlan": [10]}),
+        ((1, 11), {"dpid": "1", "dl_type": 2048, "in_port": 1,
+                   "dl_vlan": [11]}),
+        ((2, 10), {"dpid": "1", "dl_type": 2048, "in_port": 2,
+                   "dl_vlan": [10]}),
+        ((2, 11), {"dpid": "1", "dl_type": 2048, "in_port": 2,
+                   "dl_vlan": [11]}),
+    ]
+    assert sweep_size({"sweep": {"tp_dst": {"from": 2, "to": 1}}}) == 0
+
+
+def test_compress_headers():
+    """Test runs of consecutive values of the last field become ranges."""
+    rows = [(1, 1), (1, 2), (1, 3), (1, 5), (2, 6), (2, 7), (3, 8)]
+    assert compress_headers(rows) == [[1, [1, 3]], [1, 5], [2, [6, 7]],
+                                      [3, 8]]
+    assert compress_headers([(4,), (5,), (7,)]) == [[[4, 5]], [7]]
+    assert not compress_headers([])
+
+
+def test_sweep_class():
+    """Test headers are keyed by switch, port and packet class."""
+    header = {"dpid": "1", "in_port": 2, "dl_vlan": [10]}
+    classes = MagicMock()
+    classes.class_of.return_value = 3
+    assert sweep_class(classes, header) == ("1", 2, 3)
+    classes.class_of.return_value = None
+    assert sweep_class(classes, header) is None
+    assert sweep_class(None, header) is None
+
+
+def test_sweep_outcomes():
+    """Test headers whose paths only differ by their swept VLAN ID share
+    an outcome."""
+    sweep = SweepOutcomes(("dl_vlan",))
+    for vlan, out_vlan in ((10, 10), (11, 11), (12, 100), (13, 13)):
+        result = trace(vlan)
+        result[0]["out"]["vlan"] = out_vlan
+        outcome = sweep.add_trace((vlan,), result)
+        sweep.add_header((vlan,), outcome)
+    assert sweep.as_dict() == {
+        "fields": ["dl_vlan"], "headers": 4, "traced": 4,
+        "outcomes": [{"headers": [[[10, 11]], [13]], "result": trace(10)},
+                     {"headers": [[12]], "result": [{
+                         "in": {"dpid": "1", "port": 1, "type": "starting",
+                                "vlan": 12},
+                         "out": {"port": 2, "vlan": 100},
+                     }]}],
+    }
+
+
+def test_sweep_class_outcomes():
+    """Test the headers of a class only share outcomes that can't differ
+    by VLAN IDs set by flows."""
+    sweep = SweepOutcomes(("dl_vlan",), range(10, 14))
+    outcome = sweep.add_trace((10,), trace(10), "passed")
+    assert sweep.class_outcome("passed") is None
+    assert sweep.add_trace((11,), trace(11), "passed") is outcome
+    assert sweep.class_outcome("passed") is outcome
+
+    result = trace(10)
+    result[0]["out"]["vlan"] = 100
+    outcome = sweep.add_trace((10,), result, "set")
+    assert sweep.class_outcome("set") is outcome
+
+    result = trace(12)
+    result[0]["out"]["vlan"] = 13
+    sweep.add_trace((12,), result, "set_swept")
+    assert sweep.class_outcome("set_swept") is None
+    assert sweep.class_outcome(None) is None
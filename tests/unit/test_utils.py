@@ -1,9 +1,12 @@
 """Module to test the utils.py file."""
+import json
+from datetime import datetime
 import pytest
 from unittest.mock import patch, MagicMock
 from httpx import RequestError
 from tenacity import RetryError
 from kytos.core.interface import Interface
+from kytos.core.rest_api import HTTPException
 from kytos.lib.helpers import get_link_mock
 from napps.amlight.sdntrace_cp import utils, settings
 
@@ -65,6 +68,28 @@ class TestUtils():
             }
         assert result == expected
 
+    def test_copy_args(self):
+        """Verify copying packet fields doesn't share the VLAN stack."""
+        args = {"in_port": 1, "dl_vlan": [100]}
+        copy = utils.copy_args(args)
+        copy["dl_vlan"].append(200)
+        copy["in_port"] = 2
+        assert args == {"in_port": 1, "dl_vlan": [100]}
+        assert utils.copy_args({"in_port": 1}) == {"in_port": 1}
+
+    def test_entry_key(self):
+        """Test the keys of identical and different entries."""
+        entry = {"dpid": "1", "in_port": 1, "dl_vlan": [100],
+                 "sweep": {"tp_dst": {"from": 1, "to": 2}}}
+        same = {"sweep": {"tp_dst": {"to": 2, "from": 1}}, "dl_vlan": [100],
+                "in_port": 1, "dpid": "1"}
+        assert utils.entry_key(entry) == utils.entry_key(same)
+        hash(utils.entry_key(entry))
+        assert utils.entry_key({"in_port": 1}) != \
+            utils.entry_key({"in_port": True})
+        assert utils.entry_key({"dl_vlan": [100]}) != \
+            utils.entry_key({"dl_vlan": 100})
+
     def test_prepare_json(self):
         """Verify prepare json with simple tracepath result."""
         trace_result = [
@@ -375,6 +400,31 @@ class TestUtils():
         assert 'endpoint' in result
         assert result['endpoint'] is None
 
+    def test_match_field_metadata(self):
+        """Test match_field_metadata."""
+        assert utils.match_field_metadata(0, 0)
+        assert utils.match_field_metadata(4, 4)
+        assert not utils.match_field_metadata(5, 4)
+        assert utils.match_field_metadata(5, "0x4/0x6")
+        assert not utils.match_field_metadata(2, "4/6")
+        with pytest.raises(ValueError):
+            utils.match_field_metadata(2, "bad")
+
+    def test_output_ports(self):
+        """Test expanding reserved output ports."""
+        mock_switch = MagicMock()
+        down = MagicMock()
+        down.is_active.return_value = False
+        mock_switch.interfaces = {3: MagicMock(), 1: MagicMock(), 2: down,
+                                  4: MagicMock(), 0xfffffffe: MagicMock()}
+        assert utils.output_ports(mock_switch, 2, 1) == [2]
+        assert utils.output_ports(mock_switch, utils.OFPP_FLOOD, 1) == [3, 4]
+        assert utils.output_ports(mock_switch, "ALL", 4) == [1, 3]
+        assert utils.output_ports(mock_switch, utils.OFPP_IN_PORT, 1) == [1]
+        assert utils.output_ports(mock_switch, "in_port", 4) == [4]
+        assert utils.output_ports(mock_switch, "controller", 1) == \
+            ["controller"]
+
     def test_convert_vlan(self):
         """Test convert_vlan function"""
         value = 100
@@ -423,3 +473,112 @@ class TestUtils():
     def test_match_field_ip(self, field, field_flow, result):
         """Test match_field_ip"""
         assert utils.match_field_ip(field, field_flow) == result
+
+    def test_prepare_json_list(self):
+        """Test prepare_json with a list of traces."""
+        trace1 = [
+            {"in": {"dpid": "a", "port": 1}, "out": {"port": 2}},
+            {"in": {"dpid": "b", "port": 1}, "out": {"port": 3}},
+        ]
+        result = utils.prepare_json([trace1, []])
+        assert result == {"result": [[
+            {"dpid": "a", "port": 1},
+            {"dpid": "b", "port": 1, "out": {"port": 3}},
+        ], []]}
+
+    @patch("napps.amlight.sdntrace_cp.utils.get_body")
+    def test_load_json_or_400(self, get_body_mock):
+        """Test load_json_or_400 decoding and rejecting a body."""
+        get_body_mock.return_value = b'[{"trace": {}}]'
+        assert utils.load_json_or_400(MagicMock(), MagicMock()) == [
+            {"trace": {}}
+        ]
+        get_body_mock.return_value = b'[{"trace"'
+        with pytest.raises(HTTPException) as exc:
+            utils.load_json_or_400(MagicMock(), MagicMock())
+        assert exc.value.status_code == 400
+
+    @patch("napps.amlight.sdntrace_cp.utils.get_json_or_400")
+    @patch("napps.amlight.sdntrace_cp.utils.orjson", None)
+    def test_load_json_or_400_no_orjson(self, get_json_mock):
+        """Test load_json_or_400 without orjson installed."""
+        get_json_mock.return_value = []
+        assert utils.load_json_or_400(MagicMock(), MagicMock()) == []
+
+    def test_trace_json_response(self):
+        """Test TraceJSONResponse encoding with and without orjson."""
+        content = {"result": [[{"dpid": "a", "port": 1, "type": "last"}]]}
+        response = utils.TraceJSONResponse(content)
+        assert json.loads(response.body) == content
+        with patch("napps.amlight.sdntrace_cp.utils.orjson", None):
+            response = utils.TraceJSONResponse(content)
+        assert json.loads(response.body) == content
+
+    def test_prepare_compact_json(self):
+        """Test prepare_compact_json with repeated and empty traces."""
+        def trace():
+            return [
+                {"in": {"dpid": "a", "port": 1, "time": "t",
+                        "type": "starting", "vlan": 100},
+                 "out": {"port": 2, "vlan": 100}},
+                {"in": {"dpid": "b", "port": 1, "time": "t",
+                        "type": "last", "vlan": 100},
+                 "out": {"port": 3}},
+            ]
+        no_match = [{"in": {"dpid": "b", "port": 5, "time": "t",
+                            "type": "last"}}]
+
+        result = utils.prepare_compact_json([trace(), [], trace(), no_match])
+        assert result == {"result": {
+            "dpids": ["a", "b"],
+            "types": ["starting", "intermediary", "last", "loop"],
+            "paths": [
+                {"steps": ((0, 1, 0, 100), (1, 1, 2, 100)), "out": (3,)},
+                {"steps": (), "out": None},
+                {"steps": ((1, 5, 2),), "out": None},
+            ],
+            "traces": [0, 1, 0, 2],
+        }}
+
+    def test_get_response_format(self):
+        """Test get_response_format."""
+        request = MagicMock()
+        request.query_params = {}
+        assert utils.get_response_format(request) == "full"
+        request.query_params = {"format": "compact"}
+        assert utils.get_response_format(request) == "compact"
+        request.query_params = {"format": "xml"}
+        with pytest.raises(HTTPException):
+            utils.get_response_format(request)
+
+    def test_set_trace_times(self):
+        """Test set_trace_times with every timing."""
+        start = datetime(2024, 1, 1, 10, 0, 0)
+        trace_result = [{"in": {"dpid": "a"}}, {"in": {"dpid": "b"}}]
+        utils.set_trace_times(trace_result, (start, 5.0), "trace")
+        assert [step["in"]["time"] for step in trace_result] == [
+            "2024-01-01 10:00:00", "2024-01-01 10:00:00"
+        ]
+
+        trace_result = [{"in": {"time": 5.5}}, {"in": {"time": 7.0}}]
+        utils.set_trace_times(trace_result, (start, 5.0), "step")
+        assert [step["in"]["time"] for step in trace_result] == [
+            "2024-01-01 10:00:00.500000", "2024-01-01 10:00:02"
+        ]
+
+        trace_result = [{"in": {"dpid": "a"}}]
+        utils.set_trace_times(trace_result, (start, 5.0), "none")
+        assert trace_result == [{"in": {"dpid": "a"}}]
+
+    def test_get_trace_timing(self):
+        """Test get_trace_timing."""
+        request = MagicMock()
+        request.query_params = {}
+        assert utils.get_trace_timing(request) == "trace"
+        request.query_params = {"timing": "step"}
+        assert utils.get_trace_timing(request) == "step"
+        request.query_params = {"timing": "step", "format": "compact"}
+        assert utils.get_trace_timing(request) == "none"
+        request.query_params = {"timing": "always"}
+        with pytest.raises(HTTPException):
+            utils.get_trace_timing(request)
@@ -0,0 +1,133 @@
+"""Module to test the validation.py file."""
+import pathlib
+
+import pytest
+from kytos.core.rest_api import HTTPException
+
+from napps.amlight.sdntrace_cp import utils
+from napps.amlight.sdntrace_cp.validation import (compile_entries_validator,
+                                                  load_entries_schema)
+
+SPEC_PATH = pathlib.Path(__file__).parents[2] / "openapi.yml"
+
+
+class TestValidation:
+    """Test the compiled validator of trace entries."""
+
+    def setup_method(self):
+        """Execute steps before each test."""
+        schema = load_entries_schema(SPEC_PATH)
+        self.validate_entries = compile_entries_validator(schema)
+
+    def test_validate_entries(self):
+        """Test validating and converting valid entries."""
+        data = [
+            {
+                "trace": {
+                    "switch": {
+                        "dpid": "00:00:00:00:00:00:00:01",
+                        "in_port": 1
+                    },
+                    "eth": {"dl_vlan": 100, "dl_type": 2048},
+                    "ip": {"nw_src": "192.168.20.21", "nw_proto": 6},
+                    "tp": {"tp_dst": 80},
+                }
+            },
+            {
+                "trace": {
+                    "switch": {
+                        "dpid": "00:00:00:00:00:00:00:02",
+                        "in_port": 2
+                    },
+                }
+            },
+        ]
+        expected = utils.convert_list_entries(data)
+        assert self.validate_entries(data) == expected
+        assert expected[0]["dl_vlan"] == [100]
+        assert not self.validate_entries([])
+
+    def test_validate_entries_sweep(self):
+        """Test lists and ranges of values are moved to the sweep."""
+        data = [{"trace": {"switch": {"dpid": "1", "in_port": [1, 2]},
+                           "eth": {"dl_vlan": {"from": 10, "to": 20},
+                                   "dl_type": 2048},
+                           "tp": {"tp_dst": 80}}}]
+        assert self.validate_entries(data) == [{
+            "dpid": "1", "dl_type": 2048, "tp_dst": 80,
+            "sweep": {"in_port": [1, 2],
+                      "dl_vlan": {"from": 10, "to": 20}},
+        }]
+
+    @pytest.mark.parametrize(
+        "data,message",
+        [
+            (
+                {"trace": {}},
+                "{'trace': {}} is not of type 'array' for field .",
+            ),
+            (
+                [{"trace": {"eth": {"dl_vlan": 100}}}],
+                "'switch' is a required property for field 0/trace.",
+            ),
+            (
+                [{"trace": {"switch": {"dpid": "00:00:00:00:00:00:00:01"}}}],
+                "'in_port' is a required property for field 0/trace/switch.",
+            ),
+            (
+                [{"trace": {"switch": {"dpid": 1, "in_port": 1}}}],
+                "1 is not of type 'string' for field 0/trace/switch/dpid.",
+            ),
+            (
+                [{"trace": {"switch": {"dpid": "1", "in_port": "1"}}}],
+                "'1' is not valid under any of the given schemas for field "
+                "0/trace/switch/in_port.",
+            ),
+            (
+                [{"trace": {"switch": {"dpid": "1", "in_port": True}}}],
+                "True is not valid under any of the given schemas for field "
+                "0/trace/switch/in_port.",
+            ),
+            (
+                [{"trace": {"switch": {"dpid": "1", "in_port": []}}}],
+                "[] is too short for field 0/trace/switch/in_port.",
+            ),
+            (
+                [{"trace": {"switch": {"dpid": "1", "in_port": {"to": 2}}}}],
+                "'from' is a required property for field "
+                "0/trace/switch/in_port.",
+            ),
+            (
+                [{"trace": {"switch": {"dpid": "1", "in_port": 1},
+                            "eth": {"dl_vlan": [1, 4096]}}}],
+                "4096 is greater than the maximum of 4095 for field "
+                "0/trace/eth/dl_vlan/1.",
+            ),
+            (
+                [
+                    {"trace": {"switch": {"dpid": "1", "in_port": 1}}},
+                    {"trace": {"switch": {"dpid": "1", "in_port": 1},
+                               "eth": {"dl_vlan": 0}}},
+                ],
+                "0 is less than the minimum of 1 for field "
+                "1/trace/eth/dl_vlan.",
+            ),
+            (
+                [{"trace": {"switch": {"dpid": "1", "in_port": 1},
+                            "eth": {"dl_vlan": 4096}}}],
+                "4096 is greater than the maximum of 4095 for field "
+                "0/trace/eth/dl_vlan.",
+            ),
+            (
+                [{"trace": {"switch": {"dpid": "1", "in_port": 1},
+                            "ip": []}}],
+                "[] is not of type 'object' for field 0/trace/ip.",
+            ),
+        ],
+    )
+    def test_validate_entries_error(self, data, message):
+        """Test the error messages of invalid entries."""
+        with pytest.raises(HTTPException) as exc:
+            self.validate_entries(data)
+        assert exc.value.status_code == 400
+        assert exc.value.detail == message
@@ -0,0 +1,146 @@
+"""Module to test the watch.py file."""
+import pytest
+
+from napps.amlight.sdntrace_cp.watch import (WatchedTraces,
+                                             WatchedTracesLimitError,
+                                             WatchedTraceStream,
+                                             WatchedTraceStreamLimitError,
+                                             diff_results, same_flow)
+
+DPID = "00:00:00:00:00:00:00:01"
+
+
+class TestWatchedTraces:
+    """Test the WatchedTraces class."""
+
+    def setup_method(self):
+        """Execute steps before each test."""
+        self.flow = {"flow": {"table_id": 0, "priority": 10,
+                              "match": {"in_port": 1}}, "flow_id": "f1"}
+
+        def run_trace(entries, stored_flows, timing, trail):
+            assert timing == 'none'
+            flows = [flow for flow in stored_flows.get(DPID, [])
+                     if flow['flow']['match']['in_port'] == entries['in_port']]
+            trail.append((DPID, 0, dict(entries), flows[0] if flows else None))
+            step = {'dpid': DPID, 'port': entries['in_port'],
+                    'type': 'last'}
+            if flows:
+                step['out'] = {'port': 2}
+            return [step]
+
+        def do_match(flow, args, table_id):
+            return flow['flow']['match'].get('in_port') == args['in_port'] \
+                and flow['flow'].get('table_id', 0) == table_id
+
+        self.watched = WatchedTraces(run_trace, do_match, list,
+                                     max_watched=2)
+
+    def test_add(self):
+        """Test watching a trace."""
+        watched = self.watched.add({'dpid': DPID, 'in_port': 1}, {})
+        assert self.watched.get(watched.id) is watched
+        assert watched.result == [{'dpid': DPID, 'port': 1, 'type': 'last'}]
+        assert self.watched.list() == [watched]
+        assert watched.as_dict() == {
+            "id": watched.id, "result": watched.result, "changes": 0,
+            "created_at": watched.created_at,
+            "updated_at": watched.updated_at,
+        }
+        self.watched.add({'dpid': DPID, 'in_port': 2}, {})
+        with pytest.raises(WatchedTracesLimitError):
+            self.watched.add({'dpid': DPID, 'in_port': 3}, {})
+
+    def test_affected_by_flow(self):
+        """Test finding and tracing again the traces affected by flows."""
+        first = self.watched.add({'dpid': DPID, 'in_port': 1}, {})
+        second = self.watched.add({'dpid': DPID, 'in_port': 3}, {})
+
+        affected = self.watched.affected_by_flow(DPID, self.flow["flow"])
+        assert affected == {first.id}
+        assert not self.watched.affected_by_flow(
+            "00:00:00:00:00:00:00:02", self.flow["flow"]
+        )
+
+        changed = self.watched.rerun(affected | {"unknown"},
+                                     {DPID: [self.flow]})
+        assert changed == [(first, [{'dpid': DPID, 'port': 1,
+                                     'type': 'last'}])]
+        assert first.result[0]['out'] == {'port': 2}
+        assert first.changes == 1
+        assert not self.watched.rerun({second.id}, {DPID: [self.flow]})
+
+        assert self.watched.affected_by_ports([(DPID, 2)]) == {first.id}
+        removed = self.watched.affected_by_flow(DPID, self.flow["flow"],
+                                                "f1", removed=True)
+        assert removed == {first.id}
+
+        assert self.watched.remove(first.id) is first
+        assert not self.watched.affected_by_ports([(DPID, 2)])
+        assert not self.watched.affected_by_flow(DPID, self.flow["flow"])
+        assert self.watched.remove(first.id) is None
+
+    def test_same_flow(self):
+        """Test comparing stored flows with flows of events."""
+        assert same_flow(self.flow, {}, "f1")
+        assert not same_flow(self.flow, {}, "f2")
+        del self.flow["flow_id"]
+        assert same_flow(self.flow, {"table_id": 0, "priority": 10,
+                                     "match": {"in_port": 1}})
+        assert not same_flow(self.flow, {"table_id": 0, "priority": 20,
+                                         "match": {"in_port": 1}})
+
+
+class TestWatchedTraceStream:
+    """Test the WatchedTraceStream class."""
+
+    async def test_subscribe(self):
+        """Test streaming events to a subscriber."""
+        stream = WatchedTraceStream(queue_size=2, heartbeat=0.01)
+        messages = stream.subscribe([("snapshot", {"watched_traces": []})])
+        assert await anext(messages) == \
+            'event: snapshot\ndata: {"watched_traces": []}\n\n'
+        assert len(stream) == 1
+        assert await anext(messages) == ": heartbeat\n\n"
+
+        stream.publish("changed", {"id": "1"})
+        assert await anext(messages) == \
+            'event: changed\ndata: {"id": "1"}\n\n'
+        stream.close()
+        assert not [message async for message in messages]
+        assert not stream
+
+    async def test_slow_subscriber(self):
+        """Test that subscribers that don't keep up are dropped."""
+        stream = WatchedTraceStream(queue_size=2, heartbeat=0.01)
+        messages = stream.subscribe()
+        for index in range(4):
+            stream.publish("changed", {"id": index})
+        assert len([message async for message in messages]) == 2
+        assert not stream
+
+    async def test_max_subscribers(self):
+        """Test the number of subscribers is bounded."""
+        stream = WatchedTraceStream(heartbeat=0.01, max_subscribers=1)
+        messages = stream.subscribe()
+        with pytest.raises(WatchedTraceStreamLimitError):
+            stream.subscribe()
+        assert await anext(messages) == ": heartbeat\n\n"
+        await messages.aclose()
+        assert not stream
+        stream.subscribe()
+        assert len(stream) == 1
+
+    def test_diff_results(self):
+        """Test the diff of two trace results."""
+        first = {"dpid": DPID, "port": 1, "type": "starting"}
+        second = {"dpid": DPID, "port": 2, "type": "last"}
+        assert diff_results([first, second], [first]) == {
+            "index": 1, "removed": [second], "added": []
+        }
+        assert diff_results([], [first]) == {
+            "index": 0, "removed": [], "added": [first]
+        }
+        assert diff_results([first], [second]) == {
+            "index": 0, "removed": [first], "added": [second]
+        }
@@ -1,13 +1,38 @@
 """Utility functions to be used in this Napp"""
 # pylint: disable=consider-using-join
 import ipaddress
+from datetime import timedelta
 
 import httpx
+from kytos.core.rest_api import (HTTPException, JSONResponse, get_body,
+                                 get_json_or_400)
 from kytos.core.retry import before_sleep
 from napps.amlight.sdntrace_cp import settings
 from tenacity import (retry, retry_if_exception_type, stop_after_attempt,
                       wait_random)
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+TRACE_TIMINGS = ('trace', 'step', 'none')
+TRACE_TYPES = ['starting', 'intermediary', 'last', 'loop']
+TRACE_TYPE_CODES = {trace_type: code
+                    for code, trace_type in enumerate(TRACE_TYPES)}
+
+# OpenFlow 1.3 reserved ports
+OFPP_MAX = 0xffffff00
+OFPP_IN_PORT = 0xfffffff8
+OFPP_FLOOD = 0xfffffffb
+OFPP_ALL = 0xfffffffc
+RESERVED_PORTS = {'in_port': OFPP_IN_PORT, 'flood': OFPP_FLOOD,
+                  'all': OFPP_ALL}
+# Key of the VLAN IDs of a path equal to the swept VLAN ID of its header
+SWEPT_VLAN = 'swept'
+# Mask of write_metadata instructions that don't have one
+METADATA_MASK = 0xffffffffffffffff
+
 
 @retry(
     stop=stop_after_attempt(3),
@@ -60,6 +85,56 @@ def convert_list_entries(entries):
     return new_entries
 
 
+def copy_args(args):
+    """Copy the packet fields of a trace, which are changed in place."""
+    args = dict(args)
+    if 'dl_vlan' in args:
+        args['dl_vlan'] = list(args['dl_vlan'])
+    return args
+
+
+def entry_key(entry):
+    """Return a hashable key of a converted entry, the same for entries
+    with the same fields and values in any order.
+
+    Booleans are kept apart from the integers they are equal to."""
+    if isinstance(entry, dict):
+        return tuple(sorted((name, entry_key(value))
+                            for name, value in entry.items()))
+    if isinstance(entry, list):
+        return (list, *map(entry_key, entry))
+    if isinstance(entry, bool):
+        return (bool, entry)
+    return entry
+
+
+def get_query_int(request, name, default, maximum=None):
+    """Get a non-negative integer query parameter or raise a 400 error."""
+    value = request.query_params.get(name, default)
+    try:
+        value = int(value)
+    except (TypeError, ValueError) as exc:
+        msg = f"Query parameter '{name}' must be an integer"
+        raise HTTPException(400, msg) from exc
+    if value < 0 or (maximum is not None and value > maximum):
+        msg = f"Query parameter '{name}' must be in range [0, {maximum}]"
+        if maximum is None:
+            msg = f"Query parameter '{name}' must not be negative"
+        raise HTTPException(400, msg)
+    return value
+
+
+def get_snapshot_query(request):
+    """Return the 'snapshot' query parameter, or None, and the
+    'max_staleness' query parameter."""
+    version = None
+    if 'snapshot' in request.query_params:
+        version = get_query_int(request, 'snapshot', None)
+    max_staleness = get_query_int(request, 'max_staleness',
+                                  settings.FLOW_SNAPSHOT_MAX_STALENESS)
+    return version, max_staleness
+
+
 def find_endpoint(switch, port):
     """ Find where switch/port is connected. If it is another switch,
     returns the interface it is connected to, otherwise returns None """
@@ -74,25 +149,246 @@ def find_endpoint(switch, port):
     return {'endpoint': None}
 
 
+def port_number(port):
+    """Return the number of a port, which can be a reserved port name."""
+    if isinstance(port, str):
+        return RESERVED_PORTS.get(port.lower(), port)
+    return port
+
+
+def output_ports(switch, port, in_port):
+    """Return the ports a packet sent to an output port goes out through.
+
+    The FLOOD and ALL reserved ports are expanded to the active interfaces
+    of the switch but the ingress port, and IN_PORT to the ingress port.
+    Reserved ports can be given by number or by name."""
+    port = port_number(port)
+    if port == OFPP_IN_PORT:
+        return [in_port]
+    if port not in (OFPP_FLOOD, OFPP_ALL):
+        return [port]
+    return sorted(
+        port_no for port_no, interface in switch.interfaces.items()
+        if port_no != in_port and port_no < OFPP_MAX and
+        interface.is_active()
+    )
+
+
 def _prepare_json(trace_result):
-    """Auxiliar function to return the json for REST call."""
-    result = []
-    for trace_step in trace_result:
-        result.append(trace_step['in'])
+    """Auxiliar function to return the json for REST call.
+
+    The 'in' dicts of the trace steps are reused as they are, only the last
+    one gets the 'out' key, and the 'branches' key if it has branches."""
+    result = [trace_step['in'] for trace_step in trace_result]
     if result:
         result[-1]["out"] = trace_result[-1].get("out")
+        if 'branches' in trace_result[-1]:
+            result[-1]['branches'] = [
+                {**branch, 'result': _prepare_json(branch['result'])}
+                for branch in trace_result[-1]['branches']
+            ]
     return result
 
 
+def _prepare_result(result):
+    """Return the json of a trace or of a sweep, see Main.trace_sweep."""
+    if isinstance(result, dict):
+        return {**result, 'outcomes': [
+            {**outcome, 'result': _prepare_json(outcome['result'])}
+            for outcome in result['outcomes']
+        ]}
+    return _prepare_json(result)
+
+
 def prepare_json(trace_result):
-    """Prepare return json for REST call."""
-    result = []
-    if trace_result and isinstance(trace_result[0], list):
-        for trace in trace_result:
-            result.append(_prepare_json(trace))
-    else:
-        result = _prepare_json(trace_result)
-    return {'result': result}
+    """Prepare return json for REST call.
+
+    trace_result is either a trace or a list of traces and sweeps."""
+    if trace_result and isinstance(trace_result[0], (list, dict)) \
+            and 'in' not in trace_result[0]:
+        return {'result': [_prepare_result(result)
+                           for result in trace_result]}
+    return {'result': _prepare_json(trace_result)}
+
+
+def prepare_compact_json(traces):
+    """Prepare the compact return json for REST call.
+
+    Dpids are listed once and referred by their index, step types are
+    indexes in TRACE_TYPES and times are dropped. Each step is a list
+    [dpid, port, type] with the vlan appended when there is one. Identical
+    traces are listed once in 'paths' and referred by their index in
+    'traces', which follows the order of the given traces. The outcomes of
+    sweeps refer to their path by its index in 'path' instead of 'result'."""
+    dpids = {}
+    paths = {}
+    trace_ids = []
+    for trace in traces:
+        if isinstance(trace, dict):
+            trace_ids.append({**trace, 'outcomes': [
+                {'headers': outcome['headers'],
+                 'path': paths.setdefault(
+                     _compact_path(outcome['result'], dpids), len(paths)
+                 )}
+                for outcome in trace['outcomes']
+            ]})
+            continue
+        path = _compact_path(trace, dpids)
+        trace_ids.append(paths.setdefault(path, len(paths)))
+    return {'result': {
+        'dpids': list(dpids),
+        'types': TRACE_TYPES,
+        'paths': [_expand_path(path) for path in paths],
+        'traces': trace_ids,
+    }}
+
+
+def _vlan_key(value, vlan):
+    """Return a VLAN ID of a path, or SWEPT_VLAN if it's the given one."""
+    return SWEPT_VLAN if vlan is not None and value == vlan else value
+
+
+def _compact_out(out, vlan=None):
+    """Return the compact 'out' of a step or branch."""
+    if out is None:
+        return None
+    if 'vlan' in out:
+        return out['port'], _vlan_key(out['vlan'], vlan)
+    return (out['port'],)
+
+
+def _compact_path(trace, dpids, vlan=None):
+    """Return a trace as a hashable (steps, out, branches) tuple, where
+    branches are (groups, out, type, path) tuples.
+
+    VLAN IDs equal to vlan are replaced by SWEPT_VLAN."""
+    steps = []
+    for trace_step in trace:
+        step_in = trace_step['in']
+        step = (dpids.setdefault(step_in['dpid'], len(dpids)),
+                step_in['port'], TRACE_TYPE_CODES[step_in['type']])
+        if 'vlan' in step_in:
+            step += (_vlan_key(step_in['vlan'], vlan),)
+        steps.append(step)
+    out = _compact_out(trace[-1].get('out'), vlan) if trace else None
+    branches = ()
+    if trace and 'branches' in trace[-1]:
+        branches = tuple(
+            (tuple((group['group'], group['bucket'])
+                   for group in branch['groups']),
+             _compact_out(branch['out'], vlan), branch['type'],
+             _compact_path(branch['result'], dpids, vlan))
+            for branch in trace[-1]['branches']
+        )
+    return tuple(steps), out, branches
+
+
+def trace_outcome(trace, dpids, vlan=None):
+    """Return a hashable key of the path of a trace, the same for traces
+    that differ only by their times. dpids maps dpids to their index.
+
+    vlan is the swept VLAN ID of the header traced, if any: the VLAN IDs
+    of the path equal to it are keyed as SWEPT_VLAN, so headers whose
+    paths only differ by their own VLAN ID have the same key."""
+    return _compact_path(trace, dpids, vlan)
+
+
+def trace_vlans(trace, start=0):
+    """Return the VLAN IDs of the steps of a trace from start, of their
+    outputs and of their branches."""
+    vlans = set()
+    for index, trace_step in enumerate(trace):
+        ends = [trace_step.get('out')]
+        if index >= start:
+            ends.append(trace_step['in'])
+        for branch in trace_step.get('branches', ()):
+            ends.append(branch['out'])
+            vlans |= trace_vlans(branch['result'])
+        vlans.update(end['vlan'] for end in ends if end and 'vlan' in end)
+    return vlans
+
+
+def _expand_path(path):
+    """Return a compact path as a dict."""
+    steps, out, branches = path
+    result = {'steps': steps, 'out': out}
+    if branches:
+        result['branches'] = [
+            {'groups': groups, 'out': branch_out, 'type': branch_type,
+             'path': _expand_path(branch_path)}
+            for groups, branch_out, branch_type, branch_path in branches
+        ]
+    return result
+
+
+def get_query_choice(request, name, choices):
+    """Get a query parameter among choices, the first one is the default.
+
+    Raise a 400 error if the parameter is not one of the choices."""
+    value = request.query_params.get(name, choices[0])
+    if value not in choices:
+        msg = f"Query parameter '{name}' must be one of {', '.join(choices)}"
+        raise HTTPException(400, msg)
+    return value
+
+
+def get_response_format(request):
+    """Get the 'format' query parameter or raise a 400 error."""
+    return get_query_choice(request, 'format', ('full', 'compact'))
+
+
+def get_trace_timing(request):
+    """Get the 'timing' query parameter or raise a 400 error.
+
+    The compact format has no times, so it doesn't take any."""
+    if get_response_format(request) == 'compact':
+        return 'none'
+    return get_query_choice(request, 'timing', TRACE_TIMINGS)
+
+
+def set_trace_times(trace_result, started, timing):
+    """Set the 'time' of the steps of a finished trace.
+
+    started is the (datetime, monotonic) pair of when the trace started.
+    With 'trace' timing all steps get the start time, with 'step' timing
+    each step holds a monotonic time that is turned into a datetime."""
+    if timing == 'trace':
+        stamp = str(started[0])
+        for trace_step in trace_result:
+            trace_step['in']['time'] = stamp
+    elif timing == 'step':
+        start, start_monotonic = started
+        for trace_step in trace_result:
+            offset = trace_step['in']['time'] - start_monotonic
+            trace_step['in']['time'] = str(start + timedelta(seconds=offset))
+    if trace_result and 'branches' in trace_result[-1]:
+        for branch in trace_result[-1]['branches']:
+            set_trace_times(branch['result'], started, timing)
+
+
+def load_json_or_400(request, loop):
+    """Load the request JSON body, with orjson when it is installed."""
+    if orjson is None:
+        return get_json_or_400(request, loop)
+    # orjson is optional, so pylint can't always inspect its members
+    # pylint: disable=no-member
+    try:
+        return orjson.loads(get_body(request, loop))
+    except (orjson.JSONDecodeError, TypeError) as exc:
+        raise HTTPException(400, detail=f"Invalid json: {exc}") from exc
+
+
+class TraceJSONResponse(JSONResponse):
+    """JSONResponse encoded with orjson when it is installed."""
+
+    def render(self, content) -> bytes:
+        """Encode the content, falling back to the json module."""
+        if orjson is None:
+            return super().render(content)
+        try:
+            return orjson.dumps(content)  # pylint: disable=no-member
+        except TypeError:
+            return super().render(content)
 
 
 # pylint: disable=too-many-return-statements
@@ -137,6 +433,22 @@ def match_field_dl_vlan(value, field_flow):
     return value & (mask_flow & 4095) == value_flow & (mask_flow & 4095)
 
 
+def convert_metadata(value):
+    """Return the value and mask of a metadata match, an int or a
+    'value/mask' string."""
+    if isinstance(value, int):
+        return value, METADATA_MASK
+    value, mask = (int(part, 0) for part in value.split('/'))
+    return value, mask
+
+
+def match_field_metadata(value, field_flow):
+    """Verify match in metadata.
+    value is the metadata of the packet, 0 if it wasn't written."""
+    value_flow, mask_flow = convert_metadata(field_flow)
+    return value & mask_flow == value_flow & mask_flow
+
+
 def match_field_ip(field, field_flow):
     "Verify match in ip fields"
     packet_address = ipaddress.ip_address(field)
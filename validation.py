@@ -0,0 +1,209 @@
+"""Specialized validation of trace entries.
+
+The schema of the PUT /v1/traces entries in openapi.yml is compiled into a
+function that validates the entries and converts them into the plain dicts
+used for matching in a single pass, instead of validating the whole payload
+with the generic OpenAPI validator and walking it again to convert it.
+Error messages have the same format as the ones of @validate_openapi.
+
+Fields whose schema is a oneOf of a value, a list or a range of values can
+be swept: their lists and ranges are moved to the SWEEP key of the entry,
+see sweep.py.
+"""
+import yaml
+from kytos.core.rest_api import HTTPException
+from napps.amlight.sdntrace_cp.sweep import SWEEP
+
+TYPE_CHECKS = {
+    'array': lambda value: isinstance(value, list),
+    'boolean': lambda value: isinstance(value, bool),
+    'integer': lambda value: (isinstance(value, int)
+                              and not isinstance(value, bool)),
+    'number': lambda value: (isinstance(value, (int, float))
+                             and not isinstance(value, bool)),
+    'object': lambda value: isinstance(value, dict),
+    'string': lambda value: isinstance(value, str),
+}
+
+
+def load_entries_schema(spec_path):
+    """Load the schema of the PUT /v1/traces body from the spec file, with
+    its references to components resolved."""
+    with open(spec_path, encoding="utf8") as spec_file:
+        spec = yaml.safe_load(spec_file)
+    request_body = spec['paths']['/v1/traces']['put']['requestBody']
+    return _resolve_refs(request_body['content']['application/json']
+                         ['schema'], spec)
+
+
+def _resolve_refs(schema, spec):
+    """Return a schema with its local '$ref's replaced by their targets."""
+    if isinstance(schema, list):
+        return [_resolve_refs(item, spec) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    if '$ref' in schema:
+        target = spec
+        for part in schema['$ref'].lstrip('#/').split('/'):
+            target = target[part]
+        return _resolve_refs(target, spec)
+    return {key: _resolve_refs(value, spec) for key, value in schema.items()}
+
+
+def validation_error(message, path):
+    """Return a 400 error for a message and the path of the invalid field."""
+    return HTTPException(
+        400, f"{message} for field {'/'.join(map(str, path))}."
+    )
+
+
+def _check_type(schema_type, value, path):
+    """Raise a 400 error if value is not of the schema type."""
+    if schema_type and not TYPE_CHECKS[schema_type](value):
+        raise validation_error(
+            f"{value!r} is not of type {schema_type!r}", path
+        )
+
+
+def _compile_field(schema):
+    """Compile the checks of a field schema into a function.
+
+    Lists are checked item by item, objects by the fields they have."""
+    if 'oneOf' in schema:
+        return _compile_one_of(schema['oneOf'])
+    schema_type = schema.get('type')
+    minimum = schema.get('minimum')
+    maximum = schema.get('maximum')
+    enum = schema.get('enum')
+    check_item = _compile_field(schema['items']) if 'items' in schema \
+        else None
+    min_items = schema.get('minItems')
+    required = schema.get('required', [])
+    properties = {name: _compile_field(property_schema)
+                  for name, property_schema
+                  in schema.get('properties', {}).items()}
+
+    def check_field(value, path):
+        _check_type(schema_type, value, path)
+        if check_item is not None:
+            if min_items is not None and len(value) < min_items:
+                raise validation_error(f"{value!r} is too short", path)
+            for index, item in enumerate(value):
+                check_item(item, path + (index,))
+            return
+        if schema_type == 'object':
+            for name in required:
+                if name not in value:
+                    raise validation_error(
+                        f"{name!r} is a required property", path
+                    )
+            for name, item in value.items():
+                if name in properties:
+                    properties[name](item, path + (name,))
+            return
+        if minimum is not None and value < minimum:
+            raise validation_error(
+                f"{value!r} is less than the minimum of {minimum!r}", path
+            )
+        if maximum is not None and value > maximum:
+            raise validation_error(
+                f"{value!r} is greater than the maximum of {maximum!r}", path
+            )
+        if enum is not None and value not in enum:
+            raise validation_error(f"{value!r} is not one of {enum!r}", path)
+
+    return check_field
+
+
+def _compile_one_of(schemas):
+    """Compile the alternatives of a oneOf schema into a function.
+
+    The alternatives of the entries schema have different types, so the
+    one of the type of the value is checked."""
+    alternatives = [(schema.get('type'), _compile_field(schema))
+                    for schema in schemas]
+
+    def check_one_of(value, path):
+        for schema_type, check_field in alternatives:
+            if TYPE_CHECKS[schema_type](value):
+                check_field(value, path)
+                return
+        raise validation_error(
+            f"{value!r} is not valid under any of the given schemas", path
+        )
+
+    return check_one_of
+
+
+def _compile_section(schema):
+    """Compile an object of fields, like 'switch' or 'eth', into a function.
+
+    The function validates the section and copies its fields into the
+    converted entry."""
+    required = schema.get('required', [])
+    fields = {name: _compile_field(field_schema)
+              for name, field_schema in schema.get('properties', {}).items()}
+    sweepable = {name for name, field_schema
+                 in schema.get('properties', {}).items()
+                 if 'oneOf' in field_schema}
+
+    def convert_section(section, path, new_entry):
+        _check_type('object', section, path)
+        for name in required:
+            if name not in section:
+                raise validation_error(
+                    f"{name!r} is a required property", path
+                )
+        for name, value in section.items():
+            check_field = fields.get(name)
+            if check_field:
+                check_field(value, path + (name,))
+            if name in sweepable and isinstance(value, (list, dict)):
+                new_entry.setdefault(SWEEP, {})[name] = value
+                continue
+            new_entry[name] = value
+
+    return convert_section
+
+
+def compile_entries_validator(schema):
+    """Compile the schema of a list of trace entries into a function.
+
+    The function takes the decoded body of a PUT /v1/traces request and
+    returns the list of plain dicts suitable for matching, like
+    convert_list_entries, or raises a 400 error."""
+    trace_schema = schema['items']['properties']['trace']
+    trace_required = trace_schema.get('required', [])
+    sections = {name: _compile_section(section_schema)
+                for name, section_schema
+                in trace_schema.get('properties', {}).items()}
+
+    def validate_entries(data):
+        _check_type('array', data, ())
+        new_entries = []
+        for index, entry in enumerate(data):
+            _check_type('object', entry, (index,))
+            if 'trace' not in entry:
+                continue
+            trace = entry['trace']
+            path = (index, 'trace')
+            _check_type('object', trace, path)
+            for name in trace_required:
+                if name not in trace:
+                    raise validation_error(
+                        f"{name!r} is a required property", path
+                    )
+            new_entry = {}
+            for name, section in trace.items():
+                convert_section = sections.get(name)
+                if convert_section:
+                    convert_section(section, path + (name,), new_entry)
+                elif isinstance(section, dict):
+                    new_entry.update(section)
+            if 'dl_vlan' in new_entry:
+                new_entry['dl_vlan'] = [new_entry['dl_vlan']]
+            if new_entry:
+                new_entries.append(new_entry)
+        return new_entries
+
+    return validate_entries
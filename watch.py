@@ -0,0 +1,323 @@
+"""Watched traces.
+
+A watched trace is a trace entry that is traced again whenever the flows or
+links its result depends on change. While tracing, every table looked up is
+recorded in a trail, along with the packet fields at that point and the
+flow matched, if any, so the result of a trace only depends on:
+
+- flows added to one of these tables that match the recorded packet;
+- the matched flows, if removed;
+- the links of the ports the trace goes through.
+
+Watched traces are indexed by table and by port, so only the ones affected
+by a change are traced again, and their new results are pushed to the
+subscribers of the stream of changes.
+"""
+import asyncio
+import json
+from datetime import datetime
+from threading import Lock
+from uuid import uuid4
+
+from napps.amlight.sdntrace_cp import settings
+from napps.amlight.sdntrace_cp.utils import copy_args
+
+
+class WatchedTracesLimitError(Exception):
+    """Raised when no more traces can be watched."""
+
+
+def same_flow(stored_flow, flow, flow_id=None):
+    """Whether a stored flow is the same flow of an event.
+
+    Flows are compared by id when they have one, otherwise by the fields
+    that identify a flow in a table."""
+    if flow_id and stored_flow.get('flow_id'):
+        return stored_flow['flow_id'] == flow_id
+    stored_flow = stored_flow['flow']
+    return all(stored_flow.get(key) == flow.get(key)
+               for key in ('table_id', 'priority', 'match', 'cookie'))
+
+
+class WatchedTrace:
+    """A trace entry and its last result, as prepared for the response."""
+
+    def __init__(self, entries):
+        self.id = uuid4().hex
+        self.entries = entries
+        self.result = []
+        self.trail = []
+        self.changes = 0
+        self.created_at = str(datetime.now())
+        self.updated_at = None
+
+    def as_dict(self):
+        """Return the watched trace with its last result as a dict."""
+        return {
+            "id": self.id,
+            "result": self.result,
+            "changes": self.changes,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+    def ports(self):
+        """Return the (dpid, port) pairs the trace goes through."""
+        ports = set()
+        steps = list(self.result)
+        while steps:
+            step = steps.pop()
+            ports.add((step['dpid'], step['port']))
+            if step.get('out'):
+                ports.add((step['dpid'], step['out']['port']))
+            for branch in step.get('branches', ()):
+                ports.add((step['dpid'], branch['out']['port']))
+                steps.extend(branch['result'])
+        return ports
+
+
+class WatchedTraces:
+    """Store of watched traces indexed by the tables and ports they go
+    through."""
+
+    def __init__(self, run_trace, do_match, prepare,
+                 max_watched=settings.WATCHED_TRACES_MAX):
+        self._run_trace = run_trace
+        self._do_match = do_match
+        self._prepare = prepare
+        self.max_watched = max_watched
+        self._watched = {}
+        self._by_table = {}
+        self._by_port = {}
+        self._lock = Lock()
+
+    def add(self, entries, stored_flows):
+        """Trace an entry and start watching it."""
+        with self._lock:
+            if len(self._watched) >= self.max_watched:
+                raise WatchedTracesLimitError(
+                    f"There are already {len(self._watched)} watched traces"
+                )
+            watched = WatchedTrace(entries)
+            self._trace(watched, stored_flows)
+            self._watched[watched.id] = watched
+            self._index(watched)
+        return watched
+
+    def get(self, watch_id):
+        """Return a watched trace given its id or None."""
+        return self._watched.get(watch_id)
+
+    def list(self):
+        """Return all watched traces."""
+        return list(self._watched.values())
+
+    def remove(self, watch_id):
+        """Stop watching a trace and return it, or None if not found."""
+        with self._lock:
+            watched = self._watched.pop(watch_id, None)
+            if watched:
+                self._unindex(watched)
+        return watched
+
+    def affected_by_flow(self, dpid, flow, flow_id=None, removed=False):
+        """Return the ids of the watched traces that may change with a flow
+        added to or removed from a switch.
+
+        flow is a flow as in the 'flow' key of a stored flow."""
+        table_id = flow.get('table_id', 0)
+        stored_flow = {'flow': flow}
+        affected = set()
+        with self._lock:
+            for watch_id, lookups in self._by_table.get((dpid, table_id),
+                                                        {}).items():
+                for args, matched in lookups:
+                    if removed:
+                        changed = matched and same_flow(matched, flow,
+                                                        flow_id)
+                    else:
+                        changed = self._do_match(stored_flow, args, table_id)
+                    if changed:
+                        affected.add(watch_id)
+                        break
+        return affected
+
+    def affected_by_ports(self, ports):
+        """Return the ids of the watched traces that go through any of the
+        given (dpid, port) pairs."""
+        with self._lock:
+            return {watch_id for port in ports
+                    for watch_id in self._by_port.get(port, ())}
+
+    def rerun(self, watch_ids, stored_flows):
+        """Trace watched traces again.
+
+        Return a list of (watched trace, previous result) pairs for the
+        ones whose result changed."""
+        changed = []
+        with self._lock:
+            for watch_id in watch_ids:
+                watched = self._watched.get(watch_id)
+                if not watched:
+                    continue
+                previous = watched.result
+                self._unindex(watched)
+                self._trace(watched, stored_flows)
+                self._index(watched)
+                if watched.result != previous:
+                    watched.changes += 1
+                    changed.append((watched, previous))
+        return changed
+
+    def _trace(self, watched, stored_flows):
+        """Trace a watched trace, recording its trail."""
+        trail = []
+        watched.result = self._prepare(
+            self._run_trace(copy_args(watched.entries), stored_flows,
+                            timing='none', trail=trail)
+        )
+        watched.trail = trail
+        watched.updated_at = str(datetime.now())
+
+    def _index(self, watched):
+        """Add a watched trace to the indexes."""
+        for dpid, table_id, args, flow in watched.trail:
+            lookups = self._by_table.setdefault((dpid, table_id), {})
+            lookups.setdefault(watched.id, []).append((args, flow))
+        for port in watched.ports():
+            self._by_port.setdefault(port, set()).add(watched.id)
+
+    def _unindex(self, watched):
+        """Remove a watched trace from the indexes."""
+        for dpid, table_id, _, _ in watched.trail:
+            lookups = self._by_table.get((dpid, table_id), {})
+            lookups.pop(watched.id, None)
+            if not lookups:
+                self._by_table.pop((dpid, table_id), None)
+        for port in watched.ports():
+            watch_ids = self._by_port.get(port, set())
+            watch_ids.discard(watched.id)
+            if not watch_ids:
+                self._by_port.pop(port, None)
+
+
+def diff_results(previous, result):
+    """Return the steps of two trace results from the first one that
+    differs, as prepared by prepare_json."""
+    index = 0
+    for index, (old, new) in enumerate(zip(previous, result)):
+        if old != new:
+            break
+    else:
+        index = min(len(previous), len(result))
+    return {'index': index, 'removed': previous[index:],
+            'added': result[index:]}
+
+
+class WatchedTraceStreamLimitError(Exception):
+    """Raised when the stream of watched traces has too many subscribers."""
+
+
+class WatchedTraceStream:
+    """Server-Sent Events stream of watched trace changes.
+
+    Every subscriber is an asyncio queue read by an async generator in the
+    event loop of its connection, so subscribers don't hold worker threads.
+    Messages are published from any thread into the loop of each
+    subscriber. The number of subscribers is bounded and every queue too:
+    a subscriber too slow to keep up is dropped, its stream ends and the
+    client has to reconnect."""
+
+    def __init__(self, queue_size=settings.WATCHED_TRACES_STREAM_QUEUE,
+                 heartbeat=settings.WATCHED_TRACES_STREAM_HEARTBEAT,
+                 max_subscribers=settings.WATCHED_TRACES_STREAM_SUBSCRIBERS):
+        self.queue_size = queue_size
+        self.heartbeat = heartbeat
+        self.max_subscribers = max_subscribers
+        self._subscribers = {}
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def publish(self, event, content):
+        """Send an event to all subscribers."""
+        message = f"event: {event}\ndata: {json.dumps(content)}\n\n"
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+        for subscriber, loop in subscribers:
+            self._call_soon(loop, self._put, subscriber, message)
+
+    def close(self):
+        """End the streams of all subscribers."""
+        with self._lock:
+            subscribers = list(self._subscribers.items())
+            self._subscribers.clear()
+        for subscriber, loop in subscribers:
+            self._call_soon(loop, self._end, subscriber)
+
+    def subscribe(self, initial=()):
+        """Return an async generator of messages for a new subscriber,
+        starting with the given (event, content) pairs.
+
+        It must be called from the event loop serving the subscriber."""
+        subscriber = asyncio.Queue(self.queue_size + 1)
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                raise WatchedTraceStreamLimitError(
+                    f"There are already {len(self._subscribers)} "
+                    "subscribers"
+                )
+            self._subscribers[subscriber] = asyncio.get_running_loop()
+        return self._messages(subscriber, initial)
+
+    async def _messages(self, subscriber, initial):
+        """Yield the messages of a subscriber until it's dropped."""
+        try:
+            for event, content in initial:
+                yield f"event: {event}\ndata: {json.dumps(content)}\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscriber.get(),
+                                                     self.heartbeat)
+                except asyncio.TimeoutError:
+                    message = ": heartbeat\n\n"
+                if message is None:
+                    return
+                yield message
+        finally:
+            self._unsubscribe(subscriber)
+
+    def _call_soon(self, loop, callback, subscriber, *args):
+        """Run a callback on a subscriber in its event loop, dropping the
+        subscriber if the loop is closed."""
+        try:
+            loop.call_soon_threadsafe(callback, subscriber, *args)
+        except RuntimeError:
+            self._unsubscribe(subscriber)
+
+    def _put(self, subscriber, message):
+        """Queue a message for a subscriber, in its event loop, or drop
+        the subscriber if it doesn't keep up."""
+        if subscriber.qsize() >= self.queue_size:
+            # The extra slot of the queue is left for ending the stream
+            self._unsubscribe(subscriber)
+            self._end(subscriber)
+            return
+        try:
+            subscriber.put_nowait(message)
+        except asyncio.QueueFull:
+            self._unsubscribe(subscriber)
+
+    @staticmethod
+    def _end(subscriber):
+        """End the stream of a subscriber, in its event loop."""
+        try:
+            subscriber.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
+
+    def _unsubscribe(self, subscriber):
+        """Remove a subscriber."""
+        with self._lock:
+            self._subscribers.pop(subscriber, None)